@@ -11,20 +11,20 @@ from fabric.context_managers import (
     cd, hide, settings, show, path, prefix, lcd, quiet, warn_only, remote_tunnel, shell_env
 )
 from fabric.decorators import (
-    hosts, roles, runs_once, with_settings, task, serial, parallel
+    hosts, roles, runs_once, with_settings, task, serial, parallel, rolling
 )
 from fabric.operations import (
-    require, prompt, put, get, run, sudo, local, reboot, open_shell
+    require, prompt, put, get, run, run_concurrent, sudo, local, reboot, open_shell
 )
 from fabric.state import env, output
 from fabric.utils import abort, warn, puts, fastprint
-from fabric.tasks import execute
+from fabric.tasks import execute, execute_iter
 
 __all__ = [
     "cd", "hide", "settings", "show", "path", "prefix", "lcd", "quiet", "warn_only", "remote_tunnel", "shell_env",
-    "hosts", "roles", "runs_once", "with_settings", "task", "serial", "parallel",
-    "require", "prompt", "put", "get", "run", "sudo", "local", "reboot", "open_shell",
+    "hosts", "roles", "runs_once", "with_settings", "task", "serial", "parallel", "rolling",
+    "require", "prompt", "put", "get", "run", "run_concurrent", "sudo", "local", "reboot", "open_shell",
     "env", "output",
     "abort", "warn", "puts", "fastprint",
-    "execute",
+    "execute", "execute_iter",
 ]
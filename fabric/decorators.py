@@ -176,6 +176,35 @@ def parallel(pool_size=None):
     return real_decorator
 
 
+def rolling(batch_size, max_failures=0):
+    """
+    Runs the wrapped task in parallel, one batch of ``batch_size`` hosts at a time.
+
+    Each batch only starts once the one before it has finished, and only if
+    no more than ``max_failures`` of that batch's hosts failed; otherwise the
+    remaining hosts are skipped. ``batch_size`` may also be a percentage of
+    the task's hosts, such as ``'10%'``.
+
+    Like `~fabric.decorators.parallel`, this takes precedence over
+    `~fabric.decorators.serial` and :ref:`env.parallel <env-parallel>`.
+
+    .. versionadded:: 1.21
+    .. seealso:: :ref:`rolling-execution`
+    """
+    def real_decorator(func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            return func(*args, **kwargs)
+
+        inner.parallel = True
+        inner.serial = False
+        inner.batch_size = batch_size
+        inner.max_failures = max_failures
+        return _wrap_as_new(func, inner)
+
+    return real_decorator
+
+
 def with_settings(*arg_settings, **kw_settings):
     """
     Decorator equivalent of ``fabric.context_managers.settings``.
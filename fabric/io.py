@@ -1,6 +1,7 @@
+import codecs
 import re
+import selectors
 import sys
-import socket
 import time
 from select import select
 from collections import deque
@@ -15,27 +16,250 @@ if win32:
     import msvcrt
 
 
-def _endswith(char_list, substring):
-    if len(substring) > len(char_list):
-        return False
+def _has_newline(bytelist):
+    return '\r' in bytelist or '\n' in bytelist
+
+
+class CaptureBuffer(object):
+    """
+    Captured output, kept as a list of string chunks.
+
+    Text is added with ``+=``. Like a ``deque`` with a ``maxlen``, only the
+    last ``maxlen`` characters are kept if ``maxlen`` is given; unlike one, it
+    doesn't take a pointer per character, so even very large outputs can be
+    captured and joined together again quickly. ``len()``, iteration (by
+    character) and ``pop()`` work as for a ``deque``.
+    """
+    # How many pieces of text to add before joining them into one chunk
+    join_every = 64
+    # How much of a longer chunk to split off for pop() to take characters from
+    pop_split = 256
+
+    def __init__(self, maxlen=None):
+        self.maxlen = maxlen
+        self._chunks = deque()
+        self._len = 0
+        # Chunks at the end which were added as they are, not joined yet
+        self._loose = 0
+
+    def __iadd__(self, text):
+        if text:
+            self._chunks.append(text)
+            self._len += len(text)
+            self._loose += 1
+            if self._loose >= self.join_every:
+                loose = [self._chunks.pop() for i in range(self._loose)]
+                self._chunks.append(''.join(reversed(loose)))
+                self._loose = 0
+            if self.maxlen is not None and self._len > self.maxlen:
+                self._trim(self._len - self.maxlen)
+        return self
+
+    def _trim(self, excess):
+        while excess and excess >= len(self._chunks[0]):
+            excess -= len(self._chunks.popleft())
+        if excess:
+            self._chunks[0] = self._chunks[0][excess:]
+        self._len = self.maxlen
+        self._loose = min(self._loose, len(self._chunks))
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            for char in chunk:
+                yield char
+
+    def pop(self):
+        """
+        Remove and return the last character.
+        """
+        if not self._len:
+            raise IndexError("pop from an empty CaptureBuffer")
+        last = self._chunks.pop()
+        if len(last) > self.pop_split:
+            # Copy the bulk of a long chunk once, rather than once per
+            # character popped, leaving its end as a short loose piece
+            self._chunks.append(last[:-self.pop_split])
+            last = last[-self.pop_split:]
+            self._loose += 1
+        if len(last) > 1:
+            self._chunks.append(last[:-1])
+        elif self._loose:
+            self._loose -= 1
+        self._len -= 1
+        return last[-1]
+
+    def endswith(self, suffix):
+        """
+        Return whether the captured text ends with ``suffix``.
 
-    for i in range(len(substring)):
-        if char_list[-1 - i] != substring[-1 - i]:
+        Only looks at as much of the end as it needs to.
+        """
+        need = len(suffix)
+        if not need:
+            return True
+        if need > self._len:
             return False
+        if need <= len(self._chunks[-1]):
+            return self._chunks[-1].endswith(suffix)
+        parts = []
+        for chunk in reversed(self._chunks):
+            if need <= len(chunk):
+                parts.append(chunk[len(chunk) - need:])
+                break
+            parts.append(chunk)
+            need -= len(chunk)
+        return ''.join(reversed(parts)) == suffix
 
-    return True
+    def getvalue(self):
+        """
+        Return all of the captured text as one string.
+        """
+        value = ''.join(self._chunks)
+        self._chunks = deque([value] if value else [])
+        self._loose = 0
+        return value
+
+
+_LINE_BREAK = re.compile(r'[\r\n]')
+
+
+def _fragment_ends(text):
+    """
+    Yield the offsets in ``text`` at which each line, and each line break,
+    ends.
+    """
+    start = 0
+    for match in _LINE_BREAK.finditer(text):
+        if match.start() > start:
+            yield match.start()
+        start = match.end()
+        yield start
+    if start < len(text):
+        yield len(text)
+
+
+class PromptMatcher(object):
+    """
+    Recognizes which of a list of prompts some output ends with.
+
+    ``prompts`` is in order of priority. Each one is a string, or a compiled
+    regular expression, which is taken to match if it matches the end of the
+    current line (as far back as its last ``regex_window`` characters).
+
+    String prompts are compiled into an Aho-Corasick automaton, whose state is
+    carried along by `advance` as output arrives, so keeping track of them
+    costs no more for dozens of prompts than it does for one. `match` then
+    gives the index of the first prompt matching at that point, or ``None``.
+    """
+    regex_window = 4096
+
+    def __init__(self, prompts):
+        self.prompts = prompts
+        literals = []
+        self.regexes = []
+        for index, prompt in enumerate(prompts):
+            if hasattr(prompt, 'search'):
+                regex = re.compile('(?:%s)\\Z' % prompt.pattern, prompt.flags)
+                self.regexes.append((index, regex))
+            elif str(prompt):
+                literals.append((index, str(prompt)))
+        self.longest = max([len(literal) for index, literal in literals] or [0])
+        # Characters which don't appear in any prompt send the automaton back
+        # to its start, so anything before them can be skipped.
+        self.alphabet = ''.join(set(''.join(literal for index, literal in literals)))
+        self._build(literals)
+
+    def _build(self, literals):
+        # A trie of the prompts, noting the best prompt ending at each node
+        goto = [{}]
+        self.best = [None]
+        for index, literal in literals:
+            state = 0
+            for char in literal:
+                if char not in goto[state]:
+                    goto.append({})
+                    self.best.append(None)
+                    goto[state][char] = len(goto) - 1
+                state = goto[state][char]
+            if self.best[state] is None:
+                self.best[state] = index
+        # Then, breadth first, fill in the transitions for characters which
+        # fall off the trie from those of the longest proper suffix which
+        # doesn't, and the prompts ending at that suffix.
+        self.delta = [dict(goto[0])]
+        self.delta.extend({} for state in goto[1:])
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            suffix = fail[state]
+            if self.best[state] is None or (self.best[suffix] is not None
+                                            and self.best[suffix] < self.best[state]):
+                self.best[state] = self.best[suffix]
+            self.delta[state] = dict(self.delta[suffix], **goto[state])
+            for char, child in goto[state].items():
+                fail[child] = self.delta[suffix].get(char, 0)
+                queue.append(child)
+
+    def advance(self, state, text):
+        """
+        Return the state after ``text`` follows the output seen in ``state``.
 
+        The start state is ``0``.
+        """
+        # Only the end of the text can matter: the part after the last
+        # character not in any prompt, and no more than the longest prompt.
+        known = len(text) - len(text.rstrip(self.alphabet))
+        if known < len(text) or known > self.longest:
+            state = 0
+            text = text[len(text) - min(known, self.longest):]
+        delta = self.delta
+        for char in text:
+            state = delta[state].get(char, 0)
+        return state
+
+    def extend_line(self, line, text):
+        """
+        Return the end of the current line once ``text`` follows ``line``.
+        """
+        if text in ('\r', '\n'):
+            return ''
+        return (line + text)[-self.regex_window:]
 
-def _has_newline(bytelist):
-    return '\r' in bytelist or '\n' in bytelist
+    def match(self, state, line=''):
+        """
+        Return the index of the first prompt the output ends with, if any.
+        """
+        best = self.best[state]
+        for index, regex in self.regexes:
+            if best is not None and index > best:
+                break
+            if regex.search(line):
+                return index
+        return best
+
+
+_prompt_matchers = {}
 
 
-def output_loop(*args, **kwargs):
-    OutputLooper(*args, **kwargs).loop()
+def _prompt_matcher(prompts):
+    """
+    Return a `PromptMatcher` for the tuple ``prompts``, reusing one if we can.
+    """
+    matcher = _prompt_matchers.get(prompts)
+    if matcher is None:
+        if len(_prompt_matchers) >= 32:
+            _prompt_matchers.clear()
+        matcher = _prompt_matchers[prompts] = PromptMatcher(prompts)
+    return matcher
 
 
 class OutputLooper(object):
-    def __init__(self, chan, attr, stream, capture, timeout):
+    def __init__(self, chan, attr, stream, capture, timeout, encoding='utf-8',
+                 errors='replace'):
         self.chan = chan
         self.stream = stream
         self.capture = capture
@@ -50,6 +274,16 @@ class OutputLooper(object):
         self.reprompt = False
         self.read_size = 4096
         self.write_buffer = deque(maxlen=len(self.prefix))
+        # Allow prefix to be turned off.
+        if not env.output_prefix:
+            self.prefix = ""
+        # State carried from one read to the next
+        self.initial_prefix_printed = False
+        self.seen_cr = False
+        self.line = []
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors)
+        self.prompt_state = 0
+        self.prompt_line = ''
 
     def _flush(self, text):
         self.stream.write(text)
@@ -60,127 +294,105 @@ class OutputLooper(object):
             self.stream.flush()
         self.write_buffer.extend(text)
 
-    def loop(self):
+    def feed(self, bytelist):
         """
-        Loop, reading from <chan>.<attr>(), writing to <stream> and buffering to <capture>.
-
-        Will raise `~fabric.exceptions.CommandTimeout` if network timeouts
-        continue to be seen past the defined ``self.timeout`` threshold.
-        (Timeouts before then are considered part of normal short-timeout fast
-        network reading; see Fabric issue #733 for background.)
+        Print, capture and answer any prompts in ``bytelist``, just read.
         """
-        # Initialize loop variables
-        initial_prefix_printed = False
-        seen_cr = False
-        line = []
-        py3_buffer = b''
+        if isinstance(bytelist, bytes):
+            # Characters split across reads are held back until the rest of
+            # them arrives
+            bytelist = self.decoder.decode(bytelist)
+        if not bytelist:
+            return
+
+        # A None capture variable implies that we're in open_shell()
+        if self.capture is None:
+            # Just print directly -- no prefixes, no capturing, nada
+            # And since we know we're using a pty in this mode, just go
+            # straight to stdout.
+            self._flush(bytelist)
+        # Otherwise, we're in run/sudo and need to handle capturing and
+        # prompts.
+        else:
+            # Print to user
+            if self.printing:
+                printable_bytes = bytelist
+                # Small state machine to eat \n after \r
+                if printable_bytes[-1] == "\r":
+                    self.seen_cr = True
+                if printable_bytes[0] == "\n" and self.seen_cr:
+                    printable_bytes = printable_bytes[1:]
+                    self.seen_cr = False
+
+                while _has_newline(printable_bytes) and printable_bytes != "":
+                    # at most 1 split !
+                    cr = re.search("(\r\n|\r|\n)", printable_bytes)
+                    if cr is None:
+                        break
+                    end_of_line = printable_bytes[:cr.start(0)]
+                    printable_bytes = printable_bytes[cr.end(0):]
+
+                    if not self.initial_prefix_printed:
+                        self._flush(self.prefix)
+
+                    if _has_newline(end_of_line):
+                        end_of_line = ''
 
-        # Allow prefix to be turned off.
-        if not env.output_prefix:
-            self.prefix = ""
+                    if self.linewise:
+                        self._flush("".join(self.line) + end_of_line + "\n")
+                        self.line = []
+                    else:
+                        self._flush(end_of_line + "\n")
+                    self.initial_prefix_printed = False
 
-        start = time.time()
-        while True:
-            # Handle actual read
-            try:
-                bytelist = self.read_func(self.read_size)
-            except socket.timeout:
-                elapsed = time.time() - start
-                if self.timeout is not None and elapsed > self.timeout:
-                    raise CommandTimeout(timeout=self.timeout)
-                continue
-
-            if isinstance(bytelist, bytes):
-                # Note that we have to decode this right away, even if an error
-                # is thrown only later in the code, because e.g. '' != b'' (see
-                # first if below).
-                py3_buffer += bytelist
-                try:
-                    bytelist = py3_buffer.decode('utf-8')
-                except UnicodeDecodeError:
-                    # Go back and grab more bytes so we hopefully get a
-                    # complete and valid Python string.
-                    # Might hang here if remote server sends garbage but unsure
-                    # if it's worth switching to processing byte by byte ...
+                if self.linewise:
+                    self.line += [printable_bytes]
+                else:
+                    if not self.initial_prefix_printed:
+                        self._flush(self.prefix)
+                        self.initial_prefix_printed = True
+                    self._flush(printable_bytes)
+
+            # Now we have handled printing, handle interactivity: look for
+            # prompts at the end of each line and line break, in order of
+            # env.prompts, then the sudo prompt, then "try again".
+            prompts = list(env.prompts.items())
+            matcher = _prompt_matcher(tuple(
+                [expected for expected, response in prompts]
+                + [env.sudo_prompt, env.again_prompt + '\n', env.again_prompt + '\r\n']
+            ))
+            captured = start = 0
+            for end in _fragment_ends(bytelist):
+                fragment = bytelist[start:end]
+                start = end
+                self.prompt_state = matcher.advance(self.prompt_state, fragment)
+                if matcher.regexes:
+                    self.prompt_line = matcher.extend_line(self.prompt_line, fragment)
+                index = matcher.match(self.prompt_state, self.prompt_line)
+                if index is None:
                     continue
+                # Store in capture buffer up to the prompt, then handle it
+                self.capture += bytelist[captured:end]
+                captured = end
+                self.prompt_state, self.prompt_line = 0, ''
+                if index < len(prompts):
+                    self.chan.sendall(str(prompts[index][1]) + '\n')
+                elif index == len(prompts):
+                    self.prompt()
                 else:
-                    # Reset the buffer as we succeeded
-                    py3_buffer = b''
-
-            # Empty byte == EOS
-            if bytelist == '':
-                # If linewise, ensure we flush any leftovers in the buffer.
-                if self.linewise and line:
-                    self._flush(self.prefix)
-                    self._flush("".join(line))
-                break
+                    self.try_again()
+            self.capture += bytelist[captured:]
 
-            # A None capture variable implies that we're in open_shell()
-            if self.capture is None:
-                # Just print directly -- no prefixes, no capturing, nada
-                # And since we know we're using a pty in this mode, just go
-                # straight to stdout.
-                self._flush(bytelist)
-            # Otherwise, we're in run/sudo and need to handle capturing and
-            # prompts.
-            else:
-                # Print to user
-                if self.printing:
-                    printable_bytes = bytelist
-                    # Small state machine to eat \n after \r
-                    if printable_bytes[-1] == "\r":
-                        seen_cr = True
-                    if printable_bytes[0] == "\n" and seen_cr:
-                        printable_bytes = printable_bytes[1:]
-                        seen_cr = False
-
-                    while _has_newline(printable_bytes) and printable_bytes != "":
-                        # at most 1 split !
-                        cr = re.search("(\r\n|\r|\n)", printable_bytes)
-                        if cr is None:
-                            break
-                        end_of_line = printable_bytes[:cr.start(0)]
-                        printable_bytes = printable_bytes[cr.end(0):]
-
-                        if not initial_prefix_printed:
-                            self._flush(self.prefix)
-
-                        if _has_newline(end_of_line):
-                            end_of_line = ''
-
-                        if self.linewise:
-                            self._flush("".join(line) + end_of_line + "\n")
-                            line = []
-                        else:
-                            self._flush(end_of_line + "\n")
-                        initial_prefix_printed = False
-
-                    if self.linewise:
-                        line += [printable_bytes]
-                    else:
-                        if not initial_prefix_printed:
-                            self._flush(self.prefix)
-                            initial_prefix_printed = True
-                        self._flush(printable_bytes)
-
-                # Now we have handled printing, handle interactivity
-                read_lines = re.split(r"(\r|\n|\r\n)", bytelist)
-                for fragment in read_lines:
-                    # Store in capture buffer
-                    self.capture += fragment
-                    # Handle prompts
-                    expected, response = self._get_prompt_response()
-                    if expected:
-                        del list(self.capture)[-1 * len(expected):]
-                        self.chan.sendall(str(response) + '\n')
-                    else:
-                        prompt = _endswith(self.capture, env.sudo_prompt)
-                        try_again = (_endswith(self.capture, env.again_prompt + '\n')
-                            or _endswith(self.capture, env.again_prompt + '\r\n'))
-                        if prompt:
-                            self.prompt()
-                        elif try_again:
-                            self.try_again()
+    def finish(self):
+        """
+        Tie off the output once the stream has ended.
+        """
+        # Anything left of an incomplete character
+        self.feed(self.decoder.decode(b'', final=True))
+        # If linewise, ensure we flush any leftovers in the buffer.
+        if self.linewise and self.line:
+            self._flush(self.prefix)
+            self._flush("".join(self.line))
 
         # Print trailing new line if the last thing we printed was our line
         # prefix.
@@ -236,27 +448,33 @@ class OutputLooper(object):
         # Set state so we re-prompt the user at the next prompt.
         self.reprompt = True
 
-    def _get_prompt_response(self):
-        """
-        Iterate through the request prompts dict and return the response and
-        original request if we find a match
-        """
-        for tup in env.prompts.items():
-            if _endswith(self.capture, tup[0]):
-                return tup
-        return None, None
+
+def _waitable(f):
+    """
+    Return whether we can wait for input from ``f`` with a selector.
+    """
+    if win32:
+        return False
+    try:
+        f.fileno()
+    except ValueError:
+        return False
+    return True
+
+
+def _send_input(chan, byte, using_pty, is_stdin):
+    chan.sendall(byte)
+    # Optionally echo locally, if needed.
+    if (not using_pty) and is_stdin and env.echo_stdin:
+        # Not using fastprint() here -- it prints as 'user'
+        # output level, don't want it to be accidentally hidden
+        sys.stdout.write(byte)
+        sys.stdout.flush()
 
 
 def input_loop(chan, f, using_pty):
     is_stdin = f == sys.stdin
-    waitable = True
-    if win32:
-        waitable = False
-    else:
-        try:
-            f.fileno()
-        except ValueError:
-            waitable = False
+    waitable = _waitable(f)
 
     while not chan.exit_status_ready():
         byte = None
@@ -273,16 +491,148 @@ def input_loop(chan, f, using_pty):
             byte = f.read(1)
 
         if byte:
-            chan.sendall(byte)
-            # Optionally echo locally, if needed.
-            if (not using_pty) and is_stdin and env.echo_stdin:
-                # Not using fastprint() here -- it prints as 'user'
-                # output level, don't want it to be accidentally hidden
-                sys.stdout.write(byte)
-                sys.stdout.flush()
-
+            _send_input(chan, byte, using_pty, is_stdin)
         elif byte == '':  # EOF
             chan.shutdown_write()
             break
         else:
             time.sleep(ssh.io_sleep)
+
+
+# Unlike epoll, poll() works with any stdin, even a regular file, and unlike
+# select() it doesn't mind how many channels' file descriptors there are.
+_Selector = getattr(selectors, 'PollSelector', selectors.SelectSelector)
+
+
+class ChannelIO(object):
+    """
+    The I/O of one channel, as served by `serve_channels`.
+
+    The channel's stdout and stderr are printed and captured by an
+    `OutputLooper` each, to ``stdout``/``stderr`` and the ``stdout_buf``/
+    ``stderr_buf`` capture buffers respectively, answering prompts as they
+    come. Input from ``stdin``, if given, is sent to the channel as it
+    arrives; it must be something we can wait on with a selector (see
+    `_waitable`). ``timeout`` is how long it may run for, and output is decoded
+    with the given ``encoding`` and ``errors`` handling.
+    """
+    def __init__(self, chan, stdout, stderr, stdout_buf, stderr_buf,
+                 stdin=None, using_pty=False, timeout=None, encoding='utf-8',
+                 errors='replace'):
+        self.chan = chan
+        self.out = OutputLooper(chan, 'recv', stdout, stdout_buf, timeout,
+            encoding, errors)
+        self.err = OutputLooper(chan, 'recv_stderr', stderr, stderr_buf, timeout,
+            encoding, errors)
+        self.stdin = stdin
+        self.using_pty = using_pty
+        self.timeout = timeout
+        self.deadline = None if timeout is None else time.time() + timeout
+        self.out_done = self.err_done = False
+        self.input_done = stdin is None
+
+    @property
+    def done(self):
+        """
+        Whether the channel's output has ended.
+        """
+        return self.out_done and self.err_done
+
+    def wants_input(self):
+        return (not self.input_done and self.chan.input_enabled
+            and self.chan.send_ready())
+
+    def read(self):
+        """
+        Handle any output that has arrived, noting when each stream ends.
+        """
+        if not self.out_done:
+            self.out_done = self._read(self.out, self.chan.recv_ready)
+        if not self.err_done:
+            self.err_done = self._read(self.err, self.chan.recv_stderr_ready)
+
+    def _read(self, looper, ready):
+        # Output sent before EOF is already in the buffer once EOF is seen, so
+        # if it was seen before the buffer ran dry the stream has ended. (Not
+        # if it's seen after: output and EOF may have arrived in between.)
+        eof = self.chan.eof_received or self.chan.closed
+        while ready():
+            looper.feed(looper.read_func(looper.read_size))
+            if not eof:
+                return False
+        if eof:
+            looper.finish()
+            return True
+        return False
+
+    def write(self):
+        """
+        Send the input that has arrived on to the channel.
+        """
+        byte = self.stdin.read(1)
+        if byte:
+            _send_input(self.chan, byte, self.using_pty, self.stdin == sys.stdin)
+        else:  # EOF
+            self.chan.shutdown_write()
+            self.input_done = True
+
+
+def serve_channels(channels, finished=None):
+    """
+    Serve the I/O of each of ``channels`` (`ChannelIO` objects) until all of
+    their output has ended, all from the calling thread.
+
+    ``finished``, if given, is called with each of ``channels`` as its output
+    ends, and may append more to ``channels``, which are then served as well.
+
+    Raises `~fabric.exceptions.CommandTimeout` if any of them is still going
+    past its timeout. If interrupted (e.g. by ``KeyboardInterrupt``) this may
+    be called again to carry on where it left off.
+    """
+    selector = _Selector()
+    try:
+        waiting_for_input = set()
+        while True:
+            pending = [io for io in channels if not io.done]
+            if not pending:
+                return
+            for io in pending:
+                try:
+                    selector.get_key(io.chan)
+                except KeyError:
+                    selector.register(io.chan, selectors.EVENT_READ, io)
+            # Watch each stdin only while its channel can take input,
+            # checking back now and then when it can't
+            wait = None
+            now = time.time()
+            for io in pending:
+                wants_input = io.wants_input()
+                if wants_input and io not in waiting_for_input:
+                    selector.register(io.stdin, selectors.EVENT_READ, io)
+                    waiting_for_input.add(io)
+                elif not wants_input and io in waiting_for_input:
+                    selector.unregister(io.stdin)
+                    waiting_for_input.remove(io)
+                if not (wants_input or io.input_done):
+                    wait = ssh.io_sleep
+                if io.deadline is not None:
+                    if now > io.deadline:
+                        raise CommandTimeout(timeout=io.timeout)
+                    left = io.deadline - now
+                    wait = left if wait is None else min(wait, left)
+
+            for key, mask in selector.select(wait):
+                io = key.data
+                if key.fileobj is io.chan:
+                    io.read()
+                    if io.done:
+                        selector.unregister(io.chan)
+                        if io in waiting_for_input:
+                            selector.unregister(io.stdin)
+                            waiting_for_input.remove(io)
+                        if finished is not None:
+                            finished(io)
+                elif io in waiting_for_input:
+                    io.write()
+    finally:
+        selector.close()
@@ -7,7 +7,9 @@ items, though within Fabric itself only ``Process`` objects are used/supported.
 
 import time
 import queue as Queue
-from collections import namedtuple
+from collections import Counter, deque, namedtuple
+from itertools import chain
+from multiprocessing.connection import wait
 
 from fabric.network import ssh
 from fabric.context_managers import settings
@@ -15,6 +17,154 @@ from fabric.context_managers import settings
 
 DoneProc = namedtuple('DoneProc', ['name', 'exitcode'])
 
+
+class FIFOSchedule(object):
+    """
+    Scheduling policy for `JobQueue`: start jobs in the order they were queued.
+
+    This is also the base class for other policies, which may override:
+
+    * ``next_job(waiting)``, given an iterator over the jobs waiting to be
+      started (in the order they were queued), returns the one to start next,
+      or ``None`` if there are none left;
+    * ``started(job)`` and ``finished(job, duration)``, called as each job
+      starts, and once it's done along with how long it took in seconds.
+    """
+    def next_job(self, waiting):
+        return next(waiting, None)
+
+    def started(self, job):
+        pass
+
+    def finished(self, job, duration):
+        pass
+
+
+class LongestFirstSchedule(FIFOSchedule):
+    """
+    Scheduling policy which starts the longest jobs first.
+
+    ``durations`` maps job names to their expected durations in seconds, e.g.
+    as recorded in earlier runs, and is updated with each job's duration as it
+    finishes. Jobs with no expected duration go first, since they might be the
+    longest of all. This policy needs to see every job up front.
+    """
+    def __init__(self, durations):
+        self.durations = durations
+        self._jobs = None
+
+    def next_job(self, waiting):
+        if self._jobs is None:
+            unknown = float('inf')
+            self._jobs = deque(sorted(
+                waiting, key=lambda job: -self.durations.get(job.name, unknown)
+            ))
+        return self._jobs.popleft() if self._jobs else None
+
+    def finished(self, job, duration):
+        self.durations[job.name] = duration
+
+
+class RoleRoundRobinSchedule(FIFOSchedule):
+    """
+    Scheduling policy which shares the running jobs out between roles.
+
+    ``roles`` maps job names to role names; other jobs count as a role of their
+    own. Each job started is taken from whichever role has the fewest jobs
+    running at the time, taking turns between roles with equal numbers, so no
+    one role can hog the pool. This policy needs to see every job up front.
+    """
+    def __init__(self, roles):
+        self.roles = roles
+        self._jobs = None
+        self._running = Counter()
+
+    def next_job(self, waiting):
+        if self._jobs is None:
+            self._jobs = {}
+            for job in waiting:
+                self._jobs.setdefault(self.roles.get(job.name), deque()).append(job)
+        if not self._jobs:
+            return None
+        role = min(self._jobs, key=lambda role: self._running[role])
+        # Re-adding the role's jobs moves it to the back of the line
+        jobs = self._jobs.pop(role)
+        job = jobs.popleft()
+        if jobs:
+            self._jobs[role] = jobs
+        return job
+
+    def started(self, job):
+        self._running[self.roles.get(job.name)] += 1
+
+    def finished(self, job, duration):
+        self._running[self.roles.get(job.name)] -= 1
+
+
+class AdaptivePoolSize(object):
+    """
+    How many jobs a `JobQueue` runs at once, adjusted as jobs finish.
+
+    Works much like TCP congestion control. Starting from ``initial``, the size
+    grows by one for each job which finishes without trouble connecting --
+    doubling it every round of jobs, at first, and after the first trouble
+    growing it by one per round -- and halves on signs of an overloaded
+    network or gateway: retries due to timeouts or SSH protocol banner read
+    failures, or connect times ``slow_factor`` times (and a second) above the
+    best seen so far. Only jobs started since the last cut can cause another,
+    so one bout of trouble halves the size once. Jobs taking that much longer
+    than the quickest one don't count towards growing it, as tasks slowing
+    down means more of them at once won't help. It stays between 1 and
+    ``maximum``.
+
+    Jobs report how connecting went by putting ``{'name': ..., 'stats': ...}``
+    on the comms queue, or in their own ``stats`` attribute, with ``stats`` as
+    from `~fabric.network.connect_stats`.
+    """
+    def __init__(self, maximum, initial=4, slow_factor=3.0):
+        self.maximum = max(1, maximum)
+        self.size = min(initial, self.maximum)
+        self.slow_factor = slow_factor
+        self._slow_start = True
+        self._credit = 0
+        self._best_connect = None
+        self._best_duration = None
+        self._last_cut = 0.0
+
+    def _slow(self, seconds, best):
+        return best is not None and seconds > max(best * self.slow_factor, best + 1.0)
+
+    def report(self, stats, started, finished):
+        """
+        Adjust the size for a job which ran from ``started`` to ``finished``.
+        """
+        trouble = stats.get('retries', 0) > 0
+        if stats.get('connects'):
+            connect_time = stats['connect_time'] / stats['connects']
+            trouble = trouble or self._slow(connect_time, self._best_connect)
+            if self._best_connect is None or connect_time < self._best_connect:
+                self._best_connect = connect_time
+        duration = finished - started
+        slow = self._slow(duration, self._best_duration)
+        if self._best_duration is None or duration < self._best_duration:
+            self._best_duration = duration
+        if trouble:
+            if started >= self._last_cut:
+                self.size = max(1, self.size // 2)
+                self._last_cut = finished
+                self._slow_start = False
+                self._credit = 0
+        elif not slow:
+            if self._slow_start:
+                self.size += 1
+            else:
+                self._credit += 1
+                if self._credit >= self.size:
+                    self._credit = 0
+                    self.size += 1
+        self.size = min(self.size, self.maximum)
+
+
 class JobQueue(object):
     """
     The goal of this class is to make a queue of processes to run, and go
@@ -32,34 +182,46 @@ class JobQueue(object):
         ____________________[~~~~~]
         ___________________________
                                 End
+
+    The order in which jobs are started is up to the ``schedule`` policy,
+    which defaults to a `FIFOSchedule`. Instead of a number, ``max_running``
+    may be an `AdaptivePoolSize`, in which case the bubble size varies.
+
+    Given a ``batch_size``, jobs are started in batches of that many, each
+    starting once the one before it has finished entirely, and the bubble
+    moves along within each batch.
     """
-    def __init__(self, max_running, comms_queue):
+    def __init__(self, max_running, comms_queue, schedule=None, batch_size=None):
         """
         Setup the class to resonable defaults.
         """
-        self._queued = []
+        self._queued = deque()
+        self._lazy = iter(())
+        self._schedule = schedule or FIFOSchedule()
+        self._started_at = {}
+        self._stats = {}
         self._running = []
         self._completed = []
         self._num_of_jobs = 0
-        self._max = max_running
+        if hasattr(max_running, 'report'):
+            self._pool = max_running
+            self._max = max_running.size
+        else:
+            self._pool = None
+            self._max = max_running
         self._comms_queue = comms_queue
         self._finished = False
         self._closed = False
+        self._cancelled = False
+        self._batch_size = batch_size
+        self._batch_started = 0
         self._debug = False
 
-    def _all_alive(self):
-        """
-        Simply states if all procs are alive or not. Needed to determine when
-        to stop looping, and pop dead procs off and add live ones.
-        """
-        if self._running:
-            return all([x.is_alive() for x in self._running])
-        else:
-            return False
-
     def __len__(self):
         """
         Just going to use number of jobs as the JobQueue length.
+
+        Jobs given to `extend` are only counted once they've been taken.
         """
         return self._num_of_jobs
 
@@ -73,6 +235,24 @@ class JobQueue(object):
 
         self._closed = True
 
+    def cancel(self, terminate=False):
+        """
+        Stop starting jobs, leaving any not yet started alone.
+
+        Jobs already running are left to finish, unless ``terminate`` is true,
+        in which case those which can be (i.e. have a ``terminate`` method, as
+        Processes do) are terminated. Either way, `iter_results` goes on to
+        report them as they finish.
+        """
+        if self._debug:
+            print("job queue cancelled.")
+
+        self._cancelled = True
+        if terminate:
+            for job in self._running:
+                if hasattr(job, 'terminate'):
+                    job.terminate()
+
     def append(self, process):
         """
         Add the Process to the queue, so that later it can be checked up on.
@@ -96,36 +276,93 @@ class JobQueue(object):
         start them, add them to _running, and then go into the main running
         loop.
 
-        This loop will check for done procs, if found, move them out of
-        _running into _completed. It also checks for a _running queue with open
-        spots, which it will then fill as discovered.
+        This loop blocks until a running job finishes or sends back results,
+        moves any finished procs out of _running into _completed, and then
+        refills the _running queue's open spots straight away.
 
         To end the loop, there have to be no running procs, and no more procs
         to be run in the queue.
 
-        This function returns an iterable of all its children's exit codes.
+        This function returns a dict mapping each job's name to its exit code
+        and results, as described in `iter_results`.
+        """
+        # Prep return value, so that jobs which never report back still show
+        results = {}
+        for job in self._queued:
+            results[job.name] = dict.fromkeys(('exit_code', 'results'))
+        results.update(self.iter_results())
+        return results
+
+    def extend(self, jobs):
+        """
+        Add an iterable of Processes to the queue, if the JobQueue is open.
+
+        Unlike `append`, ``jobs`` is only consumed as the queue gets around to
+        starting each job, so it may be a generator creating them on demand.
+        Such jobs are started after any appended ones.
+        """
+        if not self._closed:
+            self._lazy = chain(self._lazy, jobs)
+
+    def _waiting(self):
+        """
+        Iterate over the jobs waiting to be started, in the order they were
+        queued, taking them from the jobs given to `extend` as needed.
+        """
+        while self._queued:
+            yield self._queued.popleft()
+        for job in self._lazy:
+            self._num_of_jobs += 1
+            if self._debug:
+                print("job queue took %s." % job.name)
+            yield job
+
+    def iter_results(self):
+        """
+        Run the queue like `run`, but yield each job's outcome as it finishes.
+
+        Yields ``(name, {'exit_code': ..., 'results': ...})`` tuples in order
+        of completion, where ``results`` is whatever the job put on the comms
+        queue, else the job's own ``results`` attribute (if any), else
+        ``None``. Only the results of running jobs are held on to.
+
+        Failed jobs (with a non-zero exit code) are yielded before any more
+        jobs are started, so that the caller can `cancel` the rest in time.
+        If the generator is closed before the queue is done, no further jobs
+        are started, and those still running are waited for.
         """
         def _advance_the_queue():
             """
-            Helper function to do the job of poping a new proc off the queue
-            start it, then add it to the running queue. This will eventually
-            depleate the _queue, which is a condition of stopping the running
-            while loop.
+            Helper function to do the job of getting the next proc to run from
+            the schedule, start it, then add it to the running queue. This will
+            eventually depleate the _queue, which is a condition of stopping
+            the running while loop. Returns False if there's nothing to start,
+            for now (i.e. until this batch is done) or at all.
 
             It also sets the env.host_string from the job.name, so that fabric
             knows that this is the host to be making connections on.
             """
-            job = self._queued.pop()
+            if self._cancelled:
+                return False
+            if self._batch_started == self._batch_size:
+                if self._running:
+                    # Next batch waits until this one is done
+                    return False
+                self._batch_started = 0
+            job = self._schedule.next_job(waiting)
+            if job is None:
+                return False
+            if self._debug and self._batch_size and not self._batch_started:
+                print("Job queue starting a new batch.")
+            self._batch_started += 1
             if self._debug:
                 print("Popping '%s' off the queue and starting it" % job.name)
             with settings(clean_revert=True, host_string=job.name, host=job.name):
                 job.start()
+            self._started_at[id(job)] = time.time()
+            self._schedule.started(job)
             self._running.append(job)
-
-        # Prep return value so we can start filling it during main loop
-        results = {}
-        for job in self._queued:
-            results[job.name] = dict.fromkeys(('exit_code', 'results'))
+            return True
 
         if not self._closed:
             raise Exception("Need to close() before starting.")
@@ -133,67 +370,138 @@ class JobQueue(object):
         if self._debug:
             print("Job queue starting.")
 
-        while len(self._running) < self._max:
-            _advance_the_queue()
-
-        # Main loop!
-        while not self._finished:
-            while len(self._running) < self._max and self._queued:
-                _advance_the_queue()
-
-            if not self._all_alive():
-                for id, job in enumerate(self._running):
-                    if not job.is_alive():
-                        if self._debug:
-                            print("Job queue found finished proc: %s." % job.name)
-                        done = self._running.pop(id)
-                        # might be a Process or a Thread
-                        if hasattr(done, 'exitcode'):
-                            proc = done
-                            done = DoneProc(proc.name, proc.exitcode)
-                            # multiprocessing.Process.close() added in Python-3.7
-                            if hasattr(proc, 'close'):
-                                proc.close()
-                            del proc
-                        self._completed.append(done)
-
-                if self._debug:
-                    print("Job queue has %d running." % len(self._running))
-
-            if not (self._queued or self._running):
-                if self._debug:
-                    print("Job queue finished.")
-
-                self._finished = True
-
-            # Each loop pass, try pulling results off the queue to keep its
-            # size down. At this point, we don't actually care if any results
-            # have arrived yet; they will be picked up after the main loop.
-            self._fill_results(results)
-
-            time.sleep(ssh.io_sleep)
-
-        # Consume anything left in the results queue. Note that there is no
-        # need to block here, as the main loop ensures that all workers will
-        # already have finished.
-        self._fill_results(results)
-
-        # Attach exit codes now that we're all done & have joined all jobs
-        for job in self._completed:
-            if hasattr(job, 'exitcode'):
-                results[job.name]['exit_code'] = job.exitcode
+        waiting = self._waiting()
+        pending = {}
+        try:
+            while len(self._running) < self._max and _advance_the_queue():
+                pass
+
+            # Main loop!
+            while self._running:
+                done = self._done_jobs(self._wait())
+                # Finished jobs have sent their results (if any) by now
+                self._fill_results(pending)
+                finished = [(job, self._reap(job)) for job in done]
+
+                # Refill the running queue before handing anything back,
+                # unless that's a failure the caller may want to act on
+                if not any(getattr(reaped, 'exitcode', None) for _, reaped in finished):
+                    while len(self._running) < self._max and _advance_the_queue():
+                        pass
+
+                for job, reaped in finished:
+                    yield job.name, {
+                        'exit_code': getattr(reaped, 'exitcode', None),
+                        # Jobs may also hand back their own results
+                        'results': pending.pop(job.name, getattr(job, 'results', None)),
+                    }
+
+                while len(self._running) < self._max and _advance_the_queue():
+                    pass
 
-        return results
+            if self._debug:
+                print("Job queue finished.")
+
+            self._finished = True
+        finally:
+            if not self._finished:
+                # Stopped early, don't start anything new
+                self.cancel()
+                while self._running:
+                    done = self._done_jobs(self._wait())
+                    self._fill_results(pending)
+                    for job in done:
+                        self._reap(job)
+
+    def _done_jobs(self, ready):
+        """
+        Return the running jobs which have finished, given `_wait`'s result.
+        """
+        done = []
+        for job in self._running:
+            sentinel = getattr(job, 'sentinel', None)
+            if sentinel is not None:
+                if sentinel in ready:
+                    done.append(job)
+            elif not job.is_alive():
+                done.append(job)
+        return done
+
+    def _reap(self, job):
+        """
+        Join a finished job and move it from _running into _completed.
+
+        Returns the job, or for Process-like jobs a lightweight ``DoneProc``
+        standing in for it.
+        """
+        if self._debug:
+            print("Job queue found finished proc: %s." % job.name)
+        job.join()
+        self._running.remove(job)
+        started, finished = self._started_at.pop(id(job)), time.time()
+        self._schedule.finished(job, finished - started)
+        stats = self._stats.pop(job.name, None) or getattr(job, 'stats', None) or {}
+        if self._pool is not None:
+            self._pool.report(stats, started, finished)
+            if self._debug and self._pool.size != self._max:
+                print("Job queue now running up to %d at once." % self._pool.size)
+            self._max = self._pool.size
+        # might be a Process or a Thread
+        if hasattr(job, 'exitcode'):
+            proc = job
+            job = DoneProc(proc.name, proc.exitcode)
+            # multiprocessing.Process.close() added in Python-3.7
+            if hasattr(proc, 'close'):
+                proc.close()
+            del proc
+        self._completed.append(job)
+
+        if self._debug:
+            print("Job queue has %d running." % len(self._running))
+        return job
+
+    def _wait(self):
+        """
+        Block until a running job has finished, or results have arrived.
+
+        Waits on the running jobs' sentinels plus the reading end of the
+        results queue (when it has one, as ``multiprocessing.Queue`` does).
+        Jobs without a sentinel, such as plain ``threading.Thread`` objects,
+        can only be polled, so then we wake up every ``ssh.io_sleep`` seconds.
+
+        Returns the list of ready objects, as given by
+        ``multiprocessing.connection.wait``.
+        """
+        waitables = []
+        poll = False
+        for job in self._running:
+            sentinel = getattr(job, 'sentinel', None)
+            if sentinel is None:
+                poll = True
+            else:
+                waitables.append(sentinel)
+        reader = getattr(self._comms_queue, '_reader', None)
+        if reader is not None:
+            waitables.append(reader)
+        if not waitables:
+            if poll:
+                time.sleep(ssh.io_sleep)
+            return []
+        return wait(waitables, timeout=ssh.io_sleep if poll else None)
 
     def _fill_results(self, results):
         """
-        Attempt to pull data off self._comms_queue and add to 'results' dict.
-        If no data is available (i.e. the queue is empty), bail immediately.
+        Attempt to pull data off self._comms_queue and add to 'results' dict,
+        keyed by job name (or to self._stats, for connection stats). If no data
+        is available (i.e. the queue is empty), bail immediately.
         """
         while True:
             try:
                 datum = self._comms_queue.get_nowait()
-                results[datum['name']]['results'] = datum['result']
+                if 'stats' in datum:
+                    self._stats[datum['name']] = datum['stats']
+                else:
+                    results[datum['name']] = datum['result']
             except Queue.Empty:
                 break
 
@@ -24,9 +24,10 @@ from fabric.contrib import console, files, project
 
 from fabric.network import disconnect_all, ssh
 from fabric.state import env_options
-from fabric.tasks import Task, execute, get_task_details
+from fabric.tasks import Task, execute, get_task_details, _execute_pipeline
 from fabric.task_utils import _Dict, crawl
 from fabric.utils import abort, indent, warn, _pty_size
+from fabric.workers import stop_workers
 
 # One-time calculation of "all internal callables" to avoid doing this on every
 # check of a given fabfile callable (in is_classic_task()).
@@ -759,14 +760,17 @@ Remember that -f can be used to specify fabfile path, and use -h for help.""")
             print("Commands to run: %s" % names)
 
         # At this point all commands must exist, so execute them in order.
-        for name, args, kwargs, arg_hosts, arg_roles, arg_exclude_hosts in commands_to_run:
-            execute(
-                name,
-                hosts=arg_hosts,
-                roles=arg_roles,
-                exclude_hosts=arg_exclude_hosts,
-                *args, **kwargs
-            )
+        if state.env.pipeline:
+            _execute_pipeline(commands_to_run)
+        else:
+            for name, args, kwargs, arg_hosts, arg_roles, arg_exclude_hosts in commands_to_run:
+                execute(
+                    name,
+                    hosts=arg_hosts,
+                    roles=arg_roles,
+                    exclude_hosts=arg_exclude_hosts,
+                    *args, **kwargs
+                )
         # If we got here, no errors occurred, so print a final note.
         if state.output.status:
             print("\nDone.")
@@ -780,5 +784,10 @@ Remember that -f can be used to specify fabfile path, and use -h for help.""")
         # we might leave stale threads if we don't explicitly exit()
         sys.exit(1)
     finally:
+        stop_workers()
         disconnect_all()
+        stats = state.connections.stats
+        if state.output.status and any(stats.values()):
+            print("Connection cache: %(hits)d hits, %(misses)d misses, "
+                  "%(evictions)d evictions, %(dead)d dead" % stats)
     sys.exit(0)
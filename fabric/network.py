@@ -2,19 +2,28 @@
 Classes and subroutines dealing with network connections and related topics.
 """
 
+import base64
+import errno
 from functools import wraps
 import getpass
 import os
+import queue
+import random
 import re
+import selectors
 import time
 import socket
 import sys
+import threading
+import weakref
 from io import StringIO
 
 import paramiko as ssh
 
 from fabric.auth import get_password, set_password
-from fabric.utils import handle_prompt_abort, warn
+from fabric.utils import (
+    handle_prompt_abort, warn, _ThreadLocalDict, _thread_shadows, _set_thread_shadows,
+)
 from fabric.exceptions import NetworkError
 
 
@@ -37,9 +46,215 @@ def is_key_load_error(e):
     )
 
 
-def _tried_enough(tries):
+# Per-thread connection statistics, reported back by parallel jobs
+_connect_stats = threading.local()
+
+
+def connect_stats(reset=False):
+    """
+    Return this thread's connection statistics, optionally starting afresh.
+
+    A dict counting ``connects`` made, ``connect_time`` (seconds) spent making
+    them, and ``retries`` due to protocol banner read failures and timeouts.
+    """
+    if reset or not hasattr(_connect_stats, 'counts'):
+        _connect_stats.counts = {'connects': 0, 'connect_time': 0.0, 'retries': 0}
+    return _connect_stats.counts
+
+
+# Parsed known_hosts files, as (signature, HostKeys), where the signature is a
+# tuple of (path, mtime, size) for each file; see known_host_keys()
+_known_hosts = (None, None)
+_known_hosts_lock = threading.Lock()
+
+# Host keys accepted via AutoAddPolicy, by any connection in this process
+_learned_host_keys = ssh.HostKeys()
+
+
+def _known_hosts_signature(path, required):
+    try:
+        st = os.stat(path)
+    except OSError:
+        if required:
+            raise
+        return None
+    return (path, st.st_mtime, st.st_size)
+
+
+def known_host_keys():
+    """
+    Return the host keys from the known_hosts files Fabric is set to use.
+
+    That's :ref:`env.system_known_hosts <system-known-hosts>`, if set, and
+    ``~/.ssh/known_hosts``, unless :ref:`env.disable_known_hosts
+    <disable-known-hosts>` is set. The files are only parsed again once
+    they've changed, and the result is shared by all connections, including
+    those made by parallel jobs started afterwards. Raises ``IOError`` if
+    ``env.system_known_hosts`` can't be read.
+    """
+    global _known_hosts
+    from fabric.state import env
+    files = []
+    if env.get('system_known_hosts'):
+        files.append(_known_hosts_signature(env.system_known_hosts, True))
+    if not env.disable_known_hosts:
+        files.append(_known_hosts_signature(os.path.expanduser('~/.ssh/known_hosts'), False))
+    signature = tuple(f for f in files if f is not None)
+    with _known_hosts_lock:
+        if _known_hosts[0] != signature:
+            host_keys = ssh.HostKeys()
+            for path, mtime, size in signature:
+                host_keys.load(path)
+            _known_hosts = (signature, host_keys)
+        return _known_hosts[1]
+
+
+# Private keys loaded from env.key so far, by the key's text
+_loaded_keys = {}
+
+# How each (user, host, port) last authenticated: the public half of the key
+# used (as bytes), or 'password'
+_auth_methods = {}
+
+
+class _SSHClient(ssh.SSHClient):
+    """
+    ``SSHClient`` which can open sessions ahead of time; see `open_session`.
+    """
+    def __init__(self):
+        super(_SSHClient, self).__init__()
+        # Sessions opened ahead of time, and how many are still being opened
+        self._ready_sessions = []
+        self._opening_sessions = 0
+        self._sessions_lock = threading.Lock()
+
+    def open_session(self, timeout=None):
+        """
+        Return a new session channel.
+
+        Takes one of those opened ahead of time if there are any, then (with
+        :ref:`env.preopen_channels <preopen-channels>` set) starts opening
+        more in the background to replace it, so that the next call needn't
+        wait for the server to confirm a new one.
+        """
+        from fabric.state import env
+        transport = self.get_transport()
+        chan = None
+        with self._sessions_lock:
+            while self._ready_sessions and chan is None:
+                chan = self._ready_sessions.pop(0)
+                if chan.closed or not chan.active:
+                    # Closed by the server in the meantime
+                    chan = None
+        if chan is None:
+            chan = transport.open_session(timeout=timeout)
+        with self._sessions_lock:
+            wanted = env.preopen_channels - len(self._ready_sessions) - self._opening_sessions
+            self._opening_sessions += max(wanted, 0)
+        for i in range(wanted):
+            thread = threading.Thread(target=self._open_ahead, args=(transport, timeout),
+                                      name="preopen-channel")
+            thread.daemon = True
+            thread.start()
+        return chan
+
+    def _open_ahead(self, transport, timeout):
+        try:
+            chan = transport.open_session(timeout=timeout)
+        except Exception:
+            # Whoever needs it next will find out what's wrong
+            chan = None
+        with self._sessions_lock:
+            self._opening_sessions -= 1
+            if chan is not None:
+                self._ready_sessions.append(chan)
+
+def _public_key(filename):
+    """
+    Return the public half of private key file ``filename``, as bytes, from
+    the ``.pub`` file next to it; or None if there's no such (valid) file.
+    """
+    try:
+        with open(filename + '.pub') as f:
+            return base64.b64decode(f.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+def _remembered_auth(user, host, port, password):
+    """
+    Return connect() kwargs to try how ``user@host:port`` last authenticated
+    first, along with the agent connection (if any) to close once connected;
+    or None if there's nothing (usable) to remember.
+
+    Nothing is remembered ahead of an explicit ``env.key``, which is always
+    tried first.
+    """
+    from fabric.state import env
+    method = _auth_methods.get((user, host, port))
+    if method is None or env.get('key'):
+        return None
+    if method == 'password':
+        if password is None:
+            return None
+        # Skip straight to it, rather than using up auth attempts on keys
+        return dict(key_filename=[], allow_agent=False, look_for_keys=False), None
+    # Other keys, if any, are still tried if this one fails
+    filenames = key_filenames()
+    for filename in filenames:
+        if _public_key(filename) == method:
+            others = [other for other in filenames if other != filename]
+            return dict(key_filename=[filename] + others), None
+    if not env.no_agent:
+        # Agent keys only work while their agent connection is open
+        agent = ssh.Agent()
+        for key in agent.get_keys():
+            if key.asbytes() == method:
+                return dict(pkey=key), agent
+        agent.close()
+    return None
+
+
+def _remember_auth(client, user, host, port):
+    # Paramiko has no public API saying which key authenticated, so this goes
+    # by its auth handler where it has one; if not, nothing is remembered.
+    handler = getattr(client.get_transport(), 'auth_handler', None)
+    method = getattr(handler, 'auth_method', None)
+    if method == 'publickey':
+        key = getattr(handler, 'private_key', None)
+        if key is not None:
+            _auth_methods[(user, host, port)] = key.asbytes()
+    elif method == 'password':
+        _auth_methods[(user, host, port)] = 'password'
+
+
+def _tried_enough(tries, started=None):
     from fabric.state import env
-    return tries >= env.connection_attempts
+    if tries >= env.connection_attempts:
+        return True
+    # Or out of time for more attempts
+    return bool(env.retry_budget and started is not None
+                and time.time() - started >= env.retry_budget)
+
+
+def _retry_wait(tries, started, default):
+    """
+    Wait before retrying a connection, after attempt number ``tries``.
+
+    With ``env.retry_backoff`` set, waits a random time between zero and that
+    many seconds, doubled for each attempt so far, up to
+    ``env.retry_backoff_max``. The randomness keeps many hosts which failed
+    together from all retrying together. Otherwise waits ``default`` seconds.
+    Never waits past ``env.retry_budget``.
+    """
+    from fabric.state import env
+    delay = default
+    if env.retry_backoff:
+        delay = random.uniform(0, min(env.retry_backoff_max, env.retry_backoff * 2 ** (tries - 1)))
+    if env.retry_budget:
+        delay = min(delay, started + env.retry_budget - time.time())
+    if delay > 0:
+        time.sleep(delay)
 
 
 def get_gateway(host, port, cache, replace=False):
@@ -80,18 +295,66 @@ def get_gateway(host, port, cache, replace=False):
         if replace or gateway not in cache:
             if output.debug:
                 print("Creating new gateway connection to %r" % gateway)
+            if isinstance(cache, HostConnectionCache):
+                # Other connections depend on it, so it mustn't be evicted
+                cache._gateways.add(gateway)
             cache[gateway] = connect(*normalize(gateway) + (cache, False))
         # now we should have an open gw connection and can ask it for a
         # direct-tcpip channel to the real target. (bypass cache's own
         # __getitem__ override to avoid hilarity - this is usually called
         # within that method.)
-        sock = direct_tcpip(dict.__getitem__(cache, gateway), host, port)
+        sock = direct_tcpip(_ThreadLocalDict.__getitem__(cache, gateway), host, port)
     elif proxy_command:
         sock = ssh.ProxyCommand(proxy_command)
     return sock
 
 
-class HostConnectionCache(dict):
+# When each transport was last known to be working
+_last_active = weakref.WeakKeyDictionary()
+
+
+def _mark_active(client):
+    transport = client.get_transport() if client is not None else None
+    if transport is not None:
+        _last_active[transport] = time.time()
+
+
+def _usable(client):
+    """
+    Whether cached ``client`` still seems to be connected.
+
+    Transports which haven't been used for :ref:`env.connection_check
+    <connection-check>` seconds have to answer a keepalive request within
+    ``env.connection_check_timeout`` seconds to count, since one whose TCP
+    connection was silently dropped (e.g. by a NAT timeout) still looks active.
+    """
+    from fabric.state import env
+    if client is None:
+        return True
+    transport = client.get_transport()
+    if transport is None or not transport.is_active():
+        return False
+    last_active = _last_active.get(transport)
+    if not env.connection_check or (
+            last_active is not None and time.time() - last_active < env.connection_check):
+        return True
+    # Any reply will do, even a refusal
+    replied = threading.Event()
+
+    def keepalive():
+        transport.global_request('keepalive@openssh.com', wait=True)
+        replied.set()
+    thread = threading.Thread(target=keepalive, name="keepalive")
+    # Left waiting until the transport is closed, if no reply comes
+    thread.daemon = True
+    thread.start()
+    return replied.wait(env.connection_check_timeout) and transport.is_active()
+
+
+_missing = object()
+
+
+class HostConnectionCache(_ThreadLocalDict):
     """
     Dict subclass allowing for caching of host connections/clients.
 
@@ -124,10 +387,33 @@ class HostConnectionCache(dict):
     The same applies to ports: specifying two different ports will result in
     two different connections to the same host being made. If no port is given,
     22 is assumed, so ``example.com`` is equivalent to ``example.com:22``.
+
+    Connections are kept open until `disconnect_all` unless
+    :ref:`env.connection_cache_size <connection-cache-size>` or
+    :ref:`env.connection_idle_timeout <connection-idle-timeout>` are set, in
+    which case the least recently used are closed to stay within them (and
+    reopened if needed again). Gateway connections are always kept.
+
+    Connections found to be dead when looked up are replaced with new ones;
+    see :ref:`env.connection_check <connection-check>`.
+
+    ``stats`` counts ``hits`` (lookups finding a working connection),
+    ``misses`` (lookups which had to connect), ``evictions`` and ``dead``
+    (connections which had to be replaced).
     """
+    def __init__(self, *args, **kwargs):
+        super(HostConnectionCache, self).__init__(*args, **kwargs)
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'dead': 0}
+        # When each connection was last used, least recently used first
+        self._last_used = {}
+        self._gateways = set()
+        # Guards the above and evictions, as several threads may connect at
+        # once (e.g. with --preconnect)
+        self._lock = threading.RLock()
+
     def connect(self, key):
         """
-        Force a new connection to ``key`` host string.
+        Force a new connection to ``key`` host string, and return it.
         """
         from fabric.state import env
 
@@ -137,37 +423,116 @@ class HostConnectionCache(dict):
         # break the loop when the host is gateway itself
         if env.gateway:
             seek_gateway = normalize_to_string(env.gateway) != key
-        self[key] = connect(
-            user, host, port, cache=self, seek_gateway=seek_gateway)
+        client = connect(user, host, port, cache=self, seek_gateway=seek_gateway)
+        self[key] = client
+        return client
 
     def __getitem__(self, key):
         """
         Autoconnect + return connection object
         """
         key = normalize_to_string(key)
-        if key not in self:
-            self.connect(key)
-        return dict.__getitem__(self, key)
+        # Looked up just once, as other threads may evict it at any time
+        client = self._lookup(key)
+        if client is not _missing and not _usable(client):
+            from fabric.state import output
+            if output.debug:
+                print("Connection to %s is dead, reconnecting" % denormalize(key))
+            client.close()
+            with self._lock:
+                if self._lookup(key) is client:
+                    del self[key]
+            self.stats['dead'] += 1
+            client = _missing
+        if client is _missing:
+            self.stats['misses'] += 1
+            client = self.connect(key)
+        else:
+            self.stats['hits'] += 1
+            self._used(key)
+        _mark_active(client)
+        return client
+
+    def _lookup(self, key):
+        try:
+            return super(HostConnectionCache, self).__getitem__(key)
+        except KeyError:
+            return _missing
+
+    def _used(self, key):
+        """
+        Note ``key`` was just used, closing others as needed to stay in limits.
+        """
+        from fabric.state import env
+        if self._storage() is not self:
+            # A threads backend job's own cache, which only lasts for one host
+            return
+        from fabric.state import output
+        now = time.time()
+        size = env.connection_cache_size
+        idle = env.connection_idle_timeout
+        evicted = []
+        with self._lock:
+            self._last_used.pop(key, None)
+            self._last_used[key] = now
+            if not (size or idle):
+                return
+            for other in list(self._last_used):
+                if other not in self:
+                    # Removed without our noticing, e.g. by clear()
+                    del self._last_used[other]
+                    continue
+                over = size and len(self) > size
+                stale = idle and now - self._last_used[other] > idle
+                if not (over or stale) or other == key:
+                    break
+                if other not in self._gateways:
+                    evicted.append((other, self._evict(other)))
+        # Closing can take a while, so leave other threads to get on meanwhile
+        for other, client in evicted:
+            if output.debug:
+                print("Closing least recently used connection to %s" % denormalize(other))
+            client.close()
+
+    def _evict(self, key):
+        """
+        Remove ``key``'s connection, returning it for the caller to close.
+        """
+        with self._lock:
+            client = super(HostConnectionCache, self).__getitem__(key)
+            del self[key]
+            self.stats['evictions'] += 1
+        return client
 
     #
     # Dict overrides that normalize input keys
     #
 
     def __setitem__(self, key, value):
-        return dict.__setitem__(self, normalize_to_string(key), value)
+        key = normalize_to_string(key)
+        super(HostConnectionCache, self).__setitem__(key, value)
+        _mark_active(value)
+        self._used(key)
 
     def __delitem__(self, key):
-        return dict.__delitem__(self, normalize_to_string(key))
+        key = normalize_to_string(key)
+        if self._storage() is not self:
+            return super(HostConnectionCache, self).__delitem__(key)
+        with self._lock:
+            self._last_used.pop(key, None)
+            return super(HostConnectionCache, self).__delitem__(key)
 
     def __contains__(self, key):
-        return dict.__contains__(self, normalize_to_string(key))
+        return super(HostConnectionCache, self).__contains__(normalize_to_string(key))
 
 
 def ssh_config(host_string=None):
     """
     Return ssh configuration dict for current env.host_string host value.
 
-    Memoizes the loaded SSH config file, but not the specific per-host results.
+    Memoizes the loaded SSH config file, and the results for each host string,
+    until env.ssh_config_path changes. Results are shared, so must not be
+    modified.
 
     This function performs the necessary "is SSH config enabled?" checks and
     will simply return an empty dict if not. If SSH config *is* enabled and the
@@ -179,18 +544,24 @@ def ssh_config(host_string=None):
     dummy = {}
     if not env.use_ssh_config:
         return dummy
-    if '_ssh_config' not in env:
+    path = os.path.expanduser(env.ssh_config_path)
+    if '_ssh_config' not in env or env.get('_ssh_config_path') != path:
         try:
             conf = ssh.SSHConfig()
-            path = os.path.expanduser(env.ssh_config_path)
             with open(path) as fd:
                 conf.parse(fd)
-                env._ssh_config = conf
         except IOError:
             warn("Unable to load SSH config file '%s'" % path)
             return dummy
-    host = parse_host_string(host_string or env.host_string)['host']
-    return env._ssh_config.lookup(host)
+        env._ssh_config = conf
+        env._ssh_config_path = path
+        env._ssh_config_hosts = {}
+    host_string = host_string or env.host_string
+    hosts = env._ssh_config_hosts
+    if host_string not in hosts:
+        host = parse_host_string(host_string)['host']
+        hosts[host_string] = env._ssh_config.lookup(host)
+    return hosts[host_string]
 
 
 def key_filenames():
@@ -219,10 +590,15 @@ def key_filenames():
 def key_from_env(passphrase=None):
     """
     Returns a paramiko-ready key from a text string of a private key
+
+    Keys are only parsed once; later calls return the same key object.
     """
     from fabric.state import env, output
 
     if 'key' in env:
+        if env.key in _loaded_keys:
+            return _loaded_keys[env.key]
+
         if output.debug:
             sys.stderr.write("Trying to honor in-memory env.key %.66r...\n" % env.key)
 
@@ -233,7 +609,9 @@ def key_from_env(passphrase=None):
             if output.debug:
                 sys.stderr.write("Trying to load it as %s\n" % pkey_class)
             try:
-                return pkey_class.from_private_key(StringIO(env.key), passphrase)
+                key = pkey_class.from_private_key(StringIO(env.key), passphrase)
+                _loaded_keys[env.key] = key
+                return key
             except Exception as e:
                 # File is valid key, but is encrypted: raise it, this will
                 # cause cxn loop to prompt for passphrase & retry
@@ -416,16 +794,16 @@ def connect(user, host, port, cache, seek_gateway=True):
     #
 
     # Init client
-    client = ssh.SSHClient()
-
-    # Load system hosts file (e.g. /etc/ssh/ssh_known_hosts)
-    known_hosts = env.get('system_known_hosts')
-    if known_hosts:
-        client.load_system_host_keys(known_hosts)
-
-    # Load known host keys (e.g. ~/.ssh/known_hosts) unless user says not to.
+    client = _SSHClient()
+
+    # Use the system hosts file (e.g. /etc/ssh/ssh_known_hosts) and known host
+    # keys (e.g. ~/.ssh/known_hosts) unless user says not to. These are parsed
+    # once and shared: the client only ever reads its "system" host keys.
+    client._system_host_keys = known_host_keys()
+    # Along with keys accepted by earlier connections, which AutoAddPolicy
+    # adds to. (No filename is set, so they're never saved.)
     if not env.disable_known_hosts:
-        client.load_system_host_keys()
+        client._host_keys = _learned_host_keys
     # Unless user specified not to, accept/add new, unknown host keys
     if not env.reject_unknown_hosts:
         client.set_missing_host_key_policy(ssh.AutoAddPolicy())
@@ -439,6 +817,9 @@ def connect(user, host, port, cache, seek_gateway=True):
     password = get_password(user, host, port, login_only=True)
     tries = 0
     sock = None
+    stats = connect_stats()
+    started = time.time()
+    remembered, agent = _remembered_auth(user, host, int(port), password) or (None, None)
 
     # Loop until successful connect (keep prompting for new password)
     while not connected:
@@ -472,14 +853,29 @@ def connect(user, host, port, cache, seek_gateway=True):
                 val = env.get(name, None)
                 if val is not None:
                     kwargs[name] = val
+            # Try whatever worked last time first
+            if remembered:
+                kwargs.update(remembered)
 
             # Ready to connect
             client.connect(**kwargs)
             connected = True
+            if agent is not None:
+                agent.close()
+            stats['connects'] += 1
+            stats['connect_time'] += time.time() - started
+            _remember_auth(client, user, host, int(port))
+
+            # Don't let Nagle's algorithm hold back each small message, e.g.
+            # opening the next command's channel, until the server has
+            # acknowledged the one before
+            transport = client.get_transport()
+            if isinstance(transport.sock, socket.socket):
+                transport.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
             # set a keepalive if desired
             if env.keepalive:
-                client.get_transport().set_keepalive(env.keepalive)
+                transport.set_keepalive(env.keepalive)
 
             return client
         # BadHostKeyException corresponds to key mismatch, i.e. what on the
@@ -497,6 +893,17 @@ def connect(user, host, port, cache, seek_gateway=True):
             ssh.SSHException
         ) as e:
             msg = str(e)
+            # What worked last time doesn't any more: try everything again
+            # before resorting to prompting
+            if remembered and isinstance(e, ssh.AuthenticationException):
+                _auth_methods.pop((user, host, int(port)), None)
+                remembered = None
+                if agent is not None:
+                    agent.close()
+                    agent = None
+                tries -= 1
+                continue
+
             # If we get SSHExceptionError and the exception message indicates
             # SSH protocol banner read failures, assume it's caused by the
             # server load and try again.
@@ -505,8 +912,10 @@ def connect(user, host, port, cache, seek_gateway=True):
             # connection to the downstream host fails. We should retry.
             if (e.__class__ is ssh.SSHException and msg.startswith('Error reading SSH protocol banner')) \
                or e.__class__ is ssh.ChannelException:
-                if _tried_enough(tries):
+                if _tried_enough(tries, started):
                     raise NetworkError(msg, e)
+                stats['retries'] += 1
+                _retry_wait(tries, started, 0)
                 continue
 
             # For whatever reason, empty password + no ssh key or agent
@@ -580,7 +989,7 @@ def connect(user, host, port, cache, seek_gateway=True):
         # NOTE: In 2.6, socket.error subclasses IOError
         except socket.error as e:
             not_timeout = type(e) is not socket.timeout
-            giving_up = _tried_enough(tries)
+            giving_up = _tried_enough(tries, started)
             # Baseline error msg for when debug is off
             msg = "Timed out trying to connect to %s" % host
             # Expanded for debug on
@@ -593,10 +1002,10 @@ def connect(user, host, port, cache, seek_gateway=True):
                 sys.stderr.write(err + '\n')
             # Having said our piece, try again
             if not giving_up:
+                stats['retries'] += 1
                 # Sleep if it wasn't a timeout, so we still get timeout-like
-                # behavior
-                if not_timeout:
-                    time.sleep(env.timeout)
+                # behavior (unless backing off)
+                _retry_wait(tries, started, env.timeout if not_timeout else 0)
                 continue
             # Override eror msg if we were retrying other errors
             if not_timeout:
@@ -605,8 +1014,8 @@ def connect(user, host, port, cache, seek_gateway=True):
                 )
             # Here, all attempts failed. Tweak error msg to show # tries.
             # TODO: find good humanization module, jeez
-            s = "s" if env.connection_attempts > 1 else ""
-            msg += " (tried %s time%s)" % (env.connection_attempts, s)
+            s = "s" if tries > 1 else ""
+            msg += " (tried %s time%s)" % (tries, s)
             raise NetworkError(msg, e)
         # Ensure that if we terminated without connecting and we were given an
         # explicit socket, close it out.
@@ -685,12 +1094,288 @@ def needs_host(func):
     return host_prompting_wrapper
 
 
+def probe_hosts(hosts, timeout=None, max_open=None):
+    """
+    Check which of ``hosts`` accept TCP connections on their SSH port.
+
+    Connects to up to ``max_open`` of them at once, each for at most
+    ``timeout`` seconds (default: :ref:`env.timeout <timeout>`), so dead hosts
+    can be spotted without waiting out a full SSH connection attempt for each.
+    Connections are closed again as soon as they're made. Host names are
+    looked up by a few threads meanwhile, counting towards ``max_open``; if
+    one has several addresses (e.g. IPv6 and IPv4), each is tried in turn
+    until one connects.
+
+    ``max_open`` defaults to :ref:`env.pool_size <pool-size>`, or 100 if that
+    isn't set, but never more than half of the open files this process is
+    allowed.
+
+    Hosts reached through a gateway, ``ProxyJump`` or ``ProxyCommand`` can't be
+    checked this way, and are assumed to be reachable.
+
+    Returns a dict mapping each host string which could not be reached to a
+    `~fabric.exceptions.NetworkError` saying why.
+    """
+    from fabric.state import env
+    if timeout is None:
+        timeout = env.timeout
+    if max_open is None:
+        max_open = _probe_window(env.pool_size)
+    unreachable = {}
+    if env.gateway:
+        return unreachable
+    selector = selectors.DefaultSelector()
+    # Name lookups block, so they're done by threads, which wake us up with a
+    # byte down this pipe when they're done (until we stop listening)
+    lookups, resolved = queue.Queue(), queue.Queue()
+    wake_r, wake_w = os.pipe()
+    wake_lock = threading.Lock()
+    listening = [True]
+    selector.register(wake_r, selectors.EVENT_READ)
+
+    def candidates():
+        for host_string in hosts:
+            conf = ssh_config(host_string)
+            if conf.get('proxyjump') or conf.get('proxycommand'):
+                continue
+            user, host, port = normalize(host_string)
+            yield host_string, host, port
+
+    def resolve():
+        while True:
+            lookup = lookups.get()
+            if lookup is None:
+                return
+            host_string, host, port = lookup
+            try:
+                addrs = socket.getaddrinfo(host, int(port), 0, socket.SOCK_STREAM)
+            except (OSError, UnicodeError) as e:
+                addrs = NetworkError('Name lookup failed for %s' % host, e)
+            resolved.put((host_string, host, port, addrs))
+            with wake_lock:
+                if listening[0]:
+                    os.write(wake_w, b'x')
+
+    def start(probe):
+        # Try the host's next address, or give up on it if there are none
+        while probe.addrs:
+            family, type_, proto, _, addr = probe.addrs.pop(0)
+            try:
+                sock = socket.socket(family, type_, proto)
+            except OSError as e:
+                probe.error = _unreachable(probe.host, probe.port, e)
+                continue
+            try:
+                sock.setblocking(False)
+                err = sock.connect_ex(addr)
+            except OSError as e:
+                err = e
+            if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                probe.deadline = time.time() + timeout
+                selector.register(sock, selectors.EVENT_WRITE, probe)
+                return
+            sock.close()
+            probe.error = _unreachable(probe.host, probe.port, err)
+        unreachable[probe.host_string] = probe.error
+
+    def finish(key, error=None):
+        selector.unregister(key.fileobj)
+        key.fileobj.close()
+        if error is not None:
+            key.data.error = error
+            start(key.data)
+
+    resolvers = [
+        threading.Thread(target=resolve, name="probe-resolver-%d" % i)
+        for i in range(min(8, max_open))
+    ]
+    for thread in resolvers:
+        thread.daemon = True
+        thread.start()
+    try:
+        waiting = candidates()
+        looking_up = 0
+        while True:
+            # Look up as many more hosts as there's room to probe (besides
+            # wake_r, the selector holds one socket per probe)
+            while looking_up + len(selector.get_map()) - 1 < max_open:
+                candidate = next(waiting, None)
+                if candidate is None:
+                    break
+                lookups.put(candidate)
+                looking_up += 1
+            while not resolved.empty():
+                host_string, host, port, addrs = resolved.get_nowait()
+                looking_up -= 1
+                if isinstance(addrs, NetworkError):
+                    unreachable[host_string] = addrs
+                else:
+                    start(_Probe(host_string, host, port, addrs))
+            probes = [key for key in selector.get_map().values() if key.data is not None]
+            if not probes and not looking_up:
+                break
+            wait = None
+            if probes:
+                wait = max(0, min(key.data.deadline for key in probes) - time.time())
+            # Writable means connected, or failed to connect
+            for key, events in selector.select(wait):
+                probe = key.data
+                if probe is None:
+                    os.read(wake_r, 4096)
+                    continue
+                err = key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                finish(key, _unreachable(probe.host, probe.port, err) if err else None)
+            now = time.time()
+            for key in list(selector.get_map().values()):
+                if key.data is not None and key.data.deadline <= now:
+                    finish(key, NetworkError("Timed out trying to connect to %s" % key.data.host,
+                                             socket.timeout('timed out')))
+    finally:
+        for thread in resolvers:
+            lookups.put(None)
+        selector.unregister(wake_r)
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+        with wake_lock:
+            listening[0] = False
+            os.close(wake_r)
+            os.close(wake_w)
+    return unreachable
+
+
+class _Probe(object):
+    """
+    One host being checked by `probe_hosts`, with the addresses left to try.
+    """
+    def __init__(self, host_string, host, port, addrs):
+        self.host_string = host_string
+        self.host = host
+        self.port = port
+        self.addrs = list(addrs)
+        self.error = None
+        self.deadline = None
+
+
+def _probe_window(pool_size):
+    """
+    Return how many connections `probe_hosts` may have open at once.
+    """
+    try:
+        window = int(pool_size)
+    except (TypeError, ValueError):
+        window = 0
+    if window < 1:
+        window = 100
+    try:
+        import resource
+    except ImportError:
+        return window
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY:
+        window = min(window, max(1, soft // 2))
+    return window
+
+
+def _unreachable(host, port, err):
+    e = err if isinstance(err, OSError) else OSError(err, os.strerror(err))
+    return NetworkError(
+        "Low level socket error connecting to host %s on port %s: %s" % (host, port, e.strerror), e)
+
+
+class _PromptNeeded(Exception):
+    pass
+
+
+def preconnect(hosts, pool_size=None):
+    """
+    Connect to all of ``hosts`` at once, ahead of running anything on them.
+
+    Connections are opened by up to ``pool_size`` threads at a time (all hosts
+    at once if not given), and go into the usual connection cache, so tasks
+    then find them already open. Hosts which are already connected are left
+    alone, as are hosts which turn out to need a password or passphrase
+    prompt: they connect (and prompt) as usual once a task gets to them.
+
+    With :ref:`env.connection_cache_size <connection-cache-size>` set, only
+    that many hosts are connected to (with a warning about the rest), as any
+    more would only close the first ones again.
+
+    Returns a dict mapping each host string which could not be connected to to
+    the `~fabric.exceptions.NetworkError` raised.
+
+    Used by `~fabric.tasks.execute` when :ref:`env.preconnect <preconnect>` is
+    set.
+    """
+    from fabric.state import connections, env, output
+    seen = set()
+    wanted = []
+    for host in hosts:
+        key = normalize_to_string(host)
+        if key not in seen and key not in connections:
+            seen.add(key)
+            wanted.append(host)
+    failures = {}
+    if not wanted:
+        return failures
+    size = env.connection_cache_size
+    if size and len(wanted) > size:
+        warn("Only connecting to the first %d of %d hosts ahead of time, as "
+             "env.connection_cache_size would close the rest again" % (size, len(wanted)))
+        wanted = wanted[:size]
+    todo = queue.Queue()
+    for host in wanted:
+        todo.put(host)
+    if env.gateway:
+        # Connect it once up front, rather than from all threads at once
+        try:
+            connections[env.gateway]
+        except NetworkError as e:
+            return dict((host, e) for host in todo.queue)
+    # Connecting threads see the same connection cache as we do, but get their
+    # own env for each host
+    shadows = _thread_shadows() or {}
+
+    def connect_hosts():
+        while True:
+            try:
+                host = todo.get_nowait()
+            except queue.Empty:
+                return
+            host_env = dict(env, abort_on_prompts=True, abort_exception=_PromptNeeded)
+            host_env.update(to_dict(host))
+            host_shadows = dict(shadows)
+            host_shadows[id(env)] = host_env
+            host_shadows[id(output)] = dict(output, aborts=False)
+            _set_thread_shadows(host_shadows)
+            try:
+                connections.connect(host)
+            except NetworkError as e:
+                failures[host] = e
+            except _PromptNeeded:
+                pass
+            finally:
+                _set_thread_shadows(None)
+
+    threads = [
+        threading.Thread(target=connect_hosts, name="preconnect-%d" % i)
+        for i in range(min(pool_size or len(wanted), len(wanted)))
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return failures
+
+
 def disconnect_all():
     """
     Disconnect from all currently connected servers.
 
     Used at the end of ``fab``'s main loop, and also intended for use by
-    library users.
+    library users. Persistent workers (see ``env.persistent_workers``) keep
+    their connections until ``fabric.workers.stop_workers()``.
     """
     from fabric.state import connections, output
     # Explicitly disconnect from all servers
@@ -699,7 +1384,8 @@ def disconnect_all():
             # Here we can't use the py3k print(x, end=" ")
             # because 2.5 backwards compatibility
             sys.stdout.write("Disconnecting from %s ... " % denormalize(key))
-        connections[key].close()
+        # (Bypassing the cache's own __getitem__, so as not to count a hit)
+        _ThreadLocalDict.__getitem__(connections, key).close()
         del connections[key]
         if output.status:
             sys.stdout.write("done.\n")
@@ -11,18 +11,20 @@ import subprocess
 import sys
 import time
 from glob import glob
-from collections import deque
 from contextlib import closing, contextmanager
 
 from fabric.context_managers import (settings, char_buffered, hide,
     quiet as quiet_manager, warn_only as warn_only_manager)
-from fabric.io import output_loop, input_loop
+from fabric.io import (
+    CaptureBuffer, ChannelIO, input_loop, serve_channels, _waitable,
+)
 from fabric.network import needs_host, ssh, ssh_config
 from fabric.sftp import SFTP
 from fabric.state import env, connections, output, win32, default_channel
 from fabric.thread_handling import ThreadHandler
 from fabric.utils import (
     abort, error, handle_prompt_abort, indent, _pty_size, warn, apply_lcwd,
+    _thread_stdin,
 )
 
 
@@ -707,7 +709,8 @@ def _prefix_env_vars(command, local=False):
 
 def _execute(channel, command, pty=True, combine_stderr=None,
              invoke_shell=False, stdin=None, stdout=None, stderr=None,
-             timeout=None, capture_buffer_size=None):
+             timeout=None, capture_buffer_size=None, encoding='utf-8',
+             errors='replace'):
     """
     Execute ``command`` over ``channel``.
 
@@ -726,12 +729,15 @@ def _execute(channel, command, pty=True, combine_stderr=None,
     capture stdout/stderr. (This is ignored if ``invoke_shell=True``, since
     that completely disables capturing overall.)
 
+    ``encoding`` and ``errors`` control how stdout/stderr are decoded.
+
     Returns a three-tuple of (``stdout``, ``stderr``, ``status``), where
     ``stdout``/``stderr`` are captured output strings and ``status`` is the
     program's return code, if applicable.
     """
     # stdin/stdout/stderr redirection
-    stdin = stdin or sys.stdin
+    default_stdin = _thread_stdin()
+    stdin = stdin or default_stdin
     stdout = stdout or sys.stdout
     stderr = stderr or sys.stderr
 
@@ -740,7 +746,7 @@ def _execute(channel, command, pty=True, combine_stderr=None,
 
     # Assume pty use, and allow overriding of this either via kwarg or env
     # var.  (invoke_shell always wants a pty no matter what.)
-    using_pty = invoke_shell or (pty and env.always_use_pty and (stdin is sys.stdin))
+    using_pty = invoke_shell or (pty and env.always_use_pty and (stdin is default_stdin))
 
     # What to do with CTRl-C?
     remote_interrupt = env.remote_interrupt
@@ -775,32 +781,27 @@ def _execute(channel, command, pty=True, combine_stderr=None,
         else:
             channel.exec_command(command=command)
 
-        # Init stdout, stderr capturing. Must use lists instead of strings as
-        # strings are immutable and we're using these as pass-by-reference
-        stdout_buf = deque(maxlen=capture_buffer_size)
-        stderr_buf = deque(maxlen=capture_buffer_size)
+        # Init stdout, stderr capturing. Must use buffers instead of strings
+        # as strings are immutable and we're using these as pass-by-reference
+        stdout_buf = CaptureBuffer(maxlen=capture_buffer_size)
+        stderr_buf = CaptureBuffer(maxlen=capture_buffer_size)
         if invoke_shell:
             stdout_buf = stderr_buf = None
 
-        workers = (
-            ThreadHandler('out', output_loop, channel, "recv",
-                capture=stdout_buf, stream=stdout, timeout=timeout),
-            ThreadHandler('err', output_loop, channel, "recv_stderr",
-                capture=stderr_buf, stream=stderr, timeout=timeout),
-            ThreadHandler('in', input_loop, channel, stdin, using_pty)
-        )
+        # Serve stdout, stderr and stdin from this thread, unless stdin is
+        # something we can't wait for input from, which is then left to a
+        # thread of its own
+        io = ChannelIO(channel, stdout, stderr, stdout_buf, stderr_buf,
+            stdin=stdin if _waitable(stdin) else None, using_pty=using_pty,
+            timeout=timeout, encoding=encoding, errors=errors)
+        workers = ()
+        if io.stdin is None:
+            workers = (ThreadHandler('in', input_loop, channel, stdin, using_pty),)
 
         while True:
-            if channel.exit_status_ready():
-                break
-            else:
-                # Check for thread exceptions here so we can raise ASAP
-                # (without chance of getting blocked by, or hidden by an
-                # exception within, recv_exit_status())
-                for worker in workers:
-                    worker.raise_if_needed()
             try:
-                time.sleep(ssh.io_sleep)
+                serve_channels([io])
+                break
             except KeyboardInterrupt:
                 if not remote_interrupt:
                     raise
@@ -822,8 +823,8 @@ def _execute(channel, command, pty=True, combine_stderr=None,
 
         # Update stdout/stderr with captured values if applicable
         if not invoke_shell:
-            stdout_buf = ''.join(stdout_buf).strip()
-            stderr_buf = ''.join(stderr_buf).strip()
+            stdout_buf = stdout_buf.getvalue().strip()
+            stderr_buf = stderr_buf.getvalue().strip()
 
         # Tie off "loose" output by printing a newline. Helps to ensure any
         # following print()s aren't on the same line as a trailing line prefix
@@ -877,7 +878,8 @@ def _noop():
 def _run_command(command, shell=True, pty=True, combine_stderr=True,
                  sudo=False, user=None, quiet=False, warn_only=False,
                  stdin=None, stdout=None, stderr=None, group=None,
-                 timeout=None, shell_escape=None, capture_buffer_size=None):
+                 timeout=None, shell_escape=None, capture_buffer_size=None,
+                 encoding='utf-8', errors='replace'):
     """
     Underpinnings of `run` and `sudo`. See their docstrings for more info.
     """
@@ -888,72 +890,88 @@ def _run_command(command, shell=True, pty=True, combine_stderr=True,
     if quiet:
         manager = quiet_manager
     with manager():
-        # Set up new var so original argument can be displayed verbatim later.
-        given_command = command
-
-        # Check if shell_escape has been overridden in env
-        if shell_escape is None:
-            shell_escape = env.get('shell_escape', True)
-
-        # Handle context manager modifications, and shell wrapping
-        wrapped_command = _shell_wrap(
-            _prefix_env_vars(_prefix_commands(command, 'remote')),
-            shell_escape,
-            shell,
-            _sudo_prefix(user, group) if sudo else None
-        )
-        # Execute info line
-        which = 'sudo' if sudo else 'run'
-        if output.debug:
-            print("[%s] %s: %s" % (env.host_string, which, wrapped_command))
-        elif output.running:
-            print("[%s] %s: %s" % (env.host_string, which, given_command))
+        wrapped_command = _command_started(command, shell, sudo, user, group,
+                                           shell_escape)
 
         # Actual execution, stdin/stdout/stderr handling, and termination
         result_stdout, result_stderr, status = _execute(
             channel=default_channel(), command=wrapped_command, pty=pty,
             combine_stderr=combine_stderr, invoke_shell=False,
             stdin=stdin, stdout=stdout, stderr=stderr,
-            timeout=timeout, capture_buffer_size=capture_buffer_size)
-
-        # Assemble output string
-        out = _stdoutString(result_stdout)
-        err = result_stderr
-
-        # Error handling
-        out.failed = False
-        out.command = given_command
-        out.real_command = wrapped_command
-        if status not in env.ok_ret_codes:
-            out.failed = True
-            msg = "%s() received nonzero return code %s while executing" % (
-                which, status
+            timeout=timeout, capture_buffer_size=capture_buffer_size,
+            encoding=encoding, errors=errors)
+
+        return _command_result(command, wrapped_command, sudo, result_stdout,
+                               result_stderr, status)
+
+
+def _command_started(command, shell, sudo, user, group, shell_escape):
+    """
+    Return ``command`` as it's to be run, having printed the info line for it.
+    """
+    # Check if shell_escape has been overridden in env
+    if shell_escape is None:
+        shell_escape = env.get('shell_escape', True)
+
+    # Handle context manager modifications, and shell wrapping
+    wrapped_command = _shell_wrap(
+        _prefix_env_vars(_prefix_commands(command, 'remote')),
+        shell_escape,
+        shell,
+        _sudo_prefix(user, group) if sudo else None
+    )
+    # Execute info line
+    which = 'sudo' if sudo else 'run'
+    if output.debug:
+        print("[%s] %s: %s" % (env.host_string, which, wrapped_command))
+    elif output.running:
+        print("[%s] %s: %s" % (env.host_string, which, command))
+    return wrapped_command
+
+
+def _command_result(given_command, wrapped_command, sudo, stdout, stderr, status):
+    """
+    Return the result of a finished command, handling its failure if need be.
+    """
+    # Assemble output string
+    out = _stdoutString(stdout)
+    err = stderr
+
+    # Error handling
+    out.failed = False
+    out.command = given_command
+    out.real_command = wrapped_command
+    if status not in env.ok_ret_codes:
+        out.failed = True
+        msg = "%s() received nonzero return code %s while executing" % (
+            'sudo' if sudo else 'run', status
+        )
+        if env.warn_only:
+            msg += " '%s'!" % given_command
+        else:
+            msg += "!\n\nRequested: %s\nExecuted: %s" % (
+                given_command, wrapped_command
             )
-            if env.warn_only:
-                msg += " '%s'!" % given_command
-            else:
-                msg += "!\n\nRequested: %s\nExecuted: %s" % (
-                    given_command, wrapped_command
-                )
-            error(message=msg, stdout=out, stderr=err)
+        error(message=msg, stdout=out, stderr=err)
 
-        # Attach return code to output string so users who have set things to
-        # warn only, can inspect the error code.
-        out.return_code = status
+    # Attach return code to output string so users who have set things to
+    # warn only, can inspect the error code.
+    out.return_code = status
 
-        # Convenience mirror of .failed
-        out.succeeded = not out.failed
+    # Convenience mirror of .failed
+    out.succeeded = not out.failed
 
-        # Attach stderr for anyone interested in that.
-        out.stderr = err
+    # Attach stderr for anyone interested in that.
+    out.stderr = err
 
-        return out
+    return out
 
 
 @needs_host
 def run(command, shell=True, pty=True, combine_stderr=None, quiet=False,
         warn_only=False, stdin=None, stdout=None, stderr=None,
-        timeout=None, shell_escape=None, capture_buffer_size=None):
+        timeout=None, shell_escape=None, capture_buffer_size=None,
+        encoding='utf-8', errors='replace'):
     """
     Run a shell command on a remote host.
 
@@ -1034,6 +1052,12 @@ def run(command, shell=True, pty=True, combine_stderr=None, quiet=False,
     If you want to disable Fabric's automatic attempts at escaping quotes,
     dollar signs etc., specify ``shell_escape=False``.
 
+    The remote program's output is decoded using ``encoding`` (UTF-8 by
+    default), with any bytes which aren't valid in it handled as per
+    ``errors`` -- one of the error handlers of Python's `codecs` module. By
+    default they are replaced with ``U+FFFD``; ``errors='strict'`` raises
+    ``UnicodeDecodeError`` instead.
+
     Examples::
 
         run("ls /var/www/")
@@ -1058,18 +1082,142 @@ def run(command, shell=True, pty=True, combine_stderr=None, quiet=False,
 
     .. versionadded:: 1.17
         The ``stdin`` argument.
+
+    .. versionadded:: 1.21
+        The ``encoding`` and ``errors`` arguments.
     """
     return _run_command(
         command, shell, pty, combine_stderr, quiet=quiet, warn_only=warn_only,
         stdin=stdin, stdout=stdout, stderr=stderr, timeout=timeout,
         shell_escape=shell_escape, capture_buffer_size=capture_buffer_size,
+        encoding=encoding, errors=errors,
     )
 
 
+@needs_host
+def run_concurrent(commands, max_channels=10, shell=True, combine_stderr=None,
+                   quiet=False, warn_only=False, timeout=None,
+                   shell_escape=None, capture_buffer_size=None, encoding='utf-8',
+                   errors='replace'):
+    """
+    Run several shell commands on a remote host at once, over one connection.
+
+    Each of ``commands`` is run as by `~fabric.operations.run`, but up to
+    ``max_channels`` of them at a time, each on its own channel of the host's
+    (cached) connection, all served from the calling thread. Many quick, independent commands -- say, checking
+    ``systemctl is-active`` for twenty units -- thus take about as long as the
+    slowest of them, rather than twenty round trips one after another.
+
+    Returns a list of results, in the same order as ``commands``, which are
+    just like those returned by `~fabric.operations.run`: each has
+    ``return_code``, ``failed``, ``succeeded``, ``stderr``, ``command`` and
+    ``real_command`` attributes.
+
+    Failures are only handled once every command has finished. If any of them
+    failed, `~fabric.utils.error` is called listing the failed commands and
+    their return codes (which aborts unless ``warn_only``, ``quiet`` or
+    :ref:`env.warn_only <warn_only>` is set). If any of them runs past its
+    ``timeout``, though, `~fabric.exceptions.CommandTimeout` is raised right
+    away, closing the channels of the rest.
+
+    The ``shell``, ``combine_stderr``, ``quiet``, ``timeout``,
+    ``shell_escape``, ``capture_buffer_size``, ``encoding`` and ``errors``
+    arguments work as for `~fabric.operations.run`, applied to every command.
+
+    As in parallel mode, output is printed a line at a time, and nothing can
+    be typed at the remote commands: they run without a pty and with empty
+    stdin, and anything prompting for input (such as a password prompt)
+    aborts. Use `~fabric.operations.run` for interactive commands.
+
+    .. note::
+        SSH servers limit how many sessions may be open on one connection at
+        a time -- OpenSSH's ``MaxSessions`` defaults to 10, which is why
+        ``max_channels`` does too. Sessions opened ahead of time (see
+        :ref:`preopen-channels`) count towards this limit as well, so up to
+        ``max_channels`` minus :ref:`env.preopen_channels
+        <preopen-channels>` commands (but at least one) run at a time.
+
+    Example::
+
+        units = ['nginx', 'redis', 'postgresql']
+        with quiet():
+            results = run_concurrent(
+                ["systemctl is-active %s" % unit for unit in units])
+        down = [unit for unit, result in zip(units, results) if result.failed]
+
+    .. versionadded:: 1.21
+    """
+    commands = list(commands)
+    results = [None] * len(commands)
+    if not commands:
+        return results
+    # Connect (and prompt for a password, if need be) before any channels are
+    # opened, so they all share one connection
+    connections[env.host_string]
+    if combine_stderr is None:
+        combine_stderr = env.combine_stderr
+    if timeout is None:
+        timeout = env.command_timeout
+    todo = enumerate(commands)
+    ios = []
+    running = {}
+
+    def start_next():
+        for i, command in todo:
+            wrapped_command = _command_started(command, shell, False, None,
+                                               None, shell_escape)
+            chan = default_channel()
+            chan.set_combine_stderr(combine_stderr)
+            chan.exec_command(command=wrapped_command)
+            # Nothing can be typed at it
+            chan.shutdown_write()
+            io = ChannelIO(chan, sys.stdout, sys.stderr,
+                           CaptureBuffer(maxlen=capture_buffer_size),
+                           CaptureBuffer(maxlen=capture_buffer_size),
+                           timeout=timeout, encoding=encoding, errors=errors)
+            running[io] = (i, command, wrapped_command)
+            ios.append(io)
+            return
+
+    def finished(io):
+        i, command, wrapped_command = running.pop(io)
+        status = io.chan.recv_exit_status()
+        io.chan.close()
+        results[i] = _command_result(
+            command, wrapped_command, False, io.out.capture.getvalue().strip(),
+            io.err.capture.getvalue().strip(), status)
+        start_next()
+
+    # Each command's session is replaced by one opened ahead of time, which
+    # the server counts as open too
+    channels = len(commands)
+    if max_channels:
+        channels = min(max(max_channels - env.preopen_channels, 1), channels)
+    # Like a parallel task: output a line at a time, no prompts
+    manager = quiet_manager if quiet else warn_only_manager
+    with settings(manager(), parallel=True, linewise=True):
+        try:
+            for i in range(channels):
+                start_next()
+            serve_channels(ios, finished)
+        finally:
+            for io in running:
+                io.chan.close()
+    failed = [result for result in results if result.failed]
+    if failed and not (warn_only or quiet):
+        msg = "run_concurrent() received nonzero return codes from %d of %d commands:\n\n%s" % (
+            len(failed), len(commands),
+            "\n".join("%s: %s" % (r.return_code, r.command) for r in failed),
+        )
+        error(message=msg)
+    return results
+
+
 @needs_host
 def sudo(command, shell=True, pty=True, combine_stderr=None, user=None,
          quiet=False, warn_only=False, stdin=None, stdout=None, stderr=None,
-         group=None, timeout=None, shell_escape=None, capture_buffer_size=None):
+         group=None, timeout=None, shell_escape=None, capture_buffer_size=None,
+         encoding='utf-8', errors='replace'):
     """
     Run a shell command on a remote host, with superuser privileges.
 
@@ -1114,6 +1262,9 @@ def sudo(command, shell=True, pty=True, combine_stderr=None, user=None,
 
     .. versionadded:: 1.17
         The ``stdin`` argument.
+
+    .. versionadded:: 1.21
+        The ``encoding`` and ``errors`` arguments.
     """
     return _run_command(
         command, shell, pty, combine_stderr, sudo=True,
@@ -1121,7 +1272,7 @@ def sudo(command, shell=True, pty=True, combine_stderr=None, user=None,
         group=group, quiet=quiet, warn_only=warn_only,
         stdin=stdin, stdout=stdout, stderr=stderr,
         timeout=timeout, shell_escape=shell_escape,
-        capture_buffer_size=capture_buffer_size,
+        capture_buffer_size=capture_buffer_size, encoding=encoding, errors=errors,
     )
 
 
@@ -4,11 +4,11 @@ Internal shared-state variables such as config settings and host lists.
 
 import os
 import sys
-from optparse import make_option
+from optparse import make_option, OptionValueError
 
 import paramiko as ssh
 
-from fabric.network import HostConnectionCache
+from fabric.network import HostConnectionCache, _SSHClient
 from fabric.version import get_version
 from fabric.utils import _AliasDict, _AttributeDict
 
@@ -71,6 +71,24 @@ def _rc_path():
     return expanded_rc_path
 
 
+def _pool_size_option(option, opt_str, value, parser):
+    """
+    Accept an integer (``0`` meaning unset), or ``'auto'``, for ``--pool-size``.
+    """
+    pool_size = value
+    if value != 'auto':
+        try:
+            pool_size = int(value)
+        except ValueError:
+            pool_size = -1
+        if pool_size < 0:
+            raise OptionValueError(
+                "option %s: invalid pool size: %r (expected a number or 'auto')"
+                % (opt_str, value)
+            )
+    setattr(parser.values, option.dest, pool_size)
+
+
 default_port = '22'  # hurr durr
 default_ssh_config_path = os.path.join(os.path.expanduser('~'), '.ssh', 'config')
 
@@ -110,6 +128,12 @@ env_options = [
         help="abort instead of prompting (for password, host, etc)"
     ),
 
+    make_option('--batch-size',
+        default=None,
+        metavar='N',
+        help="run parallel tasks in batches of N hosts (or N% of hosts), one after another"
+    ),
+
     make_option('-c', '--config',
         dest='rcfile',
         default=_rc_path(),
@@ -141,6 +165,18 @@ env_options = [
         help="python module file to import, e.g. '../other.py'"
     ),
 
+    make_option('--fail-fast',
+        default=None,
+        metavar='LIMIT',
+        help="stop starting parallel jobs after LIMIT failures, e.g. 1, 5, 2% or 5,2%"
+    ),
+
+    make_option('--fail-fast-terminate',
+        action='store_true',
+        default=False,
+        help="also terminate running parallel jobs when --fail-fast kicks in"
+    ),
+
     make_option('-g', '--gateway',
         default=None,
         metavar='HOST',
@@ -211,6 +247,34 @@ env_options = [
         help="make M attempts to connect before giving up"
     ),
 
+    make_option('--connection-cache-size',
+        type='int',
+        metavar='N',
+        default=0,
+        help="keep at most N connections open, closing the least recently used"
+    ),
+
+    make_option('--connection-check',
+        type='float',
+        metavar='SECONDS',
+        default=0,
+        help="check connections unused for SECONDS still work before reusing them"
+    ),
+
+    make_option('--connection-idle-timeout',
+        type='float',
+        metavar='SECONDS',
+        default=0,
+        help="close connections which haven't been used for SECONDS"
+    ),
+
+    make_option('--max-batch-failures',
+        type='int',
+        default=0,
+        metavar='N',
+        help="start the next --batch-size batch only if at most N hosts failed"
+    ),
+
     make_option('--no-pty',
         dest='always_use_pty',
         action='store_false',
@@ -230,6 +294,45 @@ env_options = [
         help="default to parallel execution method"
     ),
 
+    make_option('--parallel-backend',
+        type='choice',
+        choices=['processes', 'threads'],
+        default='processes',
+        metavar='BACKEND',
+        help="run parallel tasks in 'processes' (default) or 'threads'"
+    ),
+
+    make_option('--persistent-workers',
+        action='store_true',
+        default=False,
+        help="keep one worker (and its connections) per host for all parallel tasks"
+    ),
+
+    make_option('--pipeline',
+        action='store_true',
+        default=False,
+        help="run consecutive parallel tasks back to back on each host"
+    ),
+
+    make_option('--preconnect',
+        action='store_true',
+        default=False,
+        help="connect to all hosts at once before running serial tasks"
+    ),
+
+    make_option('--preopen-channels',
+        type='int',
+        metavar='N',
+        default=0,
+        help="keep N sessions per connection opened ahead of time for commands"
+    ),
+
+    make_option('--probe-hosts',
+        action='store_true',
+        default=False,
+        help="check which hosts can be reached before running tasks on them"
+    ),
+
     make_option('--port',
         default=default_port,
         help="SSH connection port"
@@ -241,6 +344,27 @@ env_options = [
         help="reject unknown hosts"
     ),
 
+    make_option('--retry-backoff',
+        type='float',
+        metavar='SECONDS',
+        default=0,
+        help="wait a random time of up to SECONDS, doubling each retry, between connection attempts"
+    ),
+
+    make_option('--retry-backoff-max',
+        type='float',
+        metavar='SECONDS',
+        default=30,
+        help="wait at most SECONDS between connection attempts when backing off"
+    ),
+
+    make_option('--retry-budget',
+        type='float',
+        metavar='SECONDS',
+        default=0,
+        help="stop retrying a connection once SECONDS have passed since the first attempt"
+    ),
+
     make_option('--sudo-password',
         default=None,
         help="password for use with sudo only",
@@ -261,6 +385,14 @@ env_options = [
         help="specify a new shell, defaults to '/bin/bash -l -c'"
     ),
 
+    make_option('--schedule',
+        type='choice',
+        choices=['fifo', 'longest-first', 'role-round-robin'],
+        default='fifo',
+        metavar='POLICY',
+        help="order in which to start parallel jobs: 'fifo' (default), 'longest-first' or 'role-round-robin'"
+    ),
+
     make_option('--show',
         metavar='LEVELS',
         help="comma-separated list of output levels to show"
@@ -332,10 +464,12 @@ env_options = [
 
     make_option('-z', '--pool-size',
             dest='pool_size',
-            type='int',
+            type='string',
+            action='callback',
+            callback=_pool_size_option,
             metavar='INT',
             default=0,
-            help="number of concurrent processes to use in parallel mode",
+            help="number of concurrent processes to use in parallel mode, or 'auto'",
     ),
 
 ]
@@ -356,6 +490,7 @@ env = _AttributeDict({
     'again_prompt': 'Sorry, try again.',
     'all_hosts': [],
     'combine_stderr': True,
+    'connection_check_timeout': 3,
     'colorize_errors': False,
     'command': None,
     'command_prefixes': [],
@@ -383,6 +518,7 @@ env = _AttributeDict({
     'remote_interrupt': None,
     'roles': [],
     'roledefs': {},
+    'schedule_history': '~/.fab_durations.json',
     'shell_env': {},
     'skip_bad_hosts': False,
     'skip_unknown_tasks': False,
@@ -433,7 +569,10 @@ connections = HostConnectionCache()
 
 
 def _open_session():
-    transport = connections[env.host_string].get_transport()
+    client = connections[env.host_string]
+    if isinstance(client, _SSHClient):
+        return client.open_session(timeout=env.timeout)
+    transport = client.get_transport()
     # Try passing session-open timeout for Paramiko versions which support it
     # (1.14.3+)
     try:
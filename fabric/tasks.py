@@ -1,12 +1,22 @@
 import inspect
+import json
+import math
+import os
 import sys
 import textwrap
+from contextlib import closing
 
 from fabric import state
 from fabric.utils import abort, warn, error
-from fabric.network import to_dict, disconnect_all
+from fabric.network import (
+    to_dict, disconnect_all, connect_stats, known_host_keys, preconnect, probe_hosts,
+)
 from fabric.context_managers import settings
-from fabric.job_queue import JobQueue
+from fabric.job_queue import (
+    JobQueue, AdaptivePoolSize, FIFOSchedule, LongestFirstSchedule, RoleRoundRobinSchedule
+)
+from fabric.thread_handling import ThreadContext
+from fabric.workers import persistent_job
 from fabric.task_utils import crawl, merge, parse_kwargs
 from fabric.exceptions import NetworkError
 
@@ -40,6 +50,24 @@ def _get_list(env):
     return inner
 
 
+def _pool_size(value):
+    """
+    Return a task's or ``env``'s pool size as an int or ``'auto'``.
+
+    Strings of digits are converted (in case somebody gave a string), and
+    ``None`` or ``0`` mean it's unset, giving ``None``.
+    """
+    if value is None or value == 'auto':
+        return value
+    try:
+        pool_size = int(value)
+    except (TypeError, ValueError):
+        pool_size = -1
+    if pool_size < 0:
+        abort("Pool size must be a positive number or 'auto', not %r" % (value,))
+    return pool_size or None
+
+
 class Task(object):
     """
     Abstract base class for objects wishing to be picked up as Fabric tasks.
@@ -102,12 +130,12 @@ class Task(object):
 
     def get_pool_size(self, hosts, default):
         # Default parallel pool size (calculate per-task in case variables
-        # change)
-        default_pool_size = default or len(hosts)
-        # Allow per-task override
-        # Also cast to int in case somebody gave a string
+        # change), allowing per-task override; unset means one per host
         from_task = getattr(self, 'pool_size', None)
-        pool_size = int(from_task or default_pool_size)
+        pool_size = _pool_size(from_task) or _pool_size(default) or len(hosts)
+        # When adaptive (see AdaptivePoolSize), this is only the upper limit
+        if pool_size == 'auto':
+            pool_size = len(hosts)
         # But ensure it's never larger than the number of hosts
         pool_size = min((pool_size, len(hosts)))
         # Inform user of final pool size for this task
@@ -182,16 +210,177 @@ def _is_network_error_ignored():
     return not state.env.use_exceptions_for['network'] and state.env.skip_bad_hosts
 
 
-def _parallel_wrap(task, args, kwargs, queue, name, env):
+def _parallel_context():
+    """
+    Return the ``multiprocessing``-like context used to run parallel jobs.
+
+    Depends on ``env.parallel_backend``: ``'processes'`` forks one child
+    process per host, ``'threads'`` runs each host in a thread of this process.
+    """
+    backend = state.env.get('parallel_backend', 'processes')
+    if backend == 'threads':
+        return ThreadContext
+    if backend != 'processes':
+        abort("Unknown parallel backend %r (expected 'processes' or 'threads')" % (backend,))
+    import multiprocessing
+    return multiprocessing.get_context('fork')
+
+
+def _host_count(spec, num_hosts, what):
+    """
+    Turn ``spec`` into a number of hosts, out of ``num_hosts``.
+
+    ``spec`` is a number, a percentage of hosts (e.g. ``'2%'``), or several of
+    those separated by commas, in which case the fewest wins. Percentages are
+    rounded up, and the result is at least 1.
+    """
+    counts = []
+    for part in str(spec).split(','):
+        part = part.strip()
+        try:
+            if part.endswith('%'):
+                counts.append(int(math.ceil(float(part[:-1]) * num_hosts / 100)))
+            else:
+                counts.append(int(part))
+        except ValueError:
+            abort("Invalid %s %r (expected e.g. '5', '2%%' or '5,2%%')" % (what, spec))
+    return max(1, min(counts))
+
+
+def _failure_limit(num_hosts):
+    """
+    Return how many failures out of ``num_hosts`` stop a parallel task early.
+
+    Depends on ``env.fail_fast``, which is a number of failures, a percentage
+    of hosts, or several of those separated by commas (whichever is fewest).
+    ``True`` means one failure, and ``None`` (the default) means no limit.
+    """
+    spec = state.env.get('fail_fast')
+    if spec is None or spec is False:
+        return None
+    if spec is True:
+        return 1
+    return _host_count(spec, num_hosts, 'fail-fast limit')
+
+
+def _batches(task, num_hosts):
+    """
+    Return ``(batch_size, max_failures)`` for rolling execution of ``task``.
+
+    Taken from the task's `~fabric.decorators.rolling` arguments, else
+    ``env.batch_size`` and ``env.max_batch_failures``. ``batch_size`` is
+    ``None`` when not rolling.
+    """
+    spec = getattr(task, 'batch_size', None) or state.env.get('batch_size')
+    if not spec:
+        return None, None
+    max_failures = getattr(task, 'max_failures', None)
+    if max_failures is None:
+        max_failures = state.env.get('max_batch_failures', 0)
+    return _host_count(spec, num_hosts, 'batch size'), int(max_failures)
+
+
+def _preconnect(task, hosts):
+    """
+    Connect to all of a serial task's hosts up front; see `.preconnect`.
+
+    Returns the hosts which failed, as `.preconnect` does. Unless those are to
+    be skipped, fails right away, before running the task anywhere.
+    """
+    failed = preconnect(hosts, task.get_pool_size(hosts, state.env.pool_size))
+    if failed and not _is_network_error_ignored():
+        e = failed[next(host for host in hosts if host in failed)]
+        if state.env.use_exceptions_for['network']:
+            raise e
+        error(e.message, func=abort, exception=e.wrapped)
+    return failed
+
+
+def _probe_hosts(hosts):
+    """
+    Find which of ``hosts`` are unreachable; see `.probe_hosts`.
+
+    Reports them all in one message: a warning if they're to be skipped,
+    otherwise an abort (or the first one's exception), before running the task
+    anywhere.
+    """
+    unreachable = probe_hosts(hosts)
+    if not unreachable:
+        return unreachable
+    dead = [host for host in hosts if host in unreachable]
+    summary = "%d of %d host(s) unreachable: %s" % (len(dead), len(hosts), ", ".join(
+        "%s (%s)" % (host, unreachable[host].wrapped.strerror or unreachable[host].wrapped)
+        for host in dead
+    ))
+    if not _is_network_error_ignored():
+        if state.env.use_exceptions_for['network']:
+            raise unreachable[dead[0]]
+        abort(summary)
+    warn(summary + "; skipping them")
+    return unreachable
+
+
+def _job_schedule(my_env):
+    """
+    Return the `~fabric.job_queue.JobQueue` scheduling policy for a task.
+
+    Depends on ``env.schedule``; see :ref:`job-scheduling`.
+    """
+    schedule = state.env.get('schedule', 'fifo')
+    if schedule == 'fifo':
+        return FIFOSchedule()
+    if schedule == 'longest-first':
+        return LongestFirstSchedule(_load_durations().get(my_env['command'], {}))
+    if schedule == 'role-round-robin':
+        roles = {}
+        for role in my_env['effective_roles']:
+            for host in merge([], [role], [], state.env.roledefs):
+                roles.setdefault(host, role)
+        return RoleRoundRobinSchedule(roles)
+    abort("Unknown schedule %r (expected 'fifo', 'longest-first' or 'role-round-robin')" % (schedule,))
+
+
+def _load_durations():
+    """
+    Load the per-task, per-host durations kept in ``env.schedule_history``.
+    """
+    path = os.path.expanduser(state.env.schedule_history)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save_durations(command, durations):
+    """
+    Record the durations of ``command`` on each host in ``env.schedule_history``.
+    """
+    path = os.path.expanduser(state.env.schedule_history)
+    history = _load_durations()
+    history.setdefault(command, {}).update(durations)
+    try:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(history, f)
+        os.replace(path + '.tmp', path)
+    except (IOError, OSError) as e:
+        warn("Unable to save task durations to %s: %s" % (path, e))
+
+
+def _parallel_wrap(task, args, kwargs, queue, name, env, keep_connections=False):
     # Wrap in another callable that:
     # * expands the env it's given to ensure parallel, linewise, etc are
     #   all set correctly and explicitly
-    # * nukes the connection cache to prevent shared-access problems
+    # * nukes the connection cache to prevent shared-access problems (unless
+    #   it's a persistent worker's own cache)
     # * knows how to send the tasks' return value back over a Queue
     # * captures exceptions raised by the task
+    # * reports how connecting went, for adaptive pool sizing
     state.env.update(env)
+    connect_stats(reset=True)
     try:
-        state.connections.clear()
+        if not keep_connections:
+            state.connections.clear()
         queue.put({'name': name, 'result': task.run(*args, **kwargs)})
     except BaseException as e:  # We really do want to capture everything
         # SystemExit implies use of abort(), which prints its own
@@ -208,13 +397,19 @@ def _parallel_wrap(task, args, kwargs, queue, name, env):
         # child process.
         if not (isinstance(e, NetworkError) and _is_network_error_ignored()):
             raise
+    finally:
+        queue.put({'name': name, 'stats': dict(connect_stats())})
 
-def _execute(task, host, my_env, args, kwargs, jobs, queue, multiprocessing):
+def _execute(task, host, my_env, args, kwargs, queue, multiprocessing):
     """
     Primary single-host work body of execute()
+
+    Returns the task's result when running serially, or the job to run it when
+    running in parallel.
     """
-    # Log to stdout
-    if state.output.running and not hasattr(task, 'return_value'):
+    # Log to stdout (pipelines log each of their tasks as they go)
+    if state.output.running and not hasattr(task, 'return_value') \
+            and not isinstance(task, _Pipeline):
         print("[%s] Executing task '%s'" % (host, my_env['command']))
     # Create per-run env with connection settings
     local_env = to_dict(host)
@@ -235,11 +430,14 @@ def _execute(task, host, my_env, args, kwargs, jobs, queue, multiprocessing):
             'name': name,
             'env': local_env,
         }
-        p = multiprocessing.Process(target=_parallel_wrap, kwargs=kwarg_dict)
-        # Name/id is host string
-        p.name = name
-        # Add to queue
-        jobs.append(p)
+        p = None
+        if state.env.persistent_workers:
+            p = persistent_job(multiprocessing, kwarg_dict)
+        if p is None:
+            p = multiprocessing.Process(target=_parallel_wrap, kwargs=kwarg_dict)
+            # Name/id is host string
+            p.name = name
+        return p
     # Handle serial execution
     else:
         with settings(**local_env):
@@ -286,7 +484,8 @@ def execute(task, *args, **kwargs):
 
     .. seealso::
         :ref:`The execute usage docs <execute>`, for an expanded explanation
-        and some examples.
+        and some examples; `~fabric.tasks.execute_iter`, to handle each host's
+        result as soon as it is available.
 
     .. versionadded:: 1.3
 
@@ -294,8 +493,55 @@ def execute(task, *args, **kwargs):
         Added the return value mapping; previously this function had no defined
         return value.
     """
+    prepared = _prepare_execute(task, kwargs)
+    if prepared is None:
+        return
+    task, my_env, new_kwargs = prepared
+    # Keep results in host list order, rather than order of completion
+    results = dict.fromkeys(my_env['all_hosts'])
+    for host, result in _execute_iter(task, my_env, args, new_kwargs):
+        results[host] = result
+    return results
+
+
+def execute_iter(task, *args, **kwargs):
+    """
+    Like `~fabric.tasks.execute`, but yield each host's result as it finishes.
+
+    Takes the same arguments as `~fabric.tasks.execute`, and yields ``(host,
+    result)`` tuples -- the same key/value pairs `~fabric.tasks.execute` would
+    return -- as each host's run of the task completes. In parallel mode this
+    is in order of completion, so e.g. follow-up work can start on the first
+    hosts to finish without waiting for the slowest, and only the results of
+    hosts still running are held in memory.
+
+    Failures are handled as in `~fabric.tasks.execute`. A host which fails in
+    parallel mode is yielded as soon as it finishes (with its exception, or
+    ``None`` if it aborted), while the resulting abort (or warning, if
+    :ref:`warn_only <warn_only>` is set) only happens once all hosts are done.
+
+    If the iterator is closed early (e.g. by ``break``-ing out of a loop over
+    it) no further hosts are started, and any still running in parallel are
+    waited for.
+
+    .. versionadded:: 1.21
+    """
+    prepared = _prepare_execute(task, kwargs)
+    if prepared is None:
+        return
+    task, my_env, new_kwargs = prepared
+    for host, result in _execute_iter(task, my_env, args, new_kwargs):
+        yield host, result
+
+
+def _prepare_execute(task, kwargs):
+    """
+    Common setup for execute() and execute_iter()
+
+    Returns ``(task, my_env, new_kwargs)``, or ``None`` for an unknown task
+    which is being skipped.
+    """
     my_env = {'clean_revert': True}
-    results = {}
     # Obtain task
     is_callable = callable(task)
     if not (is_callable or _is_task(task)):
@@ -306,7 +552,7 @@ def execute(task, *args, **kwargs):
             msg = "%r is not callable or a valid task name" % (my_env['command'],)
             if state.env.get('skip_unknown_tasks', False):
                 warn(msg)
-                return
+                return None
             else:
                 abort(msg)
     # Set env.command if we were given a real function or callable task obj
@@ -321,33 +567,46 @@ def execute(task, *args, **kwargs):
     # Set up host list
     my_env['all_hosts'], my_env['effective_roles'] = task.get_hosts_and_effective_roles(hosts, roles,
                                                                                         exclude_hosts, state.env)
+    return task, my_env, new_kwargs
 
-    parallel = requires_parallel(task)
-    if parallel:
-        import multiprocessing
-        ctx = multiprocessing.get_context('fork')
-        # Set up job queue for parallel cases
-        queue = ctx.Queue()
-    else:
-        ctx = None
-        queue = None
 
-    # Get pool size for this task
-    pool_size = task.get_pool_size(my_env['all_hosts'], state.env.pool_size)
-    jobs = JobQueue(pool_size, queue)
-    if state.output.debug:
-        jobs._debug = True
+def _execute_iter(task, my_env, args, new_kwargs):
+    """
+    Run ``task`` across its host list, yielding ``(host, result)`` as we go
 
-    # Call on host list
-    if my_env['all_hosts']:
+    Note that nothing is yielded from within a ``settings`` block, so the
+    caller's env is untouched while this generator is suspended.
+    """
+    # Just run once for local-only
+    if not my_env['all_hosts']:
+        with settings(**my_env):
+            result = task.run(*args, **new_kwargs)
+        yield '<local-only>', result
+        return
+
+    unreachable = {}
+    hosts = my_env['all_hosts']
+    if state.env.probe_hosts:
+        unreachable = _probe_hosts(hosts)
+        hosts = [host for host in hosts if host not in unreachable]
+
+    if not requires_parallel(task):
+        failed = {}
+        # Eagerly disconnecting would only close them again after one host
+        if state.env.preconnect and not state.env.eagerly_disconnect and hosts:
+            failed = _preconnect(task, hosts)
         # Attempt to cycle on hosts, skipping if needed
         for host in my_env['all_hosts']:
+            if host in unreachable:
+                # Already reported
+                yield host, unreachable[host]
+                continue
             try:
-                results[host] = _execute(
-                    task, host, my_env, args, new_kwargs, jobs, queue, ctx,
-                )
+                if host in failed:
+                    raise failed[host]
+                result = _execute(task, host, my_env, args, new_kwargs, None, None)
             except NetworkError as e:
-                results[host] = e
+                result = e
                 # Backwards compat test re: whether to use an exception or
                 # abort
                 if not state.env.use_exceptions_for['network']:
@@ -360,31 +619,182 @@ def execute(task, *args, **kwargs):
             if state.env.eagerly_disconnect:
                 disconnect_all()
 
-        # If running in parallel, block until job queue is emptied
-        if jobs:
-            err = "One or more hosts failed while executing task '%s'" % (
-                my_env['command']
-            )
-            jobs.close()
-            # Abort if any children did not exit cleanly (fail-fast).
-            # This prevents Fabric from continuing on to any other tasks.
-            # Otherwise, pull in results from the child run.
-            ran_jobs = jobs.run()
-            for name, d in ran_jobs.items():
+            yield host, result
+        return
+
+    # Already reported
+    for host in my_env['all_hosts']:
+        if host in unreachable:
+            yield host, unreachable[host]
+    if not hosts:
+        return
+
+    # Set up job queue for parallel cases
+    ctx = _parallel_context()
+    # Parse known_hosts up front, so child processes needn't each do it
+    try:
+        known_host_keys()
+    except IOError:
+        # Each host will report it when connecting
+        pass
+    queue = ctx.Queue()
+    # Get pool size for this task
+    pool_size = task.get_pool_size(hosts, state.env.pool_size)
+    schedule = _job_schedule(my_env)
+    if (_pool_size(getattr(task, 'pool_size', None)) or _pool_size(state.env.pool_size)) == 'auto':
+        # Adaptive, up to the usual pool size
+        pool_size = AdaptivePoolSize(maximum=pool_size)
+    batch_size, max_batch_failures = _batches(task, len(hosts))
+    jobs = JobQueue(pool_size, queue, schedule, batch_size)
+    if state.output.debug:
+        jobs._debug = True
+    # Jobs are only created as the queue gets around to starting them
+    jobs.extend(
+        _execute(task, host, my_env, args, new_kwargs, queue, ctx)
+        for host in hosts
+    )
+    jobs.close()
+
+    # Block until job queue is emptied
+    err = "One or more hosts failed while executing task '%s'" % (
+        my_env['command']
+    )
+    failures = []
+    failure_limit = _failure_limit(len(hosts))
+    batch_failures = 0
+    finished_hosts = []
+    stopped = None
+    try:
+        with closing(jobs.iter_results()) as finished:
+            for name, d in finished:
+                finished_hosts.append(name)
                 if d['exit_code'] != 0:
                     if isinstance(d['results'], NetworkError) and \
                             _is_network_error_ignored():
                         error(d['results'].message, func=warn, exception=d['results'].wrapped)
-                    elif isinstance(d['results'], BaseException):
-                        error(err, exception=d['results'])
                     else:
-                        error(err)
-                results[name] = d['results']
+                        failures.append(d['results'])
+                        batch_failures += 1
+                        if len(failures) == failure_limit:
+                            # Fail fast: don't start any more hosts
+                            stopped = stopped or "Stopped after %d failure(s)" % failure_limit
+                            jobs.cancel(terminate=state.env.get('fail_fast_terminate', False))
+                        elif batch_size and batch_failures == max_batch_failures + 1:
+                            # Over this batch's budget, so don't start the next.
+                            # Batches only start once the one before is done,
+                            # so this host is in batch number:
+                            batch = (len(finished_hosts) - 1) // batch_size + 1
+                            stopped = stopped or "Batch %d failed on more than %d host(s)" % (
+                                batch, max_batch_failures)
+                            jobs.cancel()
+                if batch_size and len(finished_hosts) % batch_size == 0:
+                    batch_failures = 0
+                yield name, d['results']
+    finally:
+        if isinstance(schedule, LongestFirstSchedule):
+            _save_durations(my_env['command'], schedule.durations)
+    if stopped:
+        finished_hosts = set(finished_hosts)
+        skipped = [host for host in hosts if host not in finished_hosts]
+        if skipped:
+            warn("%s; skipped %d host(s): %s" % (stopped, len(skipped), ", ".join(skipped)))
+    # Abort if any children did not exit cleanly (fail-fast).
+    # This prevents Fabric from continuing on to any other tasks.
+    for result in failures:
+        if isinstance(result, BaseException):
+            error(err, exception=result)
+        else:
+            error(err)
+
+
+class _Pipeline(Task):
+    """
+    Runs a series of parallel tasks in turn, on each of their hosts.
 
-    # Or just run once for local-only
-    else:
-        with settings(**my_env):
-            results['<local-only>'] = task.run(*args, **new_kwargs)
-    # Return what we can from the inner task executions
+    Built by `_execute_pipeline` from already-prepared ``(task, my_env, args,
+    kwargs)`` stages. Each stage is skipped on hosts not in its host list, and
+    starts with the env as it was at the start of the pipeline, just as
+    separate `execute` calls would. The pool size adapts (as with ``'auto'``)
+    if any stage's task asks for that.
+    """
+    parallel = True
 
-    return results
+    def __init__(self, stages, *args, **kwargs):
+        super(_Pipeline, self).__init__(*args, **kwargs)
+        self.stages = stages
+        self.name = ", ".join(my_env['command'] for _, my_env, _, _ in stages)
+        if any(_pool_size(getattr(task, 'pool_size', None)) == 'auto'
+               for task, _, _, _ in stages):
+            self.pool_size = 'auto'
+
+    def get_pool_size(self, hosts, default):
+        return min(
+            task.get_pool_size(my_env['all_hosts'], default)
+            for task, my_env, _, _ in self.stages
+        )
+
+    def run(self):
+        host = state.env.host_string
+        initial_env = dict(state.env)
+        for task, my_env, args, kwargs in self.stages:
+            if host not in my_env['all_hosts']:
+                continue
+            state.env.clear()
+            state.env.update(initial_env)
+            if state.output.running:
+                print("[%s] Executing task '%s'" % (host, my_env['command']))
+            with settings(**my_env):
+                task.run(*args, **kwargs)
+
+
+def _execute_pipeline(commands_to_run):
+    """
+    Execute ``fab``'s list of commands, pipelining runs of parallel tasks.
+
+    Consecutive parallel tasks are run as one `_Pipeline`, so that each host
+    moves on to its next task as soon as it's done with the previous one.
+    Other tasks (``@serial`` ones, including ``@runs_once``) act as barriers,
+    and are run via `execute` once everything before them is done.
+
+    Tasks' return values are discarded, as ``fab`` has no use for them.
+    """
+    stages = []
+
+    def _flush():
+        if len(stages) == 1:
+            task, my_env, args, kwargs = stages[0]
+        else:
+            all_hosts, seen, roles = [], set(), []
+            for _, stage_env, _, _ in stages:
+                for host in stage_env['all_hosts']:
+                    if host not in seen:
+                        seen.add(host)
+                        all_hosts.append(host)
+                # So that the schedule knows each host's role
+                roles.extend(r for r in stage_env['effective_roles'] if r not in roles)
+            task = _Pipeline(list(stages))
+            my_env = {
+                'clean_revert': True,
+                'command': task.name,
+                'all_hosts': all_hosts,
+                'effective_roles': roles,
+            }
+            args, kwargs = (), {}
+        for _ in _execute_iter(task, my_env, args, kwargs):
+            pass
+        del stages[:]
+
+    for name, args, kwargs, hosts, roles, exclude_hosts in commands_to_run:
+        kwargs = dict(kwargs, hosts=hosts, roles=roles, exclude_hosts=exclude_hosts)
+        task = crawl(name, state.commands)
+        if task is not None and requires_parallel(task):
+            task, my_env, new_kwargs = _prepare_execute(name, kwargs)
+            if my_env['all_hosts']:
+                stages.append((task, my_env, args, new_kwargs))
+                continue
+        # A barrier: finish everything pipelined so far, then run it by itself
+        if stages:
+            _flush()
+        execute(name, *args, **kwargs)
+    if stages:
+        _flush()
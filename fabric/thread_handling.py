@@ -1,5 +1,11 @@
+import copy
+import os
+import queue
 import threading
 import sys
+import traceback
+
+from fabric.utils import _thread_shadows, _set_thread_shadows
 
 
 def reraise(tp, value, tb=None):
@@ -18,8 +24,11 @@ class ThreadHandler(object):
     def __init__(self, name, callable, *args, **kwargs):
         # Set up exception handling
         self.exception = None
+        # Helper threads see the same (possibly per-thread) env as their parent
+        shadows = _thread_shadows()
 
         def wrapper(*args, **kwargs):
+            _set_thread_shadows(shadows)
             try:
                 callable(*args, **kwargs)
             except BaseException:
@@ -35,3 +44,103 @@ class ThreadHandler(object):
         if self.exception:
             e = self.exception
             reraise(e[0], e[1], e[2])
+
+
+def _exitcode_of(func, name):
+    """
+    Call ``func()`` and return its exit code, as a child process would.
+
+    Exceptions other than ``SystemExit`` print a traceback headed by ``name``.
+    """
+    try:
+        func()
+        return 0
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        elif isinstance(e.code, int):
+            return e.code
+        else:
+            sys.stderr.write(str(e.code) + '\n')
+            return 1
+    except BaseException:
+        sys.stderr.write("%s:\n" % name)
+        traceback.print_exc()
+        return 1
+
+
+def _copy_env(env):
+    """
+    Return a copy of ``env`` for a new thread, with its dicts, lists and sets
+    (such as ``passwords`` and ``roledefs``) copied too.
+    """
+    copied = dict(env)
+    for key, value in copied.items():
+        if isinstance(value, (dict, list, set)):
+            copied[key] = copy.deepcopy(value)
+    return copied
+
+
+class ThreadJob(threading.Thread):
+    """
+    Thread with enough of the ``multiprocessing.Process`` interface for
+    `~fabric.job_queue.JobQueue`.
+
+    Used by the ``threads`` parallel backend. Much like a forked child, the
+    thread gets its own copy of ``env`` and ``output`` as they are when it is
+    started, stdin reading from ``os.devnull`` rather than the terminal (see
+    `~fabric.utils._thread_stdin`), and its own (initially empty) connection
+    cache, which is closed when the thread finishes -- unless a cache to use
+    (and leave open) is given as ``connections``. ``exitcode`` follows
+    ``Process`` conventions, and ``sentinel`` is a file descriptor which
+    becomes readable once the thread is done.
+    """
+    def __init__(self, *args, **kwargs):
+        super(ThreadJob, self).__init__(*args, **kwargs)
+        self.daemon = True
+        self.exitcode = None
+        self.connections = None
+        self.sentinel = None
+        self._sentinel_w = None
+        self._shadows = None
+
+    def start(self):
+        from fabric.state import env, output, connections
+        self._shadows = {
+            id(env): _copy_env(env),
+            id(output): dict(output),
+            id(connections): {} if self.connections is None else self.connections,
+            'stdin': open(os.devnull),
+        }
+        self.sentinel, self._sentinel_w = os.pipe()
+        super(ThreadJob, self).start()
+
+    def close(self):
+        if self.sentinel is not None:
+            os.close(self.sentinel)
+            self.sentinel = None
+
+    def run(self):
+        from fabric.state import connections
+        _set_thread_shadows(self._shadows)
+        stdin = self._shadows['stdin']
+        self._shadows = None
+        try:
+            self.exitcode = _exitcode_of(super(ThreadJob, self).run, "Thread %s" % self.name)
+        finally:
+            if self.connections is None:
+                for client in list(connections.values()):
+                    client.close()
+                connections.clear()
+            _set_thread_shadows(None)
+            stdin.close()
+            # EOF on the sentinel wakes up whoever is waiting for us
+            os.close(self._sentinel_w)
+
+
+class ThreadContext(object):
+    """
+    Stand-in for a ``multiprocessing`` context, backed by threads.
+    """
+    Process = ThreadJob
+    Queue = queue.Queue
@@ -6,6 +6,7 @@ import os
 import sys
 import struct
 import textwrap
+import threading
 from traceback import format_exc
 
 
@@ -174,7 +175,118 @@ def handle_prompt_abort(prompt_for):
         abort(reason % "input would be ambiguous in parallel mode")
 
 
-class _AttributeDict(dict):
+_thread_state = threading.local()
+
+
+def _thread_shadows():
+    """
+    Return the calling thread's private `_ThreadLocalDict` storage, if any.
+    """
+    return getattr(_thread_state, 'shadows', None)
+
+
+def _set_thread_shadows(shadows):
+    """
+    Give the calling thread private storage for some `_ThreadLocalDict` objects.
+
+    ``shadows`` should map ``id()`` of each `_ThreadLocalDict` to the plain
+    dict that should back it within the calling thread, or be ``None`` to go
+    back to the shared storage. It may also map ``'stdin'`` to a file to use
+    in place of ``sys.stdin`` (see `_thread_stdin`).
+    """
+    _thread_state.shadows = shadows
+
+
+def _thread_stdin():
+    """
+    Return the calling thread's stdin: ``sys.stdin``, unless it has its own.
+    """
+    shadows = _thread_shadows()
+    if shadows is not None and 'stdin' in shadows:
+        return shadows['stdin']
+    return sys.stdin
+
+
+class _ThreadLocalDict(dict):
+    """
+    Dictionary subclass whose storage may be replaced on a per-thread basis.
+
+    By default all threads share the same contents, exactly like a normal
+    ``dict``. A thread which has registered a private dict for this object via
+    `_set_thread_shadows` will instead read and write that private dict, which
+    is how the ``threads`` parallel backend isolates ``env`` and friends
+    between hosts.
+    """
+    def _storage(self):
+        shadows = getattr(_thread_state, 'shadows', None)
+        if shadows:
+            return shadows.get(id(self), self)
+        return self
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self._storage(), key)
+
+    def __setitem__(self, key, value):
+        return dict.__setitem__(self._storage(), key, value)
+
+    def __delitem__(self, key):
+        return dict.__delitem__(self._storage(), key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self._storage(), key)
+
+    def __iter__(self):
+        return dict.__iter__(self._storage())
+
+    def __reversed__(self):
+        return dict.__reversed__(self._storage())
+
+    def __len__(self):
+        return dict.__len__(self._storage())
+
+    def __repr__(self):
+        return dict.__repr__(self._storage())
+
+    def __eq__(self, other):
+        return dict.__eq__(self._storage(), other)
+
+    def __ne__(self, other):
+        return dict.__ne__(self._storage(), other)
+
+    __hash__ = None
+
+    def get(self, key, default=None):
+        return dict.get(self._storage(), key, default)
+
+    def keys(self):
+        return dict.keys(self._storage())
+
+    def values(self):
+        return dict.values(self._storage())
+
+    def items(self):
+        return dict.items(self._storage())
+
+    def pop(self, key, *default):
+        return dict.pop(self._storage(), key, *default)
+
+    def popitem(self):
+        return dict.popitem(self._storage())
+
+    def setdefault(self, key, default=None):
+        return dict.setdefault(self._storage(), key, default)
+
+    def update(self, *args, **kwargs):
+        return dict.update(self._storage(), *args, **kwargs)
+
+    def clear(self):
+        return dict.clear(self._storage())
+
+    def copy(self):
+        return dict.copy(self._storage())
+
+
+class _AttributeDict(_ThreadLocalDict):
     """
     Dictionary subclass enabling attribute lookup/assignment of keys/values.
 
@@ -0,0 +1,245 @@
+"""
+Persistent per-host workers for parallel tasks; see ``env.persistent_workers``.
+
+Normally each parallel task forks a fresh child per host, which has to open
+its own SSH connection. With persistent workers, the first parallel task to
+run on a host forks a long-lived worker process for it instead, and later
+tasks on that host are sent to the same worker, which keeps its connection
+cache between them.
+
+Tasks are sent to workers by name, so this only applies to tasks which can be
+found in ``state.commands`` (as when using ``fab``), called with arguments
+which can be pickled; others fall back to a regular child process. With the
+``threads`` parallel backend, only each host's connection cache is kept.
+"""
+
+import atexit
+import multiprocessing
+import os
+import pickle
+import queue
+import sys
+
+from fabric import state
+from fabric.task_utils import crawl
+from fabric.thread_handling import ThreadContext, _exitcode_of
+from fabric.utils import _thread_shadows
+
+
+# Worker processes by host string, only valid in the process which forked them
+_workers = {}
+_workers_pid = None
+
+# Kept connection caches for the threads backend, by host string
+_thread_connections = {}
+
+
+def _get_workers():
+    global _workers_pid
+    if _workers_pid != os.getpid():
+        # We've been forked since: these are our parent's workers, not ours
+        for worker in _workers.values():
+            worker.conn.close()
+        _workers.clear()
+        _workers_pid = os.getpid()
+    return _workers
+
+
+def _task_name(task, mapping=None, prefix=''):
+    """
+    Return the name ``task`` is registered under in ``state.commands``, or None
+    """
+    if mapping is None:
+        mapping = state.commands
+    wrapped = getattr(task, 'wrapped', None)
+    for name, value in mapping.items():
+        if isinstance(value, dict):
+            found = _task_name(task, value, prefix + name + '.')
+            if found is not None:
+                return found
+        elif value is task or (wrapped is not None and (
+                value is wrapped or getattr(value, 'wrapped', None) is wrapped)):
+            return prefix + name
+    return None
+
+
+def persistent_job(ctx, kwarg_dict):
+    """
+    Return a job running ``_parallel_wrap(**kwarg_dict)`` on a persistent
+    worker for its host, or ``None`` if that isn't possible.
+    """
+    from fabric.tasks import _parallel_wrap
+    name = kwarg_dict['name']
+    if ctx is ThreadContext:
+        job = ctx.Process(target=_parallel_wrap, name=name,
+                          kwargs=dict(kwarg_dict, keep_connections=True))
+        job.connections = _thread_connections.setdefault(name, {})
+        return job
+    task_name = _task_name(kwarg_dict['task'])
+    if task_name is None:
+        return None
+    worker = _get_workers().get(name)
+    # Send over what the worker needs to recreate our env. Values which can't
+    # be pickled are fine as long as the worker already has them.
+    env = {}
+    for key, value in dict(state.env, **kwarg_dict['env']).items():
+        try:
+            env[key] = pickle.dumps(value)
+        except Exception:
+            if worker is not None and worker.env.get(key) is not value:
+                return None
+    try:
+        request = pickle.dumps((
+            name, task_name, kwarg_dict['args'], kwarg_dict['kwargs'],
+            env, dict(state.output),
+        ))
+    except Exception:
+        return None
+    return WorkerJob(name, request)
+
+
+class WorkerJob(object):
+    """
+    Job for `~fabric.job_queue.JobQueue` which runs on a persistent worker.
+
+    Has enough of the ``multiprocessing.Process`` interface for the queue, and
+    hands back the task's return value and connection stats itself, as
+    ``results`` and ``stats``.
+    """
+    def __init__(self, name, request):
+        self.name = name
+        self.exitcode = None
+        self.results = None
+        self.stats = None
+        self.sentinel = None
+        self._request = request
+        self._worker = None
+
+    def start(self):
+        workers = _get_workers()
+        worker = workers.get(self.name)
+        if worker is None or not worker.process.is_alive():
+            if worker is not None:
+                worker.conn.close()
+            worker = workers[self.name] = _Worker(self.name)
+        self._worker = worker
+        worker.conn.send_bytes(self._request)
+        self._request = None
+        # Becomes readable when the worker replies, or dies
+        self.sentinel = worker.conn
+
+    def is_alive(self):
+        return self.exitcode is None and not self._worker.conn.poll()
+
+    def terminate(self):
+        # Takes the worker down with it; a replacement is started on next use
+        if self.exitcode is None:
+            self._worker.process.terminate()
+
+    def join(self, timeout=None):
+        if self.exitcode is not None:
+            return
+        if timeout is not None and not self._worker.conn.poll(timeout):
+            return
+        try:
+            self.exitcode, self.results, self.stats = self._worker.conn.recv()
+        except EOFError:
+            # Worker died mid-task; a replacement is started on next use
+            self._worker.process.join()
+            self.exitcode = self._worker.process.exitcode or 1
+
+
+class _Worker(object):
+    """
+    Parent-side handle on a host's worker process
+    """
+    def __init__(self, name):
+        ctx = multiprocessing.get_context('fork')
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, self.conn), name=name)
+        self.process.start()
+        child_conn.close()
+        # For spotting changes to values which can't be sent to the worker
+        self.env = dict(state.env)
+
+
+def _worker_main(conn, parent_conn):
+    from fabric.network import disconnect_all
+    # Only our parent's end may stay open, so we see EOF if our parent dies
+    parent_conn.close()
+    _get_workers()
+    # Our parent's connections aren't ours to use (or close)
+    state.connections.clear()
+    base_env = dict(state.env)
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if request is None:
+            break
+        exitcode, result, stats = _run_request(request, base_env)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            conn.send((exitcode, result, stats))
+        except Exception:
+            # Unpicklable return value; a forked child would lose it too
+            conn.send((exitcode, None, stats))
+    disconnect_all()
+
+
+def _run_request(request, base_env):
+    from fabric.tasks import WrappedCallableTask, _is_task, _parallel_wrap
+    name, task_name, args, kwargs, env, output = request
+    task = crawl(task_name, state.commands)
+    if not _is_task(task):
+        task = WrappedCallableTask(task)
+    env = dict((key, pickle.loads(value)) for key, value in env.items())
+    # Start from the env as it was when we were forked, like a fresh child
+    state.env.clear()
+    state.env.update(base_env)
+    state.output.update(output)
+    results = queue.Queue()
+    exitcode = _exitcode_of(
+        lambda: _parallel_wrap(task, args, kwargs, results, name, env, keep_connections=True),
+        "Process %s" % name,
+    )
+    result = stats = None
+    while not results.empty():
+        message = results.get_nowait()
+        if 'stats' in message:
+            stats = message['stats']
+        else:
+            result = message['result']
+    return exitcode, result, stats
+
+
+def stop_workers():
+    """
+    Shut down all persistent workers, and close any connections kept for them.
+    """
+    if _thread_shadows() is not None:
+        # Called from within a threads backend job; leave the others alone
+        return
+    workers = _get_workers()
+    for worker in workers.values():
+        try:
+            worker.conn.send(None)
+        except OSError:
+            pass
+    for worker in workers.values():
+        worker.process.join(10)
+        if worker.process.is_alive():
+            worker.process.terminate()
+            worker.process.join()
+        worker.conn.close()
+    workers.clear()
+    for cache in _thread_connections.values():
+        for client in cache.values():
+            client.close()
+    _thread_connections.clear()
+
+
+# Workers last until ``fab`` is done, or library users' scripts exit
+atexit.register(stop_workers)
@@ -0,0 +1,101 @@
+"""
+Benchmark for capturing large command outputs.
+
+Feeds generated output through an OutputLooper in 4096 byte reads, as run()
+would for a command printing lots of lines, then joins the captured text up
+as run() does for its return value. Reports the time taken and how much the
+process' peak memory use grew, which is mostly the capture buffer.
+
+For comparison, ``--deque`` captures into a deque of characters, as run()
+used to. ``--prompts`` sets that many entries in ``env.prompts``, none of
+which appear in the output, to show what looking out for them costs.
+``--binary`` sends random bytes rather than lines of text, as a command
+dumping a binary file would.
+
+    python tests/bench_capture.py [--mb=100] [--line=80] [--maxlen=N] [--deque]
+                                  [--prompts=N] [--binary]
+"""
+
+import collections
+import optparse
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fabric.api import hide, settings  # noqa: E402
+from fabric.io import CaptureBuffer, OutputLooper  # noqa: E402
+
+
+class FakeChannel(object):
+    def __init__(self, size, line, binary):
+        self.left = size
+        if binary:
+            rng = random.Random(0)
+            self.block = bytes(rng.getrandbits(8) for i in range(65536))
+        else:
+            text = ('x' * (line - 1) + '\n').encode()
+            self.block = (text * (65536 // len(text) + 1))
+
+    def recv(self, size):
+        size = min(size, self.left)
+        self.left -= size
+        return self.block[:size]
+
+
+def peak_mb():
+    # Linux reports kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--mb', type='int', default=100)
+    parser.add_option('--line', type='int', default=80)
+    parser.add_option('--maxlen', type='int', default=None)
+    parser.add_option('--deque', action='store_true', default=False)
+    parser.add_option('--prompts', type='int', default=0)
+    parser.add_option('--binary', action='store_true', default=False)
+    opts, args = parser.parse_args()
+
+    size = opts.mb * 1024 * 1024
+    if opts.deque:
+        capture = collections.deque(maxlen=opts.maxlen)
+    else:
+        capture = CaptureBuffer(maxlen=opts.maxlen)
+    chan = FakeChannel(size, opts.line, opts.binary)
+    prompts = dict(('Answer question %d? ' % i, 'y') for i in range(opts.prompts))
+    before = peak_mb()
+    started = time.time()
+    with settings(hide('everything'), prompts=prompts):
+        looper = OutputLooper(chan, 'recv', sys.stdout, capture, None)
+        while True:
+            data = chan.recv(looper.read_size)
+            if not data:
+                break
+            looper.feed(data)
+        looper.finish()
+    read = time.time() - started
+    if opts.deque:
+        result = ''.join(capture).strip()
+    else:
+        result = capture.getvalue().strip()
+    joined = time.time() - started - read
+
+    print("%d MB of %s, captured in a %s%s, %d prompts" % (
+        opts.mb,
+        'random bytes' if opts.binary else '%d character lines' % opts.line,
+        'deque' if opts.deque else 'CaptureBuffer',
+        '' if opts.maxlen is None else ' (maxlen %d)' % opts.maxlen, opts.prompts,
+    ))
+    print("  read time:     %8.3f s (%.1f MB/s)" % (read, opts.mb / read))
+    print("  join time:     %8.3f s" % joined)
+    print("  peak memory:   +%7.0f MB" % (peak_mb() - before))
+    print("  captured:      %8d characters" % len(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Benchmark for JobQueue scheduling overhead.
+
+Runs many short jobs through a JobQueue and reports wall time, the CPU time
+used by the controlling process, and the "handoff" latency: the time between
+one job finishing and the next job starting in its place.
+
+For comparison, ``--poll`` uses the old scheme of sleeping ``ssh.io_sleep``
+between checks on the running jobs.
+
+    python tests/bench_job_queue.py [--jobs=500] [--pool=1] [--threads] [--poll]
+"""
+
+import multiprocessing
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fabric.job_queue import JobQueue  # noqa: E402
+from fabric.network import ssh  # noqa: E402
+from fabric.thread_handling import ThreadContext  # noqa: E402
+
+
+class PollingJobQueue(JobQueue):
+    def _wait(self):
+        time.sleep(ssh.io_sleep)
+        return [job.sentinel for job in self._running if not job.is_alive()]
+
+
+def short_job(queue, name):
+    started = time.time()
+    queue.put({'name': name, 'result': (started, time.time())})
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--jobs', type='int', default=500)
+    parser.add_option('--pool', type='int', default=1)
+    parser.add_option('--threads', action='store_true', default=False)
+    parser.add_option('--poll', action='store_true', default=False)
+    opts, args = parser.parse_args()
+
+    if opts.threads:
+        ctx = ThreadContext
+    else:
+        ctx = multiprocessing.get_context('fork')
+    queue = ctx.Queue()
+    jobs = (PollingJobQueue if opts.poll else JobQueue)(opts.pool, queue)
+    for i in range(opts.jobs):
+        name = 'job%d' % i
+        jobs.append(ctx.Process(target=short_job, args=(queue, name), name=name))
+    jobs.close()
+
+    wall = time.time()
+    cpu = time.process_time()
+    results = jobs.run()
+    cpu = time.process_time() - cpu
+    wall = time.time() - wall
+
+    spans = sorted(r['results'] for r in results.values())
+    # Only meaningful as per-slot handoff latency when pool size is 1
+    gaps = [b[0] - a[1] for a, b in zip(spans, spans[1:])]
+    print("%s, %d jobs, pool size %d, %s" % (
+        'threads' if opts.threads else 'processes', opts.jobs, opts.pool,
+        'polling' if opts.poll else 'event-driven',
+    ))
+    print("  wall time:      %8.3f s" % wall)
+    print("  controller cpu: %8.3f s" % cpu)
+    if gaps and opts.pool == 1:
+        gaps.sort()
+        print("  handoff mean:   %8.3f ms" % (1000 * sum(gaps) / len(gaps)))
+        print("  handoff p99:    %8.3f ms" % (1000 * gaps[int(len(gaps) * 0.99)]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Benchmark for the client side cost of sequential run() calls.
+
+Starts the local test server, then times a number of ``run("true")`` calls one
+after another over a single connection, reporting wall clock time and the CPU
+time used by this process (which includes the server's threads, though they
+do much the same work whatever the client does). The server closes each
+channel right after answering, rather than lingering as it does in the tests.
+
+    python tests/bench_run.py [--runs=1000] [--linger=0]
+"""
+
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fabric.api import hide, run, settings  # noqa: E402
+from server import server, HOST, PORT, USER, PASSWORDS  # noqa: E402
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--runs', type='int', default=1000)
+    parser.add_option('--linger', type='float', default=0.0)
+    opts, args = parser.parse_args()
+
+    @server(responses={'true': ''}, linger=opts.linger)
+    def bench():
+        # As in the tests, skip shell wrapping so the server knows the command
+        with settings(hide('everything'), host_string='%s@%s:%s' % (USER, HOST, PORT),
+                      password=PASSWORDS[USER], abort_on_prompts=True,
+                      disable_known_hosts=True, use_shell=False):
+            # Connect outside of the timings
+            run('true')
+            wall, cpu = time.time(), time.process_time()
+            for i in range(opts.runs):
+                run('true')
+            return time.time() - wall, time.process_time() - cpu
+
+    wall, cpu = bench()
+    print("%d sequential run() calls" % opts.runs)
+    print("  wall time:     %8.3f s" % wall)
+    print("  cpu time:      %8.3f s" % cpu)
+    print("  per run():     %8.2f ms wall, %.2f ms cpu" % (
+        1e3 * wall / opts.runs, 1e3 * cpu / opts.runs,
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Benchmark for the ssh_config work done by each run() call.
+
+Starts the local test server, then times a number of sequential ``run("true")``
+calls over a single connection with ``env.use_ssh_config`` on, against a
+generated config with many Host stanzas (the server's alias matching the last
+one). With a connection already open, each run() still resolves the host's
+ssh_config: once to find its connection (via normalize()) and once more to
+check ForwardAgent. As in bench_run.py, the server closes each channel right
+after answering.
+
+For comparison, ``--uncached`` makes every lookup miss the per-host results,
+as before they were memoized (only the parsed file being cached).
+
+    python tests/bench_ssh_config.py [--stanzas=500] [--runs=1000] [--uncached]
+"""
+
+import optparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fabric.api import hide, run, settings  # noqa: E402
+from fabric.state import env  # noqa: E402
+from server import server, HOST, PORT, USER, PASSWORDS  # noqa: E402
+
+
+class _Uncached(dict):
+    """
+    Per-host ssh_config results which are never found, so always looked up.
+    """
+    def __contains__(self, key):
+        return False
+
+
+def write_config(path, stanzas):
+    with open(path, 'w') as f:
+        for i in range(stanzas):
+            f.write("Host web%d web%d.example.com\n" % (i, i))
+            f.write("    HostName 10.0.%d.%d\n" % (i // 256, i % 256))
+            f.write("    User deploy%d\n" % (i % 7))
+            f.write("    IdentityFile ~/.ssh/web%d.pem\n\n" % i)
+        f.write("Host benchserver\n    HostName %s\n    Port %s\n    User %s\n\n" % (
+            HOST, PORT, USER))
+        f.write("Host *\n    ForwardAgent no\n")
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--stanzas', type='int', default=500)
+    parser.add_option('--runs', type='int', default=1000)
+    parser.add_option('--uncached', action='store_true', default=False)
+    opts, args = parser.parse_args()
+
+    @server(responses={'true': ''}, linger=0)
+    def bench():
+        # As in the tests, skip shell wrapping so the server knows the command
+        with settings(hide('everything'), host_string='benchserver',
+                      use_ssh_config=True, ssh_config_path=path,
+                      password=PASSWORDS[USER], abort_on_prompts=True,
+                      disable_known_hosts=True, use_shell=False):
+            # Connect (and parse the file) outside of the timings
+            run('true')
+            if opts.uncached:
+                env._ssh_config_hosts = _Uncached()
+            wall, cpu = time.time(), time.process_time()
+            for i in range(opts.runs):
+                run('true')
+            return time.time() - wall, time.process_time() - cpu
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        write_config(path, opts.stanzas)
+        wall, cpu = bench()
+    finally:
+        os.unlink(path)
+
+    print("%d sequential run() calls, %d stanzas, %s" % (
+        opts.runs, opts.stanzas,
+        'uncached' if opts.uncached else 'cached per host',
+    ))
+    print("  wall time:     %8.3f s" % wall)
+    print("  cpu time:      %8.3f s" % cpu)
+    print("  per run():     %8.2f ms wall, %.2f ms cpu" % (
+        1e3 * wall / opts.runs, 1e3 * cpu / opts.runs,
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+import inspect
 import os
 import re
 import socket
@@ -105,12 +106,13 @@ class TestServer(ssh.ServerInterface):
     ``serve_responses`` function and its ``SSHHandler`` class.
     """
     def __init__(self, passwords, home, pubkeys, files):
-        self.event = threading.Event()
         self.passwords = passwords
         self.pubkeys = pubkeys
         self.files = FakeFilesystem(files)
         self.home = home
-        self.command = None
+        # Commands exec'd so far, by channel ID
+        self.commands = {}
+        self.commands_ready = threading.Condition()
 
     def check_channel_request(self, kind, chanid):
         if kind == 'session':
@@ -118,15 +120,26 @@ class TestServer(ssh.ServerInterface):
         return ssh.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
 
     def check_channel_exec_request(self, channel, command):
-        self.command = command
-        self.event.set()
+        with self.commands_ready:
+            self.commands[channel.get_id()] = command
+            self.commands_ready.notify_all()
         return True
 
+    def wait_for_command(self, channel, done):
+        """
+        Return the command exec'd on ``channel``, or None if it never is.
+        """
+        with self.commands_ready:
+            while channel.get_id() not in self.commands:
+                if done.isSet() or channel.closed:
+                    return None
+                self.commands_ready.wait(0.1)
+            return self.commands.pop(channel.get_id())
+
     def check_channel_pty_request(self, *args):
         return True
 
     def check_channel_shell_request(self, channel):
-        self.event.set()
         return True
 
     def check_auth_password(self, username, password):
@@ -327,7 +340,8 @@ class FakeSFTPServer(ssh.SFTPServerInterface):
         return ssh.SFTP_OK
 
 
-def serve_responses(responses, files, passwords, home, pubkeys, port):
+def serve_responses(responses, files, passwords, home, pubkeys, port, flaky=0,
+                    linger=0.5):
     """
     Return a threading TCP based SocketServer listening on ``port``.
 
@@ -337,53 +351,62 @@ def serve_responses(responses, files, passwords, home, pubkeys, port):
 
     ``pubkeys`` is a Boolean value determining whether the server will allow
     pubkey auth or not.
+
+    ``flaky`` is the number of connections to drop right after accepting them,
+    like an overloaded server, before serving any. The time each connection
+    was accepted at is recorded in the server's ``accepted`` list.
+
+    ``linger`` is how long to wait after answering a command before closing its
+    channel.
     """
     # Define handler class inline so it can access serve_responses' args
     class SSHHandler(BaseRequestHandler):
         def handle(self):
+            with self.server.flaky_lock:
+                self.server.accepted.append(time.time())
+                if len(self.server.accepted) <= flaky:
+                    # Closed (without sending a banner) once we return
+                    return
             try:
                 self.init_transport()
-                self.waiting_for_command = False
+                # Each channel is served by its own thread, so commands the
+                # client runs at once are answered at once
+                workers = []
                 while not self.server.all_done.isSet():
-                    # Don't overwrite channel if we're waiting for a command.
-                    if not self.waiting_for_command:
-                        self.channel = self.transport.accept(1)
-                        if not self.channel:
-                            continue
-                    self.ssh_server.event.wait(10)
-                    if self.ssh_server.command:
-                        self.command = self.ssh_server.command
-                        # Set self.sudo_prompt, update self.command
-                        self.split_sudo_prompt()
-                        if self.command in responses:
-                            self.stdout, self.stderr, self.status = \
-                                self.response()
-                            if self.sudo_prompt and not self.sudo_password():
-                                self.channel.send(
-                                    "sudo: 3 incorrect password attempts\n"
-                                )
-                                break
-                            self.respond()
-                        else:
-                            self.channel.send_stderr(
-                                "Sorry, I don't recognize that command.\n"
-                            )
-                            self.channel.send_exit_status(1)
-                        # Close up shop
-                        self.command = self.ssh_server.command = None
-                        self.waiting_for_command = False
-                        time.sleep(0.5)
-                        self.channel.close()
-                    else:
-                        # If we're here, self.command was False or None,
-                        # but we do have a valid Channel object. Thus we're
-                        # waiting for the command to show up.
-                        self.waiting_for_command = True
-
+                    channel = self.transport.accept(1)
+                    if channel:
+                        workers.append(ThreadHandler(
+                            'channel', self.serve_channel, channel))
+                for worker in workers:
+                    worker.thread.join()
+                    worker.raise_if_needed()
             finally:
                 self.transport.close()
 
+        def serve_channel(self, channel):
+            command = self.ssh_server.wait_for_command(
+                channel, self.server.all_done)
+            if command is None:
+                # E.g. a shell or SFTP session
+                return
+            sudo_prompt, command = self.split_sudo_prompt(command)
+            if command in responses:
+                stdout, stderr, status = self.response(command)
+                if sudo_prompt and not self.sudo_password(channel):
+                    channel.send("sudo: 3 incorrect password attempts\n")
+                    self.transport.close()
+                    return
+                self.respond(channel, stdout, stderr, status)
+            else:
+                channel.send_stderr("Sorry, I don't recognize that command.\n")
+                channel.send_exit_status(1)
+            # Close up shop
+            time.sleep(linger)
+            channel.close()
+
         def init_transport(self):
+            # As sshd does, so replies aren't held back by Nagle's algorithm
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             transport = ssh.Transport(self.request)
             transport.add_server_key(ssh.RSAKey(filename=SERVER_PRIVKEY))
             transport.set_subsystem_handler('sftp', ssh.SFTPServer,
@@ -393,17 +416,15 @@ def serve_responses(responses, files, passwords, home, pubkeys, port):
             self.ssh_server = server
             self.transport = transport
 
-        def split_sudo_prompt(self):
+        def split_sudo_prompt(self, command):
             prefix = re.escape(_sudo_prefix(None, None).rstrip()) + ' +'
-            command = self.command
             if isinstance(command, bytes):
                 command = command.decode('utf-8')
 
-            result = re.findall(r'^(%s)?(.*)$' % prefix, command)[0]
-            self.sudo_prompt, self.command = result
+            return re.findall(r'^(%s)?(.*)$' % prefix, command)[0]
 
-        def response(self):
-            result = responses[self.command]
+        def response(self, command):
+            result = responses[command]
             stderr = ""
             status = 0
             sleep = 0
@@ -423,48 +444,55 @@ def serve_responses(responses, files, passwords, home, pubkeys, port):
             time.sleep(sleep)
             return stdout, stderr, status
 
-        def sudo_password(self):
+        def sudo_password(self, channel):
             # Give user 3 tries, as is typical
             passed = False
             for x in range(3):
-                self.channel.send(env.sudo_prompt)
-                password = self.channel.recv(65535).strip()
+                channel.send(env.sudo_prompt)
+                password = channel.recv(65535).strip()
                 # Spit back newline to fake the echo of user's
                 # newline
-                self.channel.send('\n')
+                channel.send('\n')
                 # Test password
                 password = password.decode('utf-8')
                 if password == passwords[self.ssh_server.username]:
                     passed = True
                     break
                 # If here, password was bad.
-                self.channel.send("Sorry, try again.\n")
+                channel.send("Sorry, try again.\n")
             return passed
 
-        def respond(self):
-            for out, err in zip(self.stdout, self.stderr):
+        def respond(self, channel, stdout, stderr, status):
+            for out, err in zip(stdout, stderr):
                 if out is not None:
-                    self.channel.send(out)
+                    channel.send(out)
                 if err is not None:
-                    self.channel.send_stderr(err)
-            self.channel.send_exit_status(self.status)
+                    channel.send_stderr(err)
+            channel.send_exit_status(status)
 
-    return SSHServer((HOST, port), SSHHandler)
+    server = SSHServer((HOST, port), SSHHandler)
+    server.accepted = []
+    server.flaky_lock = threading.Lock()
+    return server
 
 
 def server(responses=RESPONSES, files=FILES,
-           passwords=PASSWORDS, home=HOME, pubkeys=False, port=PORT):
+           passwords=PASSWORDS, home=HOME, pubkeys=False, port=PORT, flaky=0,
+           linger=0.5):
     """
     Returns a decorator that runs an SSH server during function execution.
 
-    Direct passthrough to ``serve_responses``.
+    Direct passthrough to ``serve_responses``. The server is passed to the
+    function as its ``ssh_server`` keyword argument if it has one.
     """
     def run_server(func):
         @wraps(func)
         def inner(*args, **kwargs):
             # Start server
             _server = serve_responses(responses, files, passwords, home,
-                pubkeys, port)
+                pubkeys, port, flaky, linger)
+            if 'ssh_server' in inspect.signature(func).parameters:
+                kwargs['ssh_server'] = _server
             _server.all_done = threading.Event()
             worker = ThreadHandler('server', _server.serve_forever)
             # Execute function
@@ -217,6 +217,17 @@ def test_parallel_wins_vs_serial():
     ok_(requires_parallel(serial2))
     ok_(requires_parallel(serial3))
 
+def test_rolling():
+    """
+    @rolling marks tasks as parallel, with its batch size and failure budget
+    """
+    @decorators.serial
+    @decorators.rolling(5, max_failures=1)
+    def mytask():
+        pass
+    ok_(requires_parallel(mytask))
+    eq_((mytask.batch_size, mytask.max_failures), (5, 1))
+
 @mock_streams('stdout')
 def test_global_parallel_honors_runs_once():
     """
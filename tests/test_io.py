@@ -1,12 +1,21 @@
 # -*- coding: utf-8 -*-
+import re
 import sys
-from io import BytesIO
+import threading
+import time
+from collections import deque
+from io import BytesIO, StringIO
 
-from nose.tools import eq_
+from nose.tools import assert_raises, eq_, ok_
 
-from fabric.io import OutputLooper
+from fabric.io import (
+    CaptureBuffer, ChannelIO, OutputLooper, PromptMatcher, serve_channels
+)
 from fabric.context_managers import hide, settings
+from fabric.state import default_channel
 from mock_streams import mock_streams
+from server import server
+from utils import FabricTest
 
 
 def test_request_prompts():
@@ -14,11 +23,10 @@ def test_request_prompts():
     Test valid responses from prompts
     """
     def run(txt, prompts):
-        with settings(prompts=prompts):
-            # try to fulfil the OutputLooper interface, only want to test
-            # _get_prompt_response. (str has a method upper)
-            ol = OutputLooper(str, 'upper', None, list(txt), None)
-            return ol._get_prompt_response()
+        prompts = list(prompts.items())
+        matcher = PromptMatcher(tuple(expected for expected, response in prompts))
+        index = matcher.match(matcher.advance(0, txt), txt)
+        return (None, None) if index is None else prompts[index]
 
     prompts = {"prompt2": "response2",
                "prompt1": "response1",
@@ -48,8 +56,213 @@ def test_pip_progressbar_at_4096_byte_boundary_error():
         def get_unicode_bytes(self, size):
             return self.source.read(size)
 
-    ol = OutputLooper(Mock(), 'get_unicode_bytes', sys.stdout, None, None)
+    chan = Mock()
+    ol = OutputLooper(chan, 'get_unicode_bytes', sys.stdout, None, None)
 
     with settings(hide('everything')):
-        ol.loop()
+        while True:
+            data = ol.read_func(ol.read_size)
+            if not data:
+                break
+            ol.feed(data)
+        ol.finish()
     eq_(expect, sys.stdout.getvalue())
+
+
+@mock_streams('stdout')
+def test_output_looper_feed_keeps_lines_whole():
+    """
+    OutputLooper.feed() prefixes lines split across reads just once
+    """
+    with settings(host_string='example.com', linewise=True):
+        # Reading from something other than recv, so it's taken for stderr
+        looper = OutputLooper(BytesIO(), 'read', sys.stdout, deque(), None)
+        for data in [b'hel', b'lo\nwor', b'ld']:
+            looper.feed(data)
+        looper.finish()
+    eq_(sys.stdout.getvalue(),
+        "[example.com] err: hello\n[example.com] err: world")
+    eq_("".join(looper.capture), "hello\nworld")
+
+
+class TestServeChannels(FabricTest):
+    @server(responses={
+        'one': ['1 out', '1 err', 0, 1],
+        'two': ['2 out', '', 0, 1],
+    })
+    def test_serves_several_channels_from_one_thread(self):
+        """
+        serve_channels() handles several channels' output at once
+        """
+        channels = []
+        start = time.time()
+        for command in ['one', 'two']:
+            chan = default_channel()
+            chan.set_combine_stderr(False)
+            chan.exec_command(command)
+            channels.append(ChannelIO(chan, StringIO(), StringIO(),
+                                      CaptureBuffer(), CaptureBuffer()))
+        threads = set(threading.enumerate())
+        serve_channels(channels)
+        ok_(set(threading.enumerate()) <= threads)
+        # Each command takes a second
+        ok_(time.time() - start < 1.9)
+        eq_([io.out.capture.getvalue() for io in channels], ['1 out', '2 out'])
+        eq_([io.err.capture.getvalue() for io in channels], ['1 err', ''])
+        eq_([io.chan.recv_exit_status() for io in channels], [0, 0])
+
+
+class _RacingChannel(object):
+    """
+    Channel whose output and EOF arrive just as it's found to have no output.
+    """
+    closed = False
+
+    def __init__(self, output):
+        self.output = output
+        self.buffer = b''
+        self.eof_received = False
+
+    def recv_ready(self):
+        if self.output is not None:
+            # Too late for this check, in time for the EOF check after it
+            self.buffer, self.output = self.output, None
+            self.eof_received = True
+            return False
+        return bool(self.buffer)
+
+    def recv(self, size):
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def recv_stderr_ready(self):
+        return False
+
+    def recv_stderr(self, size):
+        return b''
+
+
+def test_channel_io_reads_output_arriving_with_eof():
+    """
+    ChannelIO doesn't miss output arriving with EOF between its checks
+    """
+    io = ChannelIO(_RacingChannel(b'last words'), StringIO(), StringIO(),
+                   CaptureBuffer(), CaptureBuffer())
+    with hide('everything'):
+        for attempt in range(3):
+            io.read()
+    ok_(io.done)
+    eq_(io.out.capture.getvalue(), 'last words')
+
+
+def test_capture_buffer_keeps_the_tail():
+    """
+    CaptureBuffer keeps only the last maxlen characters, like a deque
+    """
+    buf = CaptureBuffer(maxlen=10)
+    for text in ['abc', 'defgh', 'ijklmnop', 'q']:
+        buf += text
+    eq_(len(buf), 10)
+    eq_(buf.getvalue(), 'hijklmnopq')
+    eq_(''.join(buf), 'hijklmnopq')
+    nothing = CaptureBuffer(maxlen=0)
+    nothing += 'abc'
+    eq_(nothing.getvalue(), '')
+
+
+def test_capture_buffer_suffixes():
+    """
+    CaptureBuffer matches suffixes across chunks, and pops like a deque
+    """
+    buf = CaptureBuffer()
+    buf.join_every = 3
+    for text in ['line one\n', '[sudo] pass', 'word for ', 'me', ': ']:
+        buf += text
+    ok_(buf.endswith('[sudo] password for me: '))
+    ok_(buf.endswith('me: '))
+    ok_(not buf.endswith('password for you: '))
+    ok_(not buf.endswith('x' * 100))
+    eq_([buf.pop() for i in range(6)], [' ', ':', 'e', 'm', ' ', 'r'])
+    eq_(buf.getvalue(), 'line one\n[sudo] password fo')
+    eq_(len(buf), 27)
+    ok_(buf.endswith(''))
+    ok_(CaptureBuffer().endswith(''))
+    ok_(not CaptureBuffer().endswith('x'))
+
+
+def test_capture_buffer_pops_off_long_chunks():
+    """
+    CaptureBuffer pops from the end of long chunks, then carries on adding
+    """
+    buf = CaptureBuffer()
+    buf.join_every = 2
+    buf.pop_split = 4
+    for text in ['abcdef', 'ghijkl', 'mn']:
+        buf += text
+    eq_([buf.pop() for i in range(7)], list('nmlkjih'))
+    for text in ['x', 'yz']:
+        buf += text
+    eq_(len(buf), 10)
+    ok_(buf.endswith('efgxyz'))
+    eq_(buf.getvalue(), 'abcdefgxyz')
+
+
+def test_prompt_matcher_follows_output():
+    """
+    PromptMatcher finds the first prompt the output ends with, across pieces
+    """
+    matcher = PromptMatcher(('word: ', 'password: ', re.compile(r'Overwrite \S+\? '), 'Sorry.\n'))
+    state = 0
+    for text in ['Enter pass', 'wo', 'rd: ']:
+        state = matcher.advance(state, text)
+    eq_(matcher.match(state), 0)
+    eq_(matcher.match(matcher.advance(state, 'x')), None)
+    eq_(matcher.match(matcher.advance(0, 'Sorry.\n')), 3)
+    eq_(matcher.match(matcher.advance(0, 'Sorry.')), None)
+    eq_(matcher.match(0, 'Overwrite /etc/hosts? '), 2)
+    eq_(matcher.match(0, 'Overwrite /etc/hosts?'), None)
+
+
+class PromptedChannel(BytesIO):
+    def __init__(self):
+        BytesIO.__init__(self)
+        self.sent = []
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+
+def test_output_looper_answers_prompts_split_across_reads():
+    """
+    OutputLooper answers env.prompts, literal or regex, split across reads
+    """
+    prompts = {
+        'Continue? [y/n] ': 'y',
+        re.compile(r'Overwrite \S+\? '): 'n',
+    }
+    chan = PromptedChannel()
+    with settings(hide('everything'), prompts=prompts):
+        looper = OutputLooper(chan, 'read', sys.stdout, CaptureBuffer(), None)
+        for data in [b'Installing\nContin', b'ue? [y/', b'n] ', b'y\nOverwrite /etc', b'/hosts? ']:
+            looper.feed(data)
+    eq_(chan.sent, ['y\n', 'n\n'])
+    eq_(looper.capture.getvalue(),
+        'Installing\nContinue? [y/n] y\nOverwrite /etc/hosts? ')
+
+
+def test_output_looper_decodes_incrementally():
+    """
+    OutputLooper decodes characters split across reads, and bad bytes
+    """
+    def capture(reads, **kwargs):
+        with hide('everything'):
+            looper = OutputLooper(BytesIO(), 'read', sys.stdout, CaptureBuffer(), None, **kwargs)
+            for data in reads:
+                looper.feed(data)
+            looper.finish()
+        return looper.capture.getvalue()
+
+    eq_(capture([b'caf\xc3', b'\xa9 \xe2\x82', b'\xac\n']), u'café €\n')
+    eq_(capture([b'bad \xff\xfe byte\n', b'cut \xe2\x82']), u'bad \ufffd\ufffd byte\ncut \ufffd')
+    eq_(capture([b'caf\xe9\n'], encoding='latin-1'), u'café\n')
+    assert_raises(UnicodeDecodeError, capture, [b'bad \xff'], errors='strict')
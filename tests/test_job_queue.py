@@ -0,0 +1,236 @@
+import multiprocessing
+import queue
+import sys
+import threading
+
+from nose.tools import eq_
+
+from fabric.job_queue import (
+    JobQueue, AdaptivePoolSize, LongestFirstSchedule, RoleRoundRobinSchedule
+)
+from fabric.thread_handling import ThreadJob
+
+
+def _put_name(comms, name):
+    comms.put({'name': name, 'result': name.upper()})
+
+
+def _run_jobs(bucket, comms, count=12, pool=3):
+    jobs = JobQueue(pool, comms)
+    for i in range(count):
+        name = 'job%d' % i
+        jobs.append(bucket(target=_put_name, args=(comms, name), name=name))
+    jobs.close()
+    return jobs.run()
+
+
+def test_job_queue_processes():
+    """
+    JobQueue runs Processes, waiting on their sentinels, and collects results
+    """
+    results = _run_jobs(multiprocessing.Process, multiprocessing.Queue())
+    eq_(len(results), 12)
+    for name, result in results.items():
+        eq_(result, {'exit_code': 0, 'results': name.upper()})
+
+
+def test_job_queue_thread_jobs():
+    """
+    JobQueue runs ThreadJobs, waiting on their sentinels, and collects results
+    """
+    results = _run_jobs(ThreadJob, queue.Queue())
+    eq_(len(results), 12)
+    for name, result in results.items():
+        eq_(result, {'exit_code': 0, 'results': name.upper()})
+
+
+def test_job_queue_plain_threads():
+    """
+    JobQueue falls back to polling for jobs without a sentinel
+    """
+    results = _run_jobs(threading.Thread, queue.Queue())
+    eq_(sorted(r['results'] for r in results.values()),
+        sorted('JOB%d' % i for i in range(12)))
+
+
+def test_job_queue_extend_is_lazy():
+    """
+    JobQueue only takes jobs given to extend() as it gets around to them
+    """
+    comms = queue.Queue()
+    finished = []
+    in_flight = []
+
+    def job(name):
+        _put_name(comms, name)
+        finished.append(name)
+
+    def jobs():
+        for i in range(20):
+            # Jobs taken but not finished yet, including this one
+            in_flight.append(i + 1 - len(finished))
+            yield ThreadJob(target=job, args=('job%d' % i,), name='job%d' % i)
+
+    job_queue = JobQueue(3, comms)
+    job_queue.extend(jobs())
+    job_queue.close()
+    eq_(len(list(job_queue.iter_results())), 20)
+    eq_(len(job_queue), 20)
+    assert max(in_flight) <= 3, in_flight
+
+
+def _start_order(schedule, names):
+    comms = queue.Queue()
+    jobs = JobQueue(1, comms, schedule)
+    for name in names:
+        jobs.append(ThreadJob(target=_put_name, args=(comms, name), name=name))
+    jobs.close()
+    return [name for name, result in jobs.iter_results()]
+
+
+def test_fifo_schedule():
+    """
+    JobQueue starts jobs in the order they were queued by default
+    """
+    eq_(_start_order(None, ['a', 'b', 'c']), ['a', 'b', 'c'])
+
+
+def test_longest_first_schedule():
+    """
+    LongestFirstSchedule starts unknown jobs, then the longest ones, first
+    """
+    durations = {'a': 1.0, 'b': 5.0, 'c': 3.0}
+    schedule = LongestFirstSchedule(durations)
+    eq_(_start_order(schedule, ['a', 'b', 'c', 'd']), ['d', 'b', 'c', 'a'])
+    eq_(sorted(durations), ['a', 'b', 'c', 'd'])
+    assert durations['b'] < 5.0
+
+
+def test_role_round_robin_schedule():
+    """
+    RoleRoundRobinSchedule takes turns between roles
+    """
+    schedule = RoleRoundRobinSchedule({'w1': 'web', 'w2': 'web', 'w3': 'web', 'd1': 'db'})
+    eq_(_start_order(schedule, ['w1', 'w2', 'w3', 'd1', 'x']), ['w1', 'd1', 'x', 'w2', 'w3'])
+
+
+def _fine(pool, count, started=100.0, connect_time=0.1):
+    for i in range(count):
+        pool.report({'connects': 1, 'connect_time': connect_time, 'retries': 0},
+                    started, started + 1.0)
+
+
+def test_adaptive_pool_size_grows_until_trouble():
+    """
+    AdaptivePoolSize grows quickly until connecting runs into trouble
+    """
+    pool = AdaptivePoolSize(maximum=50, initial=4)
+    _fine(pool, 8)
+    eq_(pool.size, 12)
+    pool.report({'connects': 1, 'connect_time': 0.1, 'retries': 1}, 100.0, 101.0)
+    eq_(pool.size, 6)
+    # Then only by one per round of jobs
+    _fine(pool, 6, started=102.0)
+    eq_(pool.size, 7)
+    _fine(pool, 2000, started=102.0)
+    eq_(pool.size, 50)
+
+
+def test_adaptive_pool_size_halves_once_per_bout_of_trouble():
+    """
+    AdaptivePoolSize ignores trouble for jobs started before its last cut
+    """
+    pool = AdaptivePoolSize(maximum=50, initial=16)
+    slow = {'connects': 1, 'connect_time': 5.0, 'retries': 0}
+    _fine(pool, 1)
+    eq_(pool.size, 17)
+    pool.report(slow, 100.0, 106.0)
+    eq_(pool.size, 8)
+    pool.report(slow, 100.5, 106.5)
+    eq_(pool.size, 8)
+    pool.report(slow, 107.0, 113.0)
+    eq_(pool.size, 4)
+    for i in range(10):
+        pool.report({'retries': 3}, 200.0 + i, 201.0 + i)
+    eq_(pool.size, 1)
+
+
+def test_adaptive_pool_size_stops_growing_as_tasks_slow_down():
+    """
+    AdaptivePoolSize doesn't grow for jobs much slower than the quickest
+    """
+    pool = AdaptivePoolSize(maximum=50, initial=4)
+    _fine(pool, 1)
+    pool.report({}, 100.0, 110.0)
+    eq_(pool.size, 5)
+
+
+def test_job_queue_adaptive_pool_size():
+    """
+    JobQueue runs as many jobs at once as its AdaptivePoolSize allows
+    """
+    comms = queue.Queue()
+    running = []
+    most_running = []
+
+    def job(name, retries):
+        running.append(name)
+        most_running.append(len(running))
+        comms.put({'name': name, 'stats': {'connects': 1, 'connect_time': 0.0, 'retries': retries}})
+        _put_name(comms, name)
+        running.remove(name)
+
+    pool = AdaptivePoolSize(maximum=8, initial=2)
+    jobs = JobQueue(pool, comms)
+    for i in range(30):
+        name = 'job%d' % i
+        jobs.append(ThreadJob(target=job, args=(name, int(i == 20)), name=name))
+    jobs.close()
+    results = jobs.run()
+    eq_(sorted(results), sorted('job%d' % i for i in range(30)))
+    eq_(set(r['results'] for r in results.values()), set('JOB%d' % i for i in range(30)))
+    assert max(most_running) <= 8, most_running
+    # Halved from 8 by the one retry, then grown a bit by the jobs after it
+    assert 4 <= pool.size <= 6, pool.size
+
+
+def test_job_queue_cancel_after_failure():
+    """
+    JobQueue yields failures before starting more jobs, so they can be cancelled
+    """
+    comms = queue.Queue()
+    jobs = JobQueue(1, comms)
+    for name in ['a', 'b', 'c']:
+        jobs.append(ThreadJob(target=sys.exit, args=(int(name == 'b'),), name=name))
+    jobs.close()
+    seen = []
+    for name, result in jobs.iter_results():
+        seen.append((name, result['exit_code']))
+        if result['exit_code']:
+            jobs.cancel()
+    eq_(seen, [('a', 0), ('b', 1)])
+
+
+def test_job_queue_batches():
+    """
+    JobQueue only starts each batch once the one before it is done
+    """
+    comms = queue.Queue()
+    events = []
+
+    def job(name):
+        events.append(('start', name))
+        _put_name(comms, name)
+        events.append(('end', name))
+
+    jobs = JobQueue(2, comms, batch_size=3)
+    for i in range(8):
+        name = 'job%d' % i
+        jobs.append(ThreadJob(target=job, args=(name,), name=name))
+    jobs.close()
+    eq_(len(jobs.run()), 8)
+    for i in range(3, 8):
+        started = events.index(('start', 'job%d' % i))
+        # Everything in earlier batches has ended by the time this starts
+        for j in range(i - i % 3):
+            assert events.index(('end', 'job%d' % j)) < started, events
@@ -5,17 +5,18 @@ import sys
 from collections.abc import Mapping
 
 from fudge import Fake, patched_context
-from nose.tools import ok_, eq_
+from nose.tools import assert_raises, ok_, eq_
 
 from fabric.decorators import hosts, roles, task
 from fabric.context_managers import settings
-from fabric.main import (parse_arguments, _escape_split, find_fabfile,
+from fabric.main import (parse_arguments, parse_options, _escape_split, find_fabfile,
         load_fabfile as _load_fabfile, list_commands, _task_names,
         COMMANDS_HEADER, NESTED_REMINDER)
 import fabric.state
 from fabric.tasks import Task, WrappedCallableTask
 from fabric.task_utils import _crawl, crawl, merge
 
+from mock_streams import mock_streams
 from utils import FabricTest, fabfile, path_prefix, aborts
 
 
@@ -60,6 +61,24 @@ def test_argument_parsing():
         yield eq_, parse_arguments([args]), [output]
 
 
+def _parse_pool_size(value):
+    with patched_context(sys, 'argv', ['fab', '-z', value]):
+        return parse_options()[1].pool_size
+
+
+@mock_streams('stderr')
+def test_pool_size_option():
+    """
+    --pool-size takes a number (0 meaning unset) or 'auto', and nothing else
+    """
+    eq_(_parse_pool_size('5'), 5)
+    eq_(_parse_pool_size('0'), 0)
+    eq_(_parse_pool_size('auto'), 'auto')
+    for value in ['-3', 'foo']:
+        assert_raises(SystemExit, _parse_pool_size, value)
+        ok_("invalid pool size: '%s'" % value in sys.stderr.getvalue())
+
+
 def test_escaped_task_arg_split():
     """
     Allow backslashes to escape the task argument separator character
@@ -1,13 +1,20 @@
+import errno
+import os
+import socket
 import sys
 import textwrap
+import threading
+import time
 
 from nose.tools import ok_, raises
 from fudge import (Fake, patch_object, with_patched_object, patched_context,
                    with_fakes)
 
 from fabric.context_managers import settings, hide, show
-from fabric.network import (HostConnectionCache, join_host_strings, normalize,
-                            denormalize, key_filenames, ssh, NetworkError, connect)
+from fabric.network import (HostConnectionCache, join_host_strings, normalize, normalize_to_string,
+                            denormalize, key_filenames, ssh, NetworkError, connect,
+                            disconnect_all, known_host_keys, probe_hosts, ssh_config,
+                            _public_key)
 import fabric.network  # noqa: F401  # for patch_object()
 import fabric.utils  # noqa: F401  # for patch_object()
 from fabric.state import env, output, _get_system_username
@@ -17,7 +24,7 @@ from fabric.api import parallel
 
 from mock_streams import mock_streams
 from server import (server, RESPONSES, PASSWORDS, CLIENT_PRIVKEY, USER,
-                    CLIENT_PRIVKEY_PASSPHRASE)
+                    CLIENT_PRIVKEY_PASSPHRASE, SERVER_PRIVKEY)
 from utils import (
     FabricTest, aborts, assert_contains, eq_, match_, password_response, patched_input, support,
 )
@@ -194,6 +201,207 @@ class TestNetwork(FabricTest):
                 # Test
                 ok_(host_string not in hcc)
 
+    def _fake_connections(self, now=None):
+        """
+        Patch connect() to make fake clients, returning the list of hosts
+        whose clients get closed, and the patches (also of time, if given).
+        """
+        closed = []
+
+        def connect(user, host, port, cache, seek_gateway=True):
+            transport = Fake('Transport').provides('is_active').returns(True)
+            return Fake('SSHClient').provides('close').calls(lambda: closed.append(host)) \
+                .provides('get_transport').returns(transport)
+        patches = [patched_context('fabric.network', 'connect', connect)]
+        if now is not None:
+            patches.append(patched_context(
+                'fabric.network', 'time', Fake('time').provides('time').calls(lambda: now[0])))
+        return closed, patches
+
+    def test_connection_cache_size_evicts_least_recently_used(self):
+        """
+        HostConnectionCache closes its least recently used connections to stay in size
+        """
+        cache = HostConnectionCache()
+        closed, (patched,) = self._fake_connections()
+        with patched, settings(connection_cache_size=2):
+            cache['a']
+            cache['b']
+            cache['a']
+            cache['c']
+            eq_(closed, ['b'])
+            ok_('a' in cache and 'b' not in cache and 'c' in cache)
+            # Reconnects on demand
+            cache['b']
+            eq_(closed, ['b', 'a'])
+        eq_(cache.stats, {'hits': 1, 'misses': 4, 'evictions': 2, 'dead': 0})
+
+    def test_connection_cache_evicts_safely_from_several_threads(self):
+        """
+        HostConnectionCache stays consistent while threads connect at once
+        """
+        cache = HostConnectionCache()
+        closed, (patched,) = self._fake_connections()
+        errors = []
+
+        def use(n):
+            try:
+                for i in range(300):
+                    cache['host%d-%d' % (n, i % 5)]
+            except Exception as e:
+                errors.append(e)
+
+        with patched, settings(connection_cache_size=3):
+            threads = [threading.Thread(target=use, args=(n,)) for n in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        eq_(errors, [])
+        ok_(len(cache) <= 3)
+        eq_(len(closed), cache.stats['evictions'])
+        eq_(cache.stats['misses'] - cache.stats['evictions'], len(cache))
+
+    def test_connection_idle_timeout_closes_idle_connections(self):
+        """
+        HostConnectionCache closes connections unused for env.connection_idle_timeout
+        """
+        cache = HostConnectionCache()
+        now = [0]
+        closed, patches = self._fake_connections(now)
+        with patches[0], patches[1], settings(connection_idle_timeout=10):
+            cache['a']
+            now[0] = 5
+            cache['b']
+            now[0] = 12
+            cache['b']
+            eq_(closed, ['a'])
+            now[0] = 30
+            cache['c']
+            eq_(closed, ['a', 'b'])
+        eq_(cache.stats['evictions'], 2)
+
+    def test_gateway_connections_are_not_evicted(self):
+        """
+        HostConnectionCache keeps gateway connections open regardless of limits
+        """
+        cache = HostConnectionCache()
+        cache._gateways.add(normalize_to_string('gw'))
+        closed, (patched,) = self._fake_connections()
+        with patched, settings(connection_cache_size=2):
+            cache['gw']
+            cache['a']
+            cache['b']
+            cache['c']
+        eq_(closed, ['a', 'b'])
+        ok_('gw' in cache)
+
+    @server()
+    def test_closed_connections_are_replaced(self):
+        """
+        Cached connections whose transport has closed are replaced on next use
+        """
+        from fabric.state import connections
+        dead = connections.stats['dead']
+        with hide('everything'):
+            run("ls /simple")
+            client = connections[env.host_string]
+            client.get_transport().close()
+            eq_(run("ls /simple"), RESPONSES["ls /simple"])
+        ok_(connections[env.host_string] is not client)
+        eq_(connections.stats['dead'], dead + 1)
+
+    @server()
+    def test_idle_connections_are_checked_before_use(self):
+        """
+        Cached connections idle for env.connection_check must answer a keepalive
+        """
+        from fabric.state import connections
+        dead = connections.stats['dead']
+        with hide('everything'), settings(connection_check=60, connection_check_timeout=0.5):
+            run("ls /simple")
+            client = connections[env.host_string]
+            transport = client.get_transport()
+            # Still answering
+            fabric.network._last_active[transport] = time.time() - 100
+            run("ls /simple")
+            ok_(connections[env.host_string] is client)
+            # Silently dropped, as if by a NAT timeout
+            dropped = threading.Event()
+            transport.global_request = lambda *args, **kwargs: dropped.wait()
+            fabric.network._last_active[transport] = time.time() - 100
+            try:
+                started = time.time()
+                eq_(run("ls /simple"), RESPONSES["ls /simple"])
+                ok_(time.time() - started < 5)
+            finally:
+                dropped.set()
+        ok_(connections[env.host_string] is not client)
+        eq_(connections.stats['dead'], dead + 1)
+
+    @server()
+    def test_idle_connections_are_not_checked_by_default(self):
+        """
+        Without env.connection_check, idle connections are reused unchecked
+        """
+        from fabric.state import connections
+        eq_(env.connection_check, 0)
+        with hide('everything'):
+            run("ls /simple")
+            client = connections[env.host_string]
+            transport = client.get_transport()
+            requests = []
+            transport.global_request = lambda *args, **kwargs: requests.append(args)
+            fabric.network._last_active[transport] = time.time() - 100
+            eq_(run("ls /simple"), RESPONSES["ls /simple"])
+        ok_(connections[env.host_string] is client)
+        eq_(requests, [])
+
+    def _ready_sessions(self, client, count=1):
+        # Wait for sessions being opened in the background
+        for i in range(50):
+            if len(client._ready_sessions) >= count:
+                break
+            time.sleep(0.1)
+        eq_(len(client._ready_sessions), count)
+        return client._ready_sessions
+
+    @server()
+    def test_sessions_are_opened_ahead_of_time(self):
+        """
+        env.preopen_channels keeps sessions ready for the next command
+        """
+        from fabric.state import connections
+        with hide('everything'), settings(preopen_channels=1):
+            run("ls /simple")
+            client = connections[env.host_string]
+            ready = self._ready_sessions(client)[0]
+            transport = client.get_transport()
+            opened = []
+            real_open_session = transport.open_session
+
+            def open_session(*args, **kwargs):
+                opened.append(threading.current_thread().name)
+                return real_open_session(*args, **kwargs)
+            transport.open_session = open_session
+            eq_(run("ls /simple"), RESPONSES["ls /simple"])
+            ok_(ready.closed)
+            ok_(self._ready_sessions(client)[0] is not ready)
+            # Only in the background, to replace the one used
+            eq_(opened, ['preopen-channel'])
+
+    @server()
+    def test_sessions_closed_before_use_are_skipped(self):
+        """
+        Sessions opened ahead of time but since closed aren't used
+        """
+        from fabric.state import connections
+        with hide('everything'), settings(preopen_channels=2):
+            run("ls /simple")
+            for chan in self._ready_sessions(connections[env.host_string], 2):
+                chan.close()
+            eq_(run("ls /simple"), RESPONSES["ls /simple"])
+
     #
     # Connection loop flow
     #
@@ -245,7 +453,7 @@ class TestNetwork(FabricTest):
             return fake_client
 
         fake_ssh = Fake('ssh', allows_any_call=True)
-        fake_ssh.expects('SSHClient').calls(generate_fake_client)
+        fake_client_class = Fake('_SSHClient').expects_call().calls(generate_fake_client)
 
         # We need the real exceptions here to preserve the inheritence structure
         # and for except clauses because python3 is picky about that
@@ -256,6 +464,7 @@ class TestNetwork(FabricTest):
         fake_ssh.PasswordRequiredException = ssh.PasswordRequiredException
 
         patched_connect = patch_object('fabric.network', 'ssh', fake_ssh)
+        patched_client = patch_object('fabric.network', '_SSHClient', fake_client_class)
         patched_password = patch_object('fabric.network', 'prompt_for_password',
                                         Fake('prompt_for_password', callable=True).times_called(0))
         try:
@@ -263,6 +472,7 @@ class TestNetwork(FabricTest):
         finally:
             # Restore ssh
             patched_connect.restore()
+            patched_client.restore()
             patched_password.restore()
 
     @mock_streams('stdout')
@@ -600,6 +810,278 @@ class TestConnections(FabricTest):
                 raise AssertionError("Host connected without valid "
                                      "fingerprint.")
 
+    def _known_hosts_file(self, *hosts):
+        key = ssh.RSAKey(filename=SERVER_PRIVKEY)
+        return self.mkfile('known_hosts', "".join(
+            "%s %s %s\n" % (host, key.get_name(), key.get_base64()) for host in hosts
+        ))
+
+    def test_known_hosts_are_parsed_once_until_changed(self):
+        env.system_known_hosts = self._known_hosts_file('[127.0.0.1]:2200')
+        host_keys = known_host_keys()
+        ok_(host_keys.lookup('[127.0.0.1]:2200'))
+        ok_(known_host_keys() is host_keys)
+        self._known_hosts_file('[127.0.0.1]:2200', '[127.0.0.1]:2201')
+        os.utime(env.system_known_hosts, (0, 0))
+        ok_(known_host_keys() is not host_keys)
+        ok_(known_host_keys().lookup('[127.0.0.1]:2201'))
+
+    @server()
+    def test_host_in_system_known_hosts(self):
+        """
+        Hosts in env.system_known_hosts are accepted with reject_unknown_hosts
+        """
+        with settings(
+            hide('everything'), reject_unknown_hosts=True,
+            system_known_hosts=self._known_hosts_file('[127.0.0.1]:2200'),
+        ):
+            eq_(run("ls /simple"), RESPONSES["ls /simple"])
+
+    @server()
+    def test_host_keys_accepted_earlier_are_remembered(self):
+        """
+        Host keys accepted by one connection are known to later ones
+        """
+        with patched_context(fabric.network, '_learned_host_keys', ssh.HostKeys()):
+            with settings(hide('everything'), disable_known_hosts=False):
+                run("ls /simple")
+                disconnect_all()
+                with settings(reject_unknown_hosts=True):
+                    eq_(run("ls /simple"), RESPONSES["ls /simple"])
+
+    def _connect_kwargs(self):
+        """
+        Patch connect() calls on new clients to be recorded, returning the
+        list each call's kwargs are appended to.
+        """
+        calls = []
+        real_connect = fabric.network._SSHClient.connect
+
+        def connect(self, **kwargs):
+            calls.append(kwargs)
+            return real_connect(self, **kwargs)
+        return calls, patched_context(fabric.network._SSHClient, 'connect', connect)
+
+    @server(pubkeys=True)
+    def test_winning_key_file_is_tried_first(self):
+        """
+        The key file which worked last time is offered first, by its public key
+        """
+        host = (USER, '127.0.0.1', 2200)
+        calls, patched = self._connect_kwargs()
+        with patched, settings(
+            hide('everything'), no_agent=True, no_keys=True, abort_on_prompts=True,
+            key_filename=CLIENT_PRIVKEY, password=CLIENT_PRIVKEY_PASSPHRASE,
+        ):
+            run("ls /simple")
+            eq_(fabric.network._auth_methods[host], _public_key(CLIENT_PRIVKEY))
+            disconnect_all()
+            # The server takes any key, so whichever is offered first wins
+            with settings(key_filename=[SERVER_PRIVKEY, CLIENT_PRIVKEY]):
+                run("ls /simple")
+        eq_(calls[-1]['key_filename'], [CLIENT_PRIVKEY, SERVER_PRIVKEY])
+        eq_(fabric.network._auth_methods[host], _public_key(CLIENT_PRIVKEY))
+
+    @server()
+    def test_winning_auth_method_is_tried_first(self):
+        """
+        Hosts which took a password last time aren't offered keys first
+        """
+        calls, patched = self._connect_kwargs()
+        with patched, settings(
+            hide('everything'), no_agent=True, no_keys=True, abort_on_prompts=True,
+            key_filename=CLIENT_PRIVKEY,
+        ):
+            run("ls /simple")
+            eq_(fabric.network._auth_methods, {(USER, '127.0.0.1', 2200): 'password'})
+            disconnect_all()
+            run("ls /simple")
+        eq_(calls[0]['key_filename'], [CLIENT_PRIVKEY])
+        eq_(calls[-1]['key_filename'], [])
+        eq_(calls[-1]['allow_agent'], False)
+
+    @server(pubkeys=True)
+    def test_env_key_comes_before_remembered_auth(self):
+        """
+        An explicit env.key is always tried first, whatever worked last time
+        """
+        host = (USER, '127.0.0.1', 2200)
+        calls, patched = self._connect_kwargs()
+        with patched_context(fabric.network, '_auth_methods', {host: 'password'}), patched:
+            with settings(
+                hide('everything'), no_agent=True, no_keys=True, abort_on_prompts=True,
+                key=open(CLIENT_PRIVKEY).read(), password=CLIENT_PRIVKEY_PASSPHRASE,
+                key_filename=SERVER_PRIVKEY,
+            ):
+                eq_(run("ls /simple"), RESPONSES["ls /simple"])
+        ok_(calls[-1]['pkey'] is not None)
+        eq_(calls[-1]['key_filename'], [SERVER_PRIVKEY])
+
+    @server(pubkeys=True)
+    def test_auth_method_which_stops_working_is_forgotten(self):
+        """
+        If what worked last time fails, everything else is tried without prompting
+        """
+        host = (USER, '127.0.0.1', 2200)
+        with patched_context(fabric.network, '_auth_methods', {host: 'password'}):
+            with settings(
+                hide('everything'), no_agent=True, no_keys=True, abort_on_prompts=True,
+                key_filename=CLIENT_PRIVKEY, password=CLIENT_PRIVKEY_PASSPHRASE,
+            ):
+                eq_(run("ls /simple"), RESPONSES["ls /simple"])
+                eq_(fabric.network._auth_methods[host], _public_key(CLIENT_PRIVKEY))
+
+    def _backoff_limits(self):
+        """
+        Patch the random wait between retries to always be its upper limit,
+        returning the list those are appended to.
+        """
+        limits = []
+
+        def uniform(low, high):
+            limits.append((low, high))
+            return high
+        return limits, patched_context(
+            fabric.network, 'random', Fake('random').provides('uniform').calls(uniform))
+
+    @server(flaky=2)
+    def test_dropped_connections_are_retried_with_backoff(self, ssh_server):
+        """
+        Dropped connections are retried after random, exponentially growing waits
+        """
+        limits, patched = self._backoff_limits()
+        with patched, settings(
+            hide('everything'), connection_attempts=4, retry_backoff=0.1, retry_backoff_max=0.15,
+        ):
+            eq_(run("ls /simple"), RESPONSES["ls /simple"])
+        eq_(limits, [(0, 0.1), (0, 0.15)])
+        eq_(len(ssh_server.accepted), 3)
+        ok_(ssh_server.accepted[1] - ssh_server.accepted[0] >= 0.09)
+        ok_(ssh_server.accepted[2] - ssh_server.accepted[1] >= 0.14)
+
+    def test_refused_connections_are_retried_with_backoff(self):
+        """
+        Socket errors are retried after backing off, rather than env.timeout
+        """
+        limits, patched = self._backoff_limits()
+        with patched, settings(connection_attempts=3, retry_backoff=0.05, timeout=10):
+            started = time.time()
+            try:
+                connect(USER, '127.0.0.1', 1234, HostConnectionCache())
+            except NetworkError as e:
+                assert_contains("tried 3 times", e.message)
+            else:
+                raise AssertionError("connect() didn't fail")
+        eq_(limits, [(0, 0.05), (0, 0.1)])
+        ok_(time.time() - started < 5)
+
+    @server(flaky=1000)
+    def test_retry_budget_limits_retries(self, ssh_server):
+        """
+        Connections stop being retried once env.retry_budget has passed
+        """
+        with settings(
+            hide('everything'), connection_attempts=1000, retry_backoff=0.1, retry_budget=0.5,
+        ):
+            started = time.time()
+            try:
+                connect(USER, '127.0.0.1', 2200, HostConnectionCache())
+            except NetworkError as e:
+                assert_contains("Error reading SSH protocol banner", e.message)
+            else:
+                raise AssertionError("connect() didn't fail")
+        ok_(time.time() - started < 3)
+        ok_(1 < len(ssh_server.accepted) < 1000)
+
+    @server()
+    def test_probe_hosts(self):
+        """
+        probe_hosts() reports hosts whose SSH port can't be connected to
+        """
+        unreachable = probe_hosts(['127.0.0.1:2200', '127.0.0.1:1234'])
+        eq_(list(unreachable), ['127.0.0.1:1234'])
+        ok_(isinstance(unreachable['127.0.0.1:1234'], NetworkError))
+        assert_contains("Connection refused", unreachable['127.0.0.1:1234'].message)
+
+    def test_probe_hosts_limits_open_connections(self):
+        """
+        probe_hosts() only has max_open connection attempts going at once
+        """
+        open_socks = []
+        most_open = []
+
+        class Socket(socket.socket):
+            def __init__(self, *args, **kwargs):
+                super(Socket, self).__init__(*args, **kwargs)
+                open_socks.append(self)
+                most_open.append(len(open_socks))
+
+            def close(self):
+                if self in open_socks:
+                    open_socks.remove(self)
+                super(Socket, self).close()
+
+        hosts = ['127.0.0.1:%d' % port for port in range(1230, 1260)]
+        with patched_context(socket, 'socket', Socket):
+            unreachable = probe_hosts(hosts, max_open=4)
+        eq_(sorted(unreachable), sorted(hosts))
+        ok_(max(most_open) <= 4)
+        eq_(open_socks, [])
+
+    def test_probe_hosts_counts_socket_errors_as_unreachable(self):
+        """
+        probe_hosts() reports hosts it can't open a socket for, e.g. for EMFILE
+        """
+        def no_socket(*args):
+            raise OSError(errno.EMFILE, os.strerror(errno.EMFILE))
+
+        with patched_context(socket, 'socket', no_socket):
+            unreachable = probe_hosts(['127.0.0.1:1234', '127.0.0.1:1235'])
+        eq_(sorted(unreachable), ['127.0.0.1:1234', '127.0.0.1:1235'])
+        assert_contains("Too many open files", unreachable['127.0.0.1:1234'].message)
+
+    @server()
+    def test_probe_hosts_tries_each_address(self):
+        """
+        probe_hosts() tries a host's other addresses if the first one fails
+        """
+        def getaddrinfo(host, port, *args):
+            return [
+                (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', 1234)),
+                (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', port)),
+            ]
+
+        with patched_context(socket, 'getaddrinfo', getaddrinfo):
+            eq_(probe_hosts(['dualstack:2200']), {})
+            assert_contains("Connection refused", probe_hosts(['dualstack:1234'])['dualstack:1234'].message)
+
+    def test_probe_hosts_looks_up_names_alongside_each_other(self):
+        """
+        probe_hosts() doesn't wait for one name lookup before starting others
+        """
+        fast_looked_up = threading.Event()
+
+        def getaddrinfo(host, port, *args):
+            if host == 'slow':
+                # Would time out if lookups were done one after another
+                fast_looked_up.wait(5)
+            else:
+                fast_looked_up.set()
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', port))]
+
+        started = time.time()
+        with patched_context(socket, 'getaddrinfo', getaddrinfo):
+            unreachable = probe_hosts(['slow:1234', 'fast:1234'])
+        ok_(time.time() - started < 3)
+        eq_(sorted(unreachable), ['fast:1234', 'slow:1234'])
+
+    def test_probe_hosts_skips_hosts_behind_gateways(self):
+        """
+        probe_hosts() doesn't check hosts it would reach through a gateway
+        """
+        with settings(gateway='127.0.0.1:2200'):
+            eq_(probe_hosts(['127.0.0.1:1234']), {})
+
 
 @parallel
 def parallel_subtask():
@@ -690,6 +1172,28 @@ class TestSSHConfig(FabricTest):
         eq_(normalize("localhost")[1], "localhost")
         eq_(normalize("myalias")[1], "otherhost")
 
+    def test_per_host_results_are_memoized(self):
+        """
+        Each host string's ssh_config values are only looked up once
+        """
+        conf = ssh_config('myhost')
+        eq_(conf['user'], 'neighbor')
+        ok_(ssh_config('myhost') is conf)
+        with settings(host_string='myhost'):
+            ok_(ssh_config() is conf)
+        ok_(ssh_config('otherhost') is not conf)
+
+    def test_changing_config_path_reloads(self):
+        """
+        Changing env.ssh_config_path loads that file instead
+        """
+        eq_(ssh_config('testserver')['user'], 'satan')
+        with settings(ssh_config_path=support("testserver_ssh_config")):
+            eq_(ssh_config('testserver')['user'], 'username')
+        eq_(ssh_config('testserver')['user'], 'satan')
+        with settings(use_ssh_config=False):
+            eq_(ssh_config('testserver'), {})
+
     @with_patched_object('fabric.utils', 'warn',
                          Fake('warn', callable=True, expect_call=True))
     def test_warns_with_bad_config_file_path(self):
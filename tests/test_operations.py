@@ -2,6 +2,8 @@
 import os
 import re
 import sys
+import threading
+import time
 import shutil
 from io import StringIO, BytesIO
 
@@ -11,11 +13,14 @@ from fudge.inspector import arg as fudge_arg
 from mock_streams import mock_streams
 from paramiko.sftp_client import SFTPClient  # for patching
 
+import fabric.operations
+import fabric.state
 from fabric.state import env
 from fabric.context_managers import nested, settings
 from fabric.operations import require, prompt, _sudo_prefix, _shell_wrap, \
     _shell_escape
-from fabric.api import get, put, hide, show, cd, lcd, local, run, sudo, quiet
+from fabric.api import (get, put, hide, show, cd, lcd, local, run, sudo, quiet,
+    run_concurrent)
 from fabric.exceptions import CommandTimeout
 from fabric.sftp import SFTP
 
@@ -420,6 +425,98 @@ class TestRun(FabricTest):
             sudo("slow", timeout=2)
 
 
+concurrent_server = server(responses={
+    'check a': ['a is up', '', 0, 1],
+    'check b': ['b is down', '', 3, 1],
+    'check c': ['c is up', '', 0, 1],
+    'slow': ['', '', 0, 3],
+})
+
+
+class TestRunConcurrent(FabricTest):
+    @concurrent_server
+    def test_results_in_order_of_commands(self):
+        """
+        run_concurrent() runs commands at once and returns results in order
+        """
+        start = time.time()
+        with quiet():
+            results = run_concurrent(['check a', 'check b', 'check c'])
+        # Each takes a second (and a half, till the server closes its channel)
+        ok_(time.time() - start < 3)
+        eq_(results, ['a is up', 'b is down', 'c is up'])
+        eq_([r.return_code for r in results], [0, 3, 0])
+        eq_([r.failed for r in results], [False, True, False])
+        eq_(results[1].command, 'check b')
+
+    @concurrent_server
+    @aborts
+    def test_aborts_once_done_if_any_failed(self):
+        """
+        run_concurrent() aborts on failed commands unless warn_only
+        """
+        with hide('everything'):
+            run_concurrent(['check a', 'check b'], max_channels=1)
+
+    @concurrent_server
+    @raises(CommandTimeout)
+    def test_raises_errors_from_commands(self):
+        """
+        run_concurrent() raises exceptions from any of its commands
+        """
+        with hide('everything'):
+            run_concurrent(['check a', 'slow'], timeout=2)
+
+    def _opened_channels(self):
+        """
+        Patch run_concurrent()'s channels to be recorded as they're opened,
+        returning the list of (thread, channels already open) for each.
+        """
+        opened = []
+        channels = []
+
+        def default_channel():
+            opened.append((threading.current_thread(),
+                           len([chan for chan in channels if not chan.closed])))
+            channels.append(fabric.state.default_channel())
+            return channels[-1]
+        return opened, patched_context(fabric.operations, 'default_channel', default_channel)
+
+    @concurrent_server
+    def test_serves_every_channel_from_the_calling_thread(self):
+        """
+        run_concurrent() starts no threads of its own
+        """
+        opened, patched = self._opened_channels()
+        handlers = []
+
+        def thread_handler(*args, **kwargs):
+            handlers.append(args)
+        with patched, patched_context(fabric.operations, 'ThreadHandler', thread_handler):
+            with quiet():
+                eq_(run_concurrent(['check a', 'check b', 'check c']),
+                    ['a is up', 'b is down', 'c is up'])
+        eq_(opened, [(threading.current_thread(), n) for n in range(3)])
+        eq_(handlers, [])
+
+    @concurrent_server
+    def test_preopened_sessions_count_towards_max_channels(self):
+        """
+        run_concurrent() leaves room for sessions opened ahead of time
+        """
+        opened, patched = self._opened_channels()
+        commands = ['check a', 'check b', 'check c']
+        with patched, quiet():
+            with settings(preopen_channels=2):
+                eq_(run_concurrent(commands, max_channels=4),
+                    ['a is up', 'b is down', 'c is up'])
+            eq_(max(n for thread, n in opened), 1)
+            del opened[:]
+            with settings(preopen_channels=10):
+                run_concurrent(commands)
+            eq_(max(n for thread, n in opened), 0)
+
+
 #
 # get() and put()
 #
@@ -1,12 +1,30 @@
+import json
+import multiprocessing
+import os
+import sys
+import queue
+import threading
+import time
+from io import StringIO
+
+from fudge import patched_context
+
+import fabric
 from fabric.context_managers import hide, settings
-from fabric.decorators import parallel
+from fabric.decorators import parallel, rolling, serial
+from fabric.job_queue import RoleRoundRobinSchedule
+from fabric.main import parse_options
+from fabric.network import disconnect_all
 from fabric.operations import run
-from fabric.state import env
-from fabric.tasks import execute
+from fabric.state import env, connections
+from fabric.tasks import execute, execute_iter, _execute_pipeline, _failure_limit
+from fabric.thread_handling import ThreadJob
+from fabric.utils import _thread_stdin
+from fabric.workers import stop_workers
 
 from utils import FabricTest, eq_, aborts
 from mock_streams import mock_streams
-from server import server, RESPONSES, USER, HOST, PORT
+from server import server, PASSWORDS, RESPONSES, USER, HOST, PORT
 
 # TODO: move this into test_tasks? meh.
 
@@ -94,3 +112,557 @@ class TestParallel(FabricTest):
             result = execute(mytask, hosts=[host1, host2])
         eq_(result[host1], True)
         eq_(result[host2], True)
+
+    @mock_streams('stderr')
+    def test_fail_fast_terminates_running_jobs(self):
+        @parallel
+        def mytask():
+            if env.host_string == 'slow':
+                time.sleep(30)
+            raise OhNoesException
+
+        started = time.time()
+        with settings(hide('everything'), warn_only=True, fail_fast=True, fail_fast_terminate=True):
+            result = execute(mytask, hosts=['slow', 'fast'])
+        assert time.time() - started < 20
+        eq_(result['slow'], None)
+
+
+class TestParallelThreads(FabricTest):
+    def env_setup(self):
+        super(TestParallelThreads, self).env_setup()
+        env.parallel_backend = 'threads'
+
+    @server(port=2200)
+    @server(port=2201)
+    def test_threads_get_isolated_env_and_connections(self):
+        host1 = '127.0.0.1:2200'
+        host2 = '127.0.0.1:2201'
+
+        @parallel
+        def mytask():
+            run("ls /")
+            return env.host_string, env.linewise, list(connections.keys())
+
+        with hide('everything'):
+            result = execute(mytask, hosts=[host1, host2])
+        eq_(result[host1][:2], (host1, True))
+        eq_(result[host2][:2], (host2, True))
+        eq_(len(result[host1][2]), 1)
+        eq_(len(result[host2][2]), 1)
+        # Nothing leaked back into the controlling thread
+        assert not env.linewise
+        eq_(list(connections.keys()), [])
+
+    def test_threads_get_their_own_env_containers(self):
+        @parallel
+        def mytask():
+            env.passwords[env.host_string] = 'secret'
+            env.roledefs.setdefault('web', []).append(env.host_string)
+
+        with hide('everything'):
+            execute(mytask, hosts=['a', 'b'])
+        eq_(env.passwords, {})
+        eq_(env.roledefs, {})
+
+    @server(port=2200)
+    @server(port=2201)
+    def test_threads_do_not_read_parent_stdin(self):
+        host1 = '127.0.0.1:2200'
+        host2 = '127.0.0.1:2201'
+        reads = []
+
+        class Stdin(StringIO):
+            def read(self, *args):
+                reads.append(args)
+                return StringIO.read(self, *args)
+
+        @parallel
+        def mytask():
+            run("ls /")
+            stdin = _thread_stdin()
+            return stdin is sys.stdin, stdin.read()
+
+        with patched_context(sys, 'stdin', Stdin(u'keystrokes')):
+            with hide('everything'):
+                result = execute(mytask, hosts=[host1, host2])
+        # Like forked children, each thread reads an empty stdin of its own
+        eq_(result, {host1: (False, ''), host2: (False, '')})
+        eq_(reads, [])
+
+    @server(port=2200)
+    @server(port=2201)
+    @aborts
+    def test_thread_failures_abort(self):
+        with hide('everything'):
+            host1 = '127.0.0.1:2200'
+            host2 = '127.0.0.1:2201'
+
+            @parallel
+            def mytask():
+                run("ls /")
+                if env.host_string == host2:
+                    raise OhNoesException
+
+            execute(mytask, hosts=[host1, host2])
+
+    def test_unset_pool_size_runs_every_host_at_once(self):
+        with patched_context(sys, 'argv', ['fab', '-z', '0']):
+            env.pool_size = parse_options()[1].pool_size
+        eq_(env.pool_size, 0)
+        hosts = ['a', 'b', 'c']
+        # Only gets past this with a worker for each host
+        barrier = threading.Barrier(len(hosts), timeout=10)
+
+        @parallel
+        def mytask():
+            barrier.wait()
+            return env.host_string
+
+        with hide('everything'):
+            eq_(execute(mytask, hosts=hosts), dict((host, host) for host in hosts))
+
+    @mock_streams('stderr')
+    def test_thread_failures_honor_warn_only(self):
+        @parallel
+        def mytask():
+            if env.host_string == 'b':
+                raise OhNoesException
+            return env.host_string
+
+        with settings(hide('everything'), warn_only=True):
+            result = execute(mytask, hosts=['a', 'b'])
+        eq_(result['a'], 'a')
+        assert isinstance(result['b'], OhNoesException)
+
+    def test_execute_iter_yields_hosts_as_they_finish(self):
+        release = threading.Event()
+
+        @parallel
+        def mytask():
+            if env.host_string == 'slow':
+                assert release.wait(5)
+            return env.host_string
+
+        with hide('everything'):
+            results = execute_iter(mytask, hosts=['slow', 'fast'])
+            eq_(next(results), ('fast', 'fast'))
+            release.set()
+            eq_(list(results), [('slow', 'slow')])
+
+    @aborts
+    @mock_streams('stderr')
+    def test_execute_iter_yields_failures_before_aborting(self):
+        @parallel
+        def mytask():
+            if env.host_string == 'b':
+                raise OhNoesException
+            return env.host_string
+
+        seen = {}
+        try:
+            with hide('everything'):
+                for host, result in execute_iter(mytask, hosts=['a', 'b']):
+                    seen[host] = result
+        finally:
+            eq_(seen['a'], 'a')
+            assert isinstance(seen['b'], OhNoesException)
+
+    def test_longest_first_schedule_records_durations(self):
+        env.schedule = 'longest-first'
+        env.schedule_history = self.path('durations.json')
+
+        @parallel
+        def mytask():
+            pass
+
+        with hide('everything'):
+            execute(mytask, hosts=['a', 'b'])
+        with open(env.schedule_history) as f:
+            eq_(sorted(json.load(f)['mytask']), ['a', 'b'])
+
+    def test_other_schedules_leave_durations_alone(self):
+        env.schedule_history = self.path('durations.json')
+
+        @parallel
+        def mytask():
+            pass
+
+        for schedule in ('fifo', 'role-round-robin'):
+            with settings(hide('everything'), schedule=schedule):
+                execute(mytask, hosts=['a', 'b'])
+        assert not os.path.exists(env.schedule_history)
+
+    @mock_streams('stderr')
+    def test_fail_fast_stops_starting_hosts(self):
+        ran = []
+
+        @parallel(pool_size=1)
+        def mytask():
+            ran.append(env.host_string)
+            if env.host_string == 'b':
+                raise OhNoesException
+            return env.host_string
+
+        with settings(hide('running', 'status', 'aborts'), warn_only=True, fail_fast='1'):
+            result = execute(mytask, hosts=['a', 'b', 'c', 'd'])
+        eq_(ran, ['a', 'b'])
+        eq_(result['a'], 'a')
+        assert isinstance(result['b'], OhNoesException)
+        eq_(result['c'], None)
+        assert "skipped 2 host(s): c, d" in sys.stderr.getvalue()
+
+    @mock_streams('stderr')
+    def test_rolling_stops_after_failed_batch(self):
+        ran = []
+
+        @rolling(2)
+        def mytask():
+            ran.append(env.host_string)
+            if env.host_string == 'c':
+                raise OhNoesException
+
+        with settings(hide('running', 'status', 'aborts'), warn_only=True):
+            result = execute(mytask, hosts=['a', 'b', 'c', 'd', 'e', 'f'])
+        eq_(sorted(ran), ['a', 'b', 'c', 'd'])
+        eq_(result['e'], None)
+        assert "Batch 2 failed on more than 0 host(s); skipped 2 host(s): e, f" \
+            in sys.stderr.getvalue()
+
+    @mock_streams('stderr')
+    def test_rolling_batches_within_failure_budget_carry_on(self):
+        ran = []
+
+        @parallel
+        def mytask():
+            ran.append(env.host_string)
+            if env.host_string in 'ad':
+                raise OhNoesException
+
+        with settings(hide('everything'), warn_only=True, batch_size='50%', max_batch_failures=1):
+            result = execute(mytask, hosts=['a', 'b', 'c', 'd'])
+        eq_(sorted(ran), ['a', 'b', 'c', 'd'])
+        # First batch done before second started
+        eq_(sorted(ran[:2]), ['a', 'b'])
+        assert isinstance(result['d'], OhNoesException)
+
+    def test_fail_fast_limits(self):
+        for spec, num_hosts, limit in [
+            (None, 100, None),
+            (True, 100, 1),
+            ('5', 100, 5),
+            (3, 100, 3),
+            ('2%', 100, 2),
+            ('2%', 10, 1),
+            ('5,2%', 1000, 5),
+            ('5, 2%', 100, 2),
+        ]:
+            with settings(fail_fast=spec):
+                eq_(_failure_limit(num_hosts), limit)
+
+
+class TestPersistentWorkers(FabricTest):
+    def env_setup(self):
+        super(TestPersistentWorkers, self).env_setup()
+        env.persistent_workers = True
+
+    def teardown(self):
+        stop_workers()
+        disconnect_all()
+        super(TestPersistentWorkers, self).teardown()
+
+    def _run_twice(self, task, commands):
+        host1 = '127.0.0.1:2200'
+        host2 = '127.0.0.1:2201'
+        with patched_context(fabric.state, 'commands', commands):
+            with hide('everything'):
+                first = execute(task, hosts=[host1, host2])
+                second = execute(task, hosts=[host1, host2])
+        return [(first[host], second[host]) for host in (host1, host2)]
+
+    @server(port=2200)
+    @server(port=2201)
+    def test_workers_keep_connections_between_tasks(self):
+        @parallel
+        def mytask():
+            run("ls /")
+            return os.getpid(), [id(c) for c in connections.values()]
+
+        for first, second in self._run_twice(mytask, {'mytask': mytask}):
+            eq_(first, second)
+            eq_(len(first[1]), 1)
+            assert first[0] != os.getpid()
+
+    @server(port=2200)
+    @server(port=2201)
+    def test_workers_report_connection_stats(self):
+        connects = []
+
+        class Pool(fabric.tasks.AdaptivePoolSize):
+            def report(self, stats, started, finished):
+                connects.append(stats['connects'])
+                super(Pool, self).report(stats, started, finished)
+
+        @parallel
+        def mytask():
+            run("ls /")
+
+        env.pool_size = 'auto'
+        with patched_context(fabric.tasks, 'AdaptivePoolSize', Pool):
+            self._run_twice(mytask, {'mytask': mytask})
+        # Connected the first time round, and kept those connections after
+        eq_(connects, [1, 1, 0, 0])
+
+    @server(port=2200)
+    @server(port=2201)
+    def test_disconnect_all_leaves_workers_running(self):
+        @parallel
+        def mytask():
+            run("ls /")
+            return os.getpid()
+
+        with patched_context(fabric.state, 'commands', {'mytask': mytask}):
+            with hide('everything'):
+                first = execute(mytask, hosts=['127.0.0.1:2200'])
+                disconnect_all()
+                second = execute(mytask, hosts=['127.0.0.1:2200'])
+        eq_(first, second)
+
+    @server(port=2200)
+    @server(port=2201)
+    def test_threads_keep_connections_between_tasks(self):
+        env.parallel_backend = 'threads'
+
+        @parallel
+        def mytask():
+            run("ls /")
+            return [id(c) for c in connections.values()]
+
+        for first, second in self._run_twice(mytask, {}):
+            eq_(first, second)
+            eq_(len(first), 1)
+
+    @server(port=2200)
+    @server(port=2201)
+    def test_unregistered_tasks_fall_back_to_fresh_children(self):
+        @parallel
+        def mytask():
+            run("ls /")
+            return os.getpid()
+
+        for first, second in self._run_twice(mytask, {}):
+            assert first != second
+
+    @aborts
+    @mock_streams('stderr')
+    def test_worker_failures_abort(self):
+        @parallel
+        def mytask():
+            if env.host_string == 'b':
+                raise OhNoesException
+            return env.host_string
+
+        with patched_context(fabric.state, 'commands', {'mytask': mytask}):
+            with hide('everything'):
+                execute(mytask, hosts=['a', 'b'])
+
+
+class TestPipeline(FabricTest):
+    def env_setup(self):
+        super(TestPipeline, self).env_setup()
+        env.parallel_backend = 'threads'
+
+    def _run(self, commands, *names):
+        with patched_context(fabric.state, 'commands', commands):
+            with hide('everything'):
+                _execute_pipeline([(name, [], {}, ['slow', 'fast'], [], []) for name in names])
+
+    def test_hosts_move_on_without_waiting_for_others(self):
+        fast_done = threading.Event()
+
+        @parallel
+        def first():
+            if env.host_string == 'slow':
+                # Would time out if 'fast' had to wait for us to finish here
+                assert fast_done.wait(5)
+
+        @parallel
+        def second():
+            if env.host_string == 'fast':
+                fast_done.set()
+
+        self._run({'first': first, 'second': second}, 'first', 'second')
+
+    def test_serial_tasks_are_barriers(self):
+        log = []
+
+        @parallel
+        def first():
+            log.append(('first', env.host_string))
+
+        @serial
+        def middle():
+            log.append(('middle', env.host_string))
+
+        self._run({'first': first, 'middle': middle}, 'first', 'middle', 'first')
+        eq_(sorted(log[:2]), [('first', 'fast'), ('first', 'slow')])
+        eq_(log[2:4], [('middle', 'slow'), ('middle', 'fast')])
+        eq_(sorted(log[4:]), [('first', 'fast'), ('first', 'slow')])
+
+    def test_role_round_robin_sees_each_stages_roles(self):
+        seen = []
+
+        class Schedule(RoleRoundRobinSchedule):
+            def __init__(self, roles):
+                super(Schedule, self).__init__(roles)
+                seen.append(roles)
+
+        @parallel
+        def first():
+            pass
+
+        @parallel
+        def second():
+            pass
+
+        env.roledefs = {'web': ['w1', 'w2'], 'db': ['d1']}
+        env.schedule = 'role-round-robin'
+        with patched_context(fabric.tasks, 'RoleRoundRobinSchedule', Schedule):
+            with patched_context(fabric.state, 'commands', {'first': first, 'second': second}):
+                with hide('everything'):
+                    _execute_pipeline([
+                        ('first', [], {}, [], ['web'], []),
+                        ('second', [], {}, [], ['db'], []),
+                    ])
+        eq_(seen, [{'w1': 'web', 'w2': 'web', 'd1': 'db'}])
+
+    def test_auto_pool_size_of_any_stage_applies_to_pipeline(self):
+        pools = []
+
+        class Pool(fabric.tasks.AdaptivePoolSize):
+            def __init__(self, *args, **kwargs):
+                super(Pool, self).__init__(*args, **kwargs)
+                pools.append(self)
+
+        @parallel
+        def first():
+            pass
+
+        @parallel(pool_size='auto')
+        def second():
+            pass
+
+        with patched_context(fabric.tasks, 'AdaptivePoolSize', Pool):
+            self._run({'first': first, 'second': second}, 'first', 'second')
+        eq_(len(pools), 1)
+
+    @aborts
+    @mock_streams('stderr')
+    def test_failures_stop_that_hosts_pipeline_then_abort(self):
+        log = []
+
+        @parallel
+        def first():
+            if env.host_string == 'slow':
+                raise OhNoesException
+
+        @parallel
+        def second():
+            log.append(env.host_string)
+
+        try:
+            self._run({'first': first, 'second': second}, 'first', 'second')
+        finally:
+            eq_(log, ['fast'])
+
+
+def _counting_context(job_class, queue_class):
+    """
+    Return a parallel context, and a list of how many of its jobs had been
+    created but not started, noted each time one was created.
+    """
+    waiting = []
+    most_waiting = []
+
+    class Process(job_class):
+        def __init__(self, *args, **kwargs):
+            super(Process, self).__init__(*args, **kwargs)
+            waiting.append(self)
+            most_waiting.append(len(waiting))
+
+        def start(self):
+            waiting.remove(self)
+            super(Process, self).start()
+
+    class Context(object):
+        Queue = queue_class
+
+    Context.Process = Process
+    return Context, most_waiting
+
+
+class TestParallelScale(FabricTest):
+    @server(passwords=dict(('user%d' % i, PASSWORDS[USER]) for i in range(100)))
+    def test_large_host_lists_create_jobs_lazily(self):
+        # Thread jobs, as forking while the test server's threads are busy
+        # can leave children deadlocked on locks those threads held
+        context, most_waiting = _counting_context(ThreadJob, queue.Queue)
+
+        @parallel
+        def mytask():
+            return run("ls /simple")
+
+        hosts = ['user%d@%s:%s' % (i, HOST, PORT) for i in range(100)]
+        env.password = PASSWORDS[USER]
+        env.pool_size = 20
+        with patched_context(fabric.tasks, '_parallel_context', lambda: context):
+            with hide('everything'):
+                results = execute(mytask, hosts=hosts)
+        eq_(sorted(results), sorted(hosts))
+        eq_(set(results.values()), set([RESPONSES["ls /simple"]]))
+        # Each job is only created right before it's started
+        eq_(max(most_waiting), 1)
+
+    def test_host_lists_create_processes_lazily(self):
+        # The processes backend, without connecting anywhere, so no test
+        # server threads are busy when children are forked
+        ctx = multiprocessing.get_context('fork')
+        context, most_waiting = _counting_context(ctx.Process, ctx.Queue)
+
+        @parallel
+        def mytask():
+            return env.host_string.upper()
+
+        hosts = ['host%d' % i for i in range(30)]
+        env.pool_size = 5
+        with patched_context(fabric.tasks, '_parallel_context', lambda: context):
+            with hide('everything'):
+                results = execute(mytask, hosts=hosts)
+        eq_(results, dict((host, host.upper()) for host in hosts))
+        eq_(max(most_waiting), 1)
+
+    @server(passwords=dict(('user%d' % i, PASSWORDS[USER]) for i in range(30)))
+    def test_auto_pool_size_adapts_to_connections(self):
+        sizes = []
+
+        class Pool(fabric.tasks.AdaptivePoolSize):
+            def report(self, stats, started, finished):
+                eq_(stats['connects'], 1)
+                super(Pool, self).report(stats, started, finished)
+                sizes.append(self.size)
+
+        @parallel
+        def mytask():
+            return run("ls /simple")
+
+        hosts = ['user%d@%s:%s' % (i, HOST, PORT) for i in range(30)]
+        env.password = PASSWORDS[USER]
+        env.parallel_backend = 'threads'
+        env.pool_size = 'auto'
+        with patched_context(fabric.tasks, 'AdaptivePoolSize', Pool):
+            with hide('everything'):
+                results = execute(mytask, hosts=hosts)
+        eq_(set(results.values()), set([RESPONSES["ls /simple"]]))
+        eq_(len(sizes), 30)
+        # Started small, and grew while connecting went well
+        assert 4 < max(sizes) <= 30, sizes
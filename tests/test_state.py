@@ -1,6 +1,9 @@
+import threading
+
 from nose.tools import eq_
 
 from fabric.state import _AliasDict
+from fabric.utils import _AttributeDict, _set_thread_shadows
 
 
 def test_dict_aliasing():
@@ -50,3 +53,22 @@ def test_dict_alias_expansion():
         aliases={'foo': ['bar', 'nested'], 'nested': ['biz']}
     )
     eq_(ad.expand_aliases(['foo']), ['bar', 'biz'])
+
+
+def test_thread_local_dict_storage():
+    """
+    _ThreadLocalDict contents may be swapped out for a single thread
+    """
+    d = _AttributeDict({'foo': 'shared'})
+    seen = []
+
+    def worker():
+        _set_thread_shadows({id(d): {'foo': 'private'}})
+        d.bar = 'new'
+        seen.append((d.foo, sorted(d.keys())))
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+    eq_(seen, [('private', ['bar', 'foo'])])
+    eq_(dict(d), {'foo': 'shared'})
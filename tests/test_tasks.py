@@ -5,14 +5,15 @@ import random
 import sys
 
 import fabric
-from fabric.tasks import WrappedCallableTask, execute, Task, get_task_details
+import fabric.network  # noqa: F401  # for patched_context()
+from fabric.tasks import WrappedCallableTask, execute, execute_iter, Task, get_task_details
 from fabric.main import display_command
 from fabric.api import run, env, settings, hosts, roles, hide, parallel, task, runs_once, serial
 from fabric.exceptions import NetworkError
 
 from mock_streams import mock_streams
 from utils import eq_, FabricTest, aborts, support
-from server import server
+from server import server, RESPONSES, USER
 
 
 def test_base_task_provides_undefined_name():
@@ -24,6 +25,30 @@ def test_base_task_raises_exception_on_call_to_run():
     task = Task()
     task.run()
 
+class TestPoolSize(FabricTest):
+    hosts = ['a', 'b', 'c']
+
+    def test_unset_pool_size_is_one_per_host(self):
+        for pool_size in [0, '0', None]:
+            eq_(Task().get_pool_size(self.hosts, pool_size), 3)
+
+    def test_task_pool_size_overrides_default(self):
+        task = Task()
+        task.pool_size = '2'
+        eq_(task.get_pool_size(self.hosts, 0), 2)
+        eq_(task.get_pool_size(self.hosts, 'auto'), 2)
+        task.pool_size = 0
+        eq_(task.get_pool_size(self.hosts, 1), 1)
+
+    @aborts
+    def test_junk_pool_size_aborts(self):
+        Task().get_pool_size(self.hosts, 'foo')
+
+    @aborts
+    def test_negative_pool_size_aborts(self):
+        Task().get_pool_size(self.hosts, -1)
+
+
 class TestWrappedCallableTask(unittest.TestCase):
     def test_passes_unused_args_to_parent(self):
         args = [i for i in range(random.randint(1, 10))]
@@ -425,6 +450,124 @@ class TestExecute(FabricTest):
             retval = execute(task)
         eq_(retval, {'127.0.0.1:2200': '2200', '127.0.0.1:2201': '2201'})
 
+    @server(port=2200)
+    @server(port=2201)
+    def test_preconnect_connects_to_all_hosts_first(self):
+        """
+        env.preconnect connects serial tasks to all their hosts before running
+        """
+        connected = []
+
+        @hosts('127.0.0.1:2200', '127.0.0.1:2201')
+        def task():
+            connected.append(sorted(fabric.state.connections.keys()))
+            return run("ls /simple")
+        with hide('everything'), settings(preconnect=True):
+            retval = execute(task)
+        eq_(connected[0], ['%s@127.0.0.1:2200' % USER, '%s@127.0.0.1:2201' % USER])
+        eq_(retval, {'127.0.0.1:2200': RESPONSES["ls /simple"], '127.0.0.1:2201': RESPONSES["ls /simple"]})
+
+    @server(port=2200)
+    @server(port=2201)
+    @mock_streams('stderr')
+    def test_preconnect_stops_at_connection_cache_size(self):
+        """
+        env.preconnect doesn't open more connections than the cache keeps open
+        """
+        connected = []
+
+        @hosts('127.0.0.1:2200', '127.0.0.1:2201')
+        def task():
+            connected.append(sorted(fabric.state.connections.keys()))
+        evictions = fabric.state.connections.stats['evictions']
+        with hide('running', 'status'), settings(preconnect=True, connection_cache_size=1):
+            execute(task)
+        eq_(connected[0], ['%s@127.0.0.1:2200' % USER])
+        eq_(fabric.state.connections.stats['evictions'], evictions)
+        assert "first 1 of 2 hosts" in sys.stderr.getvalue()
+
+    @server(port=2200)
+    def test_preconnect_skips_bad_hosts_up_front(self):
+        """
+        env.preconnect with env.skip_bad_hosts skips unreachable hosts without retrying
+        """
+        ran = []
+
+        def task():
+            ran.append(env.host_string)
+        attempts = []
+        real_connect = fabric.network.connect
+
+        def connect(user, host, port, *args, **kwargs):
+            attempts.append(port)
+            return real_connect(user, host, port, *args, **kwargs)
+        with hide('everything'), settings(preconnect=True, skip_bad_hosts=True), \
+                patched_context(fabric.network, 'connect', connect):
+            retval = execute(task, hosts=['127.0.0.1:1234', '127.0.0.1:2200'])
+        eq_(ran, ['127.0.0.1:2200'])
+        assert isinstance(retval['127.0.0.1:1234'], NetworkError)
+        eq_(sorted(attempts), ['1234', '2200'])
+
+    @server(port=2200)
+    def test_preconnect_aborts_before_running_anywhere(self):
+        """
+        env.preconnect aborts before running on any host if one can't be reached
+        """
+        ran = []
+
+        def task():
+            ran.append(env.host_string)
+        with hide('everything'), settings(preconnect=True):
+            try:
+                execute(task, hosts=['127.0.0.1:2200', '127.0.0.1:1234'])
+            except SystemExit:
+                pass
+            else:
+                raise AssertionError("execute() didn't abort")
+        eq_(ran, [])
+
+    @server(port=2200)
+    @mock_streams('stderr')
+    def test_probe_hosts_skips_unreachable_hosts(self):
+        """
+        env.probe_hosts with env.skip_bad_hosts skips unreachable hosts, in one warning
+        """
+        ran = []
+
+        def task():
+            ran.append(env.host_string)
+        with hide('running', 'status'), settings(probe_hosts=True, skip_bad_hosts=True):
+            retval = execute(task, hosts=['127.0.0.1:1234', '127.0.0.1:2200', '127.0.0.1:1235'])
+        eq_(ran, ['127.0.0.1:2200'])
+        assert isinstance(retval['127.0.0.1:1234'], NetworkError)
+        assert isinstance(retval['127.0.0.1:1235'], NetworkError)
+        eq_(sys.stderr.getvalue().count("Warning:"), 1)
+        assert "2 of 3 host(s) unreachable: 127.0.0.1:1234 (Connection refused), " \
+            "127.0.0.1:1235 (Connection refused)" in sys.stderr.getvalue()
+
+    @server(port=2200)
+    def test_probe_hosts_skips_unreachable_hosts_in_parallel(self):
+        """
+        env.probe_hosts leaves unreachable hosts out of parallel tasks
+        """
+        @parallel
+        def task():
+            return env.host_string
+        with hide('everything'), settings(probe_hosts=True, skip_bad_hosts=True, parallel_backend='threads'):
+            retval = execute(task, hosts=['127.0.0.1:1234', '127.0.0.1:2200'])
+        eq_(retval['127.0.0.1:2200'], '127.0.0.1:2200')
+        assert isinstance(retval['127.0.0.1:1234'], NetworkError)
+
+    @aborts
+    def test_probe_hosts_aborts_before_running_anywhere(self):
+        """
+        env.probe_hosts aborts before running on any host if one can't be reached
+        """
+        def task():
+            raise AssertionError("task ran")
+        with hide('everything'), settings(probe_hosts=True):
+            execute(task, hosts=['127.0.0.1:1235', '127.0.0.1:1234'])
+
     @with_fakes
     def test_should_work_with_Task_subclasses(self):
         """
@@ -478,6 +621,37 @@ class TestExecute(FabricTest):
 
         eq_(run['localhost:2200'], 'bar')
 
+    def test_execute_iter_yields_each_host_in_turn(self):
+        """
+        execute_iter() yields results one host at a time, outside the task's env
+        """
+        ran = []
+
+        def task():
+            ran.append(env.host_string)
+            return env.host_string.upper()
+
+        host_string = env.host_string
+        results = execute_iter(task, hosts=['a', 'b'])
+        eq_(ran, [])
+        eq_(next(results), ('a', 'A'))
+        eq_(ran, ['a'])
+        eq_(env.host_string, host_string)
+        eq_(list(results), [('b', 'B')])
+
+    def test_execute_iter_closed_early_runs_no_more_hosts(self):
+        """
+        Stopping iteration over execute_iter() skips the remaining hosts
+        """
+        ran = []
+
+        def task():
+            ran.append(env.host_string)
+
+        for host, result in execute_iter(task, hosts=['a', 'b', 'c']):
+            break
+        eq_(ran, ['a'])
+
 
 class TestExecuteEnvInteractions(FabricTest):
     def set_network(self):
@@ -14,7 +14,7 @@ from nose.tools import raises
 
 from fabric.state import env, output
 from fabric.sftp import SFTP
-from fabric.network import to_dict
+from fabric.network import to_dict, _auth_methods, _loaded_keys
 
 from server import PORT, PASSWORDS, USER, HOST
 from mock_streams import mock_streams
@@ -27,6 +27,10 @@ class FabricTest(object):
     def setup(self):
         # Clear Fudge mock expectations
         clear_expectations()
+        # Forget keys and auth methods from earlier tests, so they prompt as
+        # they would in a new session
+        _auth_methods.clear()
+        _loaded_keys.clear()
         # Copy env, output for restoration in teardown
         self.previous_env = copy.deepcopy(env)
         # Deepcopy doesn't work well on AliasDicts; but they're only one layer